@@ -0,0 +1,285 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5.QtCore import PYQT_VERSION_STR, QT_VERSION_STR, QEvent, QPoint, QPointF, QRectF, Qt
+from PyQt5.QtGui import QImage, QMouseEvent, QPainter
+from PyQt5.QtWidgets import QApplication, QStyleOptionGraphicsItem
+
+from diagramscene import (DiagramBinaryReader, DiagramDocument, DiagramItem, DiagramModel, DiagramScene, MainWindow,
+                            diagramlayout)
+
+
+def makeDocument(nodeCount, edgesPerNode=1.5, seed=1):
+    rng = random.Random(seed)
+    document = DiagramDocument()
+    document.fonts = [DiagramScene(None).font().toString()]
+    columns = max(1, int(nodeCount ** 0.5))
+    types = [diagramType.value for diagramType in DiagramItem.DiagramType]
+    for i in range(nodeCount):
+        diagramType = types[i % len(types)]
+        document.nodes.append([diagramType, (i % columns)*300., (i // columns)*300., 'Node_' + str(i),
+                                '#ffffffff', 0., 0, '#ff000000', 0., 105.])
+    for i in range(int(nodeCount*edgesPerNode)):
+        start = rng.randrange(nodeCount)
+        end = rng.randrange(nodeCount)
+        if start != end:
+            document.arrows.append([start, end, '#ff000000'])
+    return document
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def benchmarkDocument(nodeCount):
+    document = makeDocument(nodeCount)
+    scene = DiagramScene(None)
+    buildTime, _ = timed(lambda: document.toScene(scene))
+
+    with tempfile.TemporaryDirectory() as directory:
+        fileName = os.path.join(directory, 'benchmark.diagram')
+        collectTime, saved = timed(lambda: DiagramDocument.fromScene(scene))
+        writeTime, _ = timed(lambda: saved.save(fileName))
+        size = os.path.getsize(fileName)
+        parseTime, loaded = timed(lambda: DiagramDocument.load(fileName))
+
+        binaryFileName = os.path.join(directory, 'benchmark.dgmb')
+        binaryWriteTime, _ = timed(lambda: saved.saveBinary(binaryFileName))
+        binarySize = os.path.getsize(binaryFileName)
+        binaryOpenTime, reader = timed(lambda: DiagramBinaryReader(binaryFileName))
+        modelTime, model = timed(lambda: DiagramModel.fromBinary(reader))
+        reader.close()
+        viewportTime, _ = timed(lambda: model.nodesInRect(QRectF(0, 0, 1920, 1080)))
+        binaryParseTime, _ = timed(lambda: DiagramDocument.loadBinary(binaryFileName))
+
+    return {'nodes': nodeCount, 'arrows': len(loaded.arrows), 'bytes': size, 'binaryBytes': binarySize,
+            'save.collect': collectTime, 'save.write': writeTime, 'save.binary': binaryWriteTime,
+            'load.parse': parseTime, 'load.binary': binaryParseTime, 'load.build': buildTime,
+            'open.mmap': binaryOpenTime, 'open.model': modelTime, 'open.viewport': viewportTime}
+
+
+def benchmarkLayout(nodeCount):
+    scene = DiagramScene(None)
+    makeDocument(nodeCount).toScene(scene)
+    inputTime, (nodes, arguments) = timed(scene.layoutInput)
+    computeTime, (xs, ys) = timed(lambda: diagramlayout.layeredLayout(**arguments))
+    applyTime, _ = timed(lambda: scene.applyLayout(nodes, xs.tolist(), ys.tolist()))
+    return {'nodes': nodeCount, 'arrows': len(arguments['starts']),
+            'layout.input': inputTime, 'layout.compute': computeTime, 'layout.apply': applyTime}
+
+
+def sendMouse(widget, eventType, pos, button, buttons):
+    QApplication.sendEvent(widget, QMouseEvent(eventType, QPointF(pos), QPointF(widget.mapToGlobal(pos)),
+                                                button, buttons, Qt.NoModifier))
+
+
+def benchmarkScene(nodeCount, dragCount=100, moves=30, frames=5, zoomLevels=(10, 50, 100, 200), overlapCount=300):
+    window = MainWindow()
+    window.resize(1280, 800)
+    window.show()
+    app = QApplication.instance()
+    app.processEvents()
+    scene = window.scene
+    view = window.view
+    viewport = view.viewport()
+    document = makeDocument(nodeCount)
+    records = [(DiagramItem.DiagramType(node[0]), QPointF(node[1], node[2]), node[3]) for node in document.nodes]
+
+    # one node per call, the way the toolbox inserts them
+    def insertEach():
+        for diagramType, pos, name in records:
+            scene.setItemType(diagramType)
+            scene.setMode(DiagramScene.Mode.InsertItem)
+            scene.insertItem(pos)
+    insertTime, _ = timed(insertEach)
+    scene.clearDiagram()
+    bulkTime, items = timed(lambda: scene.insertItems(records))
+    arrowTime, arrows = timed(lambda: scene.addArrows([(items[start], items[end]) for start, end, color in document.arrows]))
+    app.processEvents()
+
+    # drag the block of nodes nearest to the first one through the view
+    grabbed = items[0]
+    selection = sorted(items, key=lambda item: (item.pos() - grabbed.pos()).manhattanLength())[:dragCount]
+    for item in selection:
+        item.setSelected(True)
+    draggedArrows = len({arrow for item in selection for arrow in item.arrows()})
+    view.centerOn(grabbed)
+    app.processEvents()
+    pos = view.mapFromScene(grabbed.pos())
+    sendMouse(viewport, QEvent.MouseButtonPress, pos, Qt.LeftButton, Qt.LeftButton)
+    def drag():
+        for i in range(1, moves + 1):
+            sendMouse(viewport, QEvent.MouseMove, pos + QPoint(i*3, i*2), Qt.NoButton, Qt.LeftButton)
+            app.processEvents()
+    dragTime, _ = timed(drag)
+    sendMouse(viewport, QEvent.MouseButtonRelease, pos + QPoint(moves*3, moves*2), Qt.LeftButton, Qt.NoButton)
+    scene.clearSelection()
+    app.processEvents()
+
+    image = QImage(1280, 800, QImage.Format_ARGB32_Premultiplied)
+    painter = QPainter(image)
+    painter.setRenderHint(QPainter.Antialiasing)
+    option = QStyleOptionGraphicsItem()
+    def paintArrows():
+        for _ in range(frames):
+            for arrow in arrows:
+                arrow.paint(painter, option, None)
+    paintTime, _ = timed(paintArrows)
+    painter.end()
+
+    result = {'nodes': nodeCount, 'arrows': len(arrows), 'draggedNodes': len(selection), 'draggedArrows': draggedArrows,
+              'scene.insertItem': insertTime, 'scene.insertItems': bulkTime, 'scene.addArrows': arrowTime,
+              'scene.drag': dragTime/moves, 'arrow.paint': paintTime/frames}
+
+    view.centerOn(scene.itemsBoundingRect().center())
+    for zoomScale in zoomLevels:
+        view.setZoomScale(zoomScale)
+        app.processEvents()
+        renderTime, _ = timed(lambda: [viewport.grab() for _ in range(frames)])
+        result['view.render{}'.format(zoomScale)] = renderTime/frames
+
+    for item in items[:nodeCount//2]:
+        item.setSelected(True)
+    result['scene.deleteItems'], _ = timed(window.deleteItem)
+
+    # a stack of overlapping nodes, each raised or lowered past all the others
+    scene.clearDiagram()
+    stack = scene.insertItems([(DiagramItem.DiagramType.Step, QPointF(i*2., i*2.)) for i in range(overlapCount)])
+    def restack(slot, step):
+        for item in stack[::step]:
+            scene.clearSelection()
+            item.setSelected(True)
+            slot()
+    step = max(1, overlapCount//100)
+    frontTime, _ = timed(lambda: restack(window.bringToFront, step))
+    backTime, _ = timed(lambda: restack(window.sendToBack, step))
+    result['zorder.overlaps'] = overlapCount
+    result['zorder.front'] = frontTime/len(stack[::step])
+    result['zorder.back'] = backTime/len(stack[::step])
+
+    window.close()
+    window.deleteLater()
+    app.processEvents()
+    return result
+
+
+def isTiming(key, value):
+    return '.' in key and isinstance(value, float)
+
+
+def bestOf(benchmark, nodeCount, repeat):
+    # the fastest run is the one least disturbed by the rest of the machine
+    best = benchmark(nodeCount)
+    for _ in range(repeat - 1):
+        for key, value in benchmark(nodeCount).items():
+            if isTiming(key, value):
+                best[key] = min(best[key], value)
+    return best
+
+
+def printResult(result):
+    nodeCount = result['nodes']
+    if 'bytes' in result:
+        print('{} nodes, {} arrows, {:.1f} MB json, {:.1f} MB binary'.format(
+                nodeCount, result['arrows'], result['bytes']/1e6, result['binaryBytes']/1e6))
+    elif 'draggedNodes' in result:
+        print('{} nodes, {} arrows, dragging {} nodes with {} arrows, {} overlapping'.format(
+                nodeCount, result['arrows'], result['draggedNodes'], result['draggedArrows'], result['zorder.overlaps']))
+    else:
+        print('{} nodes, {} arrows'.format(nodeCount, result['arrows']))
+    for key, value in result.items():
+        if key.startswith(('save.', 'load.', 'open.', 'layout.')):
+            print('  {:<14}{:>9.3f} s {:>12.0f} nodes/s'.format(key, value, nodeCount/value if value > 0 else 0))
+        elif isTiming(key, value):
+            # per call, per move or per frame
+            print('  {:<18}{:>9.3f} ms'.format(key, value*1000))
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def saveResults(fileName, suite, results):
+    with open(fileName, 'w') as f:
+        json.dump({'suite': suite, 'revision': revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'python': platform.python_version(), 'qt': QT_VERSION_STR, 'pyqt': PYQT_VERSION_STR,
+                   'platform': platform.platform(), 'results': results}, f, indent=1)
+
+
+def compareResults(baseline, results, threshold):
+    # timings slower than the baseline by more than threshold count as regressions
+    baselineResults = {result['nodes']: result for result in baseline['results']}
+    print('compared with {} ({})'.format(baseline.get('revision') or 'baseline', baseline.get('time', '')))
+    regressions = 0
+    for result in results:
+        old = baselineResults.get(result['nodes'])
+        if old is None:
+            continue
+        print('{} nodes'.format(result['nodes']))
+        for key, value in result.items():
+            if not isTiming(key, value) or not isinstance(old.get(key), float) or old[key] <= 0:
+                continue
+            change = value/old[key] - 1
+            regressed = change > threshold
+            regressions += regressed
+            print('  {:<18}{:>+8.1%}{}'.format(key, change, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark diagram save and load throughput.')
+    parser.add_argument('sizes', nargs='*', type=int, help='node counts to benchmark')
+    suites = parser.add_mutually_exclusive_group()
+    suites.add_argument('--layout', action='store_true', help='benchmark the auto layout instead')
+    suites.add_argument('--scene', action='store_true',
+                        help='benchmark interactive scene operations (insert, drag, delete, paint, zoom, z-order) instead')
+    parser.add_argument('--output', metavar='FILE', help='write the results to a JSON file')
+    parser.add_argument('--compare', metavar='FILE', help='compare with the results in a JSON file written by --output')
+    parser.add_argument('--repeat', type=int, default=1, help='run every size this many times and keep the best timings')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as a regression by --compare (default 0.1)')
+    args = parser.parse_args(argv)
+    if args.layout and diagramlayout is None:
+        parser.error('--layout needs NumPy')
+
+    if args.scene:
+        suite, benchmark, sizes = 'scene', benchmarkScene, [500, 2000, 5000]
+    elif args.layout:
+        suite, benchmark, sizes = 'layout', benchmarkLayout, [1000, 10000, 50000]
+    else:
+        suite, benchmark, sizes = 'document', benchmarkDocument, [1000, 10000, 50000]
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('suite') != suite:
+            parser.error('{} holds {} results, not {}'.format(args.compare, baseline.get('suite'), suite))
+
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    results = []
+    for nodeCount in args.sizes or sizes:
+        results.append(bestOf(benchmark, nodeCount, max(1, args.repeat)))
+        printResult(results[-1])
+    if args.output:
+        saveResults(args.output, suite, results)
+    if baseline is not None and compareResults(baseline, results, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
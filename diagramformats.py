@@ -0,0 +1,365 @@
+import csv
+import io
+import os
+import re
+import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+# Streaming readers and writers for graphs exchanged with other tools. The
+# readers yield records as they parse, so a caller never needs the whole
+# parsed graph:
+#   ('node', key, label, shape, pos, explicit)
+#   ('edge', source, target)
+# label, shape and pos ((x, y) or None) are None when the file does not say.
+# Nodes only mentioned by an edge are yielded with explicit False before it,
+# an explicit record for an already seen key updates it.
+# The writers take nodes as (key, label, shape, x, y) and edges as
+# (source, target) iterables and write them out as they come.
+
+GRAPH_FORMATS = {'.csv': 'csv', '.dot': 'dot', '.gv': 'dot', '.graphml': 'graphml'}
+GRAPH_FILE_FILTER = 'Graph files (*.csv *.dot *.gv *.graphml);;CSV edge lists (*.csv);;DOT graphs (*.dot *.gv);;GraphML (*.graphml)'
+
+
+def graphFormat(fileName):
+    format = GRAPH_FORMATS.get(os.path.splitext(fileName)[1].lower())
+    if format is None:
+        raise ValueError('{} is not a CSV, DOT or GraphML file'.format(os.path.basename(fileName)))
+    return format
+
+
+def readGraph(fileName, raw):
+    # raw is the file opened in binary mode; its position tells how far the parse got
+    format = graphFormat(fileName)
+    if format == 'graphml':
+        return readGraphml(raw)
+    text = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+    return readCsv(text) if format == 'csv' else readDot(text)
+
+
+def writeGraph(fileName, nodes, edges):
+    format = graphFormat(fileName)
+    with open(fileName, 'w', encoding='utf-8', newline='') as f:
+        if format == 'csv':
+            writeCsv(f, nodes, edges)
+        elif format == 'dot':
+            writeDot(f, nodes, edges)
+        else:
+            writeGraphml(f, nodes, edges)
+
+
+# CSV: one edge per row, source,target; a header row may name the columns and
+# add source_shape and target_shape, a row without a target is a lone node
+
+def readCsv(f):
+    rows = csv.reader(f)
+    columns = None
+    try:
+        for row in rows:
+            if not row or not any(row):
+                continue
+            if columns is None:
+                names = [name.strip().lower() for name in row]
+                if 'source' in names and 'target' in names:
+                    columns = [names.index(name) if name in names else None
+                                for name in ('source', 'target', 'source_shape', 'target_shape')]
+                    continue
+                columns = [0, 1, None, None]
+            source, target, sourceShape, targetShape = (row[column].strip() if column is not None and column < len(row) else ''
+                                                        for column in columns)
+            if source:
+                yield ('node', source, None, sourceShape or None, None, bool(sourceShape))
+            if target:
+                yield ('node', target, None, targetShape or None, None, bool(targetShape))
+                if source:
+                    yield ('edge', source, target)
+    except csv.Error as e:
+        raise ValueError('CSV line {}: {}'.format(rows.line_num, e))
+
+
+def writeCsv(f, nodes, edges):
+    writer = csv.writer(f)
+    writer.writerow(['source', 'target', 'source_shape', 'target_shape'])
+    shapes = {}
+    for key, label, shape, x, y in nodes:
+        shapes[key] = shape
+    connected = set()
+    for source, target in edges:
+        writer.writerow([source, target, shapes[source], shapes[target]])
+        connected.add(source)
+        connected.add(target)
+    for key, shape in shapes.items():
+        if key not in connected:
+            writer.writerow([key, '', shape, ''])
+
+
+# DOT: a streaming tokenizer and a parser for node, edge and attribute
+# statements; subgraphs are flattened, edges to whole subgraphs are not supported
+
+DotToken = re.compile(r'''
+    (?P<space>\s+|//[^\n]*|\#[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<html><[^<>]*(?:<[^<>]*>[^<>]*)*>)
+  | (?P<id>[A-Za-z_\x80-\uffff][\w\x80-\uffff]*|-?(?:\.[0-9]+|[0-9]+(?:\.[0-9]*)?))
+  | (?P<op>->|--|[{}\[\]=;,:])
+    ''', re.VERBOSE | re.DOTALL)
+
+
+def dotTokens(f, chunkSize=1 << 16):
+    # yields ('id' | 'string' | 'op', text); a token at the end of the buffer
+    # may continue in the next chunk, so it is only taken once more is read
+    buffer = ''
+    position = 0
+    eof = False
+    while True:
+        match = DotToken.match(buffer, position)
+        if match is None or (match.end() == len(buffer) and not eof):
+            if eof:
+                if position < len(buffer):
+                    raise ValueError('unexpected {!r} in DOT input'.format(buffer[position:position + 20]))
+                return
+            chunk = f.read(chunkSize)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        position = match.end()
+        kind = match.lastgroup
+        if kind == 'space':
+            continue
+        text = match.group()
+        if kind == 'string':
+            yield 'string', text[1:-1].replace('\\"', '"').replace('\\\r\n', '').replace('\\\n', '')
+        elif kind == 'html':
+            # only the text of an HTML-like label is kept
+            yield 'string', re.sub(r'<[^<>]*>', '', text[1:-1])
+        else:
+            yield kind, text
+
+
+def dotLabel(label, key):
+    if label is None:
+        return None
+    label = label.replace('\\N', key)
+    for sequence in ('\\n', '\\l', '\\r'):
+        label = label.replace(sequence, '\n')
+    return label.rstrip('\n')
+
+
+def dotPos(pos):
+    # "x,y" in points with y pointing up, optionally pinned with a trailing !
+    if pos is None:
+        return None
+    try:
+        x, y = pos.rstrip('!').split(',')[:2]
+        return float(x), -float(y)
+    except ValueError:
+        return None
+
+
+def readDot(f):
+    tokens = dotTokens(f)
+    lookahead = []
+
+    def peek():
+        if not lookahead:
+            lookahead.append(next(tokens, (None, None)))
+        return lookahead[0]
+
+    def take():
+        token = peek()
+        lookahead.pop()
+        return token
+
+    def skipPorts():
+        while peek() == ('op', ':'):
+            take()
+            take()
+
+    def attributes():
+        result = {}
+        while peek() == ('op', '['):
+            take()
+            while True:
+                kind, text = take()
+                if kind is None:
+                    raise ValueError('unterminated attribute list in DOT input')
+                if kind == 'op':
+                    if text == ']':
+                        break
+                    continue
+                if peek() == ('op', '='):
+                    take()
+                    result[text.lower()] = take()[1]
+                else:
+                    result[text.lower()] = 'true'
+        return result
+
+    # [strict] (graph | digraph) [ID] {
+    while True:
+        kind, text = take()
+        if kind is None:
+            return
+        if (kind, text) == ('op', '{'):
+            break
+
+    # node defaults of every open subgraph
+    defaults = [{}]
+    while defaults:
+        kind, text = take()
+        if kind is None:
+            raise ValueError('unexpected end of DOT input')
+        if kind == 'op':
+            if text == '{':
+                defaults.append(dict(defaults[-1]))
+            elif text == '}':
+                defaults.pop()
+            elif text not in ';,':
+                raise ValueError('unexpected {!r} in DOT input'.format(text))
+            continue
+
+        keyword = text.lower() if kind == 'id' else None
+        if keyword == 'subgraph':
+            if peek()[0] in ('id', 'string'):
+                take()
+            continue
+        if keyword in ('graph', 'node', 'edge') and peek() == ('op', '['):
+            statementAttributes = attributes()
+            if keyword == 'node':
+                defaults[-1].update(statementAttributes)
+            continue
+        if peek() == ('op', '='):
+            take()
+            take()
+            continue
+
+        chain = [text]
+        skipPorts()
+        while peek() in (('op', '->'), ('op', '--')):
+            take()
+            kind, text = take()
+            if kind not in ('id', 'string'):
+                raise ValueError('edges to subgraphs are not supported in DOT input')
+            chain.append(text)
+            skipPorts()
+        nodeAttributes = dict(defaults[-1])
+        statementAttributes = attributes()
+        if len(chain) == 1:
+            nodeAttributes.update(statementAttributes)
+            key = chain[0]
+            yield ('node', key, dotLabel(nodeAttributes.get('label'), key), nodeAttributes.get('shape'),
+                    dotPos(nodeAttributes.get('pos')), True)
+        else:
+            for key in chain:
+                yield ('node', key, dotLabel(nodeAttributes.get('label'), key), nodeAttributes.get('shape'), None, False)
+            for source, target in zip(chain, chain[1:]):
+                yield ('edge', source, target)
+
+
+def dotQuote(text):
+    return '"' + text.replace('"', '\\"').replace('\n', '\\n') + '"'
+
+
+def writeDot(f, nodes, edges):
+    f.write('digraph G {\n')
+    for key, label, shape, x, y in nodes:
+        attributes = ['shape={}'.format(shape), 'pos="{:g},{:g}"'.format(x, -y)]
+        if label != key:
+            attributes.insert(0, 'label={}'.format(dotQuote(label)))
+        f.write('  {} [{}];\n'.format(dotQuote(key), ', '.join(attributes)))
+    for source, target in edges:
+        f.write('  {} -> {};\n'.format(dotQuote(source), dotQuote(target)))
+    f.write('}\n')
+
+
+# GraphML: parsed incrementally with iterparse, every node and edge element is
+# dropped from the tree once read. Labels, shapes and positions come from
+# data elements named label/name, shape/kind/type and x/y, or from yEd's
+# NodeLabel, Shape and Geometry elements
+
+def localName(tag):
+    return tag.rpartition('}')[2]
+
+
+def graphmlNode(element, keys):
+    label = shape = x = y = None
+    for child in element.iter():
+        tag = localName(child.tag)
+        if tag == 'data':
+            name = keys.get(child.get('key'), '')
+            text = (child.text or '').strip()
+            if not text:
+                continue
+            if name in ('label', 'name') and label is None:
+                label = text
+            elif name in ('shape', 'kind', 'type'):
+                shape = text
+            elif name in ('x', 'y'):
+                try:
+                    value = float(text)
+                except ValueError:
+                    continue
+                if name == 'x':
+                    x = value
+                else:
+                    y = value
+        elif tag == 'NodeLabel' and label is None:
+            label = ''.join(child.itertext()).strip() or None
+        elif tag == 'Shape':
+            shape = child.get('type') or shape
+        elif tag == 'Geometry':
+            try:
+                # yEd geometry is the top left corner
+                x = float(child.get('x', 0)) + float(child.get('width', 0))/2
+                y = float(child.get('y', 0)) + float(child.get('height', 0))/2
+            except ValueError:
+                pass
+    pos = (x, y) if x is not None and y is not None else None
+    return ('node', element.get('id'), label, shape, pos, True)
+
+
+def readGraphml(f):
+    keys = {}
+    parents = []
+    try:
+        for event, element in ElementTree.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                parents.append(element)
+                continue
+            parents.pop()
+            tag = localName(element.tag)
+            if tag == 'key':
+                keys[element.get('id')] = (element.get('attr.name') or element.get('id') or '').lower()
+            elif tag == 'node':
+                record = graphmlNode(element, keys)
+                if record[1] is not None:
+                    yield record
+            elif tag == 'edge':
+                source = element.get('source')
+                target = element.get('target')
+                if source is not None and target is not None:
+                    yield ('node', source, None, None, None, False)
+                    yield ('node', target, None, None, None, False)
+                    yield ('edge', source, target)
+            else:
+                continue
+            if parents:
+                parents[-1].remove(element)
+    except ElementTree.ParseError as e:
+        raise ValueError('GraphML: {}'.format(e))
+
+
+def writeGraphml(f, nodes, edges):
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+            '  <key id="label" for="node" attr.name="label" attr.type="string"/>\n'
+            '  <key id="shape" for="node" attr.name="shape" attr.type="string"/>\n'
+            '  <key id="x" for="node" attr.name="x" attr.type="double"/>\n'
+            '  <key id="y" for="node" attr.name="y" attr.type="double"/>\n'
+            '  <graph edgedefault="directed">\n')
+    for key, label, shape, x, y in nodes:
+        f.write('    <node id={}><data key="label">{}</data><data key="shape">{}</data>'
+                '<data key="x">{:g}</data><data key="y">{:g}</data></node>\n'.format(
+                    quoteattr(key), escape(label), escape(shape), x, y))
+    for source, target in edges:
+        f.write('    <edge source={} target={}/>\n'.format(quoteattr(source), quoteattr(target)))
+    f.write('  </graph>\n</graphml>\n')
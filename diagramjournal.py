@@ -0,0 +1,242 @@
+import json
+import os
+import time
+
+# An append-only journal of scene operations, one JSON object per line, and
+# a snapshot the journal is periodically compacted into. Items are named by
+# the scene's undo ids and styles by the palette ids of the writing session,
+# which a 'styles' operation defines before they are used:
+#   {'op': 'styles', 'styles': [[id, argb, font or None], ...]}
+#   {'op': 'reset' | 'insert', <DiagramItemRecords columns>}
+#   {'op': 'remove', 'ids': [...]}
+#   {'op': 'translate', 'ids': [...], 'dx': dx, 'dy': dy}
+#   {'op': 'move', 'ids': [...], 'xs': [...], 'ys': [...]}
+#   {'op': 'style', 'ids': [...], 'styleIds': [...]}
+#   {'op': 'text', 'id': id, 'text': text}
+#   {'op': 'zorder', 'ids': [...], 'zs': [...]}
+# The ids of the nodes, labels and arrows of a virtual diagram come from
+# their DiagramModel ids, so items released from the view are covered too.
+# Every written operation carries a sequence number; the snapshot records the
+# last one it contains, so a crash between writing a snapshot and truncating
+# the journal replays nothing twice.
+
+JOURNAL_FILE = 'autosave.journal'
+SNAPSHOT_FILE = 'autosave.snapshot'
+SNAPSHOT_FORMAT = 'diagramjournal'
+
+
+def encodeValue(value):
+    # arrays of the operations are written as lists
+    return value.tolist()
+
+
+class JournalState:
+    # the diagram as the journal describes it, kept in plain dicts
+    def __init__(self):
+        self.seq = 0
+        self.styles = {}
+        # node id: [type, x, y, z, styleId, name]
+        self.nodes = {}
+        # text id: [owner id or -1, x, y, z, styleId, text], labels included
+        self.texts = {}
+        # node id: label id
+        self.labels = {}
+        # arrow id: [start id, end id, styleId]
+        self.arrows = {}
+
+    def isEmpty(self):
+        return not self.nodes and not self.texts
+
+    def apply(self, op):
+        kind = op['op']
+        if kind == 'styles':
+            for styleId, argb, font in op['styles']:
+                self.styles[styleId] = (argb, font)
+        elif kind == 'reset':
+            self.nodes = {}
+            self.texts = {}
+            self.labels = {}
+            self.arrows = {}
+            self.insert(op)
+        elif kind == 'insert':
+            self.insert(op)
+        elif kind == 'remove':
+            for itemId in op['ids']:
+                self.remove(itemId)
+        elif kind == 'translate':
+            dx = op['dx']
+            dy = op['dy']
+            for itemId in op['ids']:
+                values = self.nodes.get(itemId) or self.texts.get(itemId)
+                if values is not None:
+                    values[1] += dx
+                    values[2] += dy
+        elif kind == 'move':
+            for itemId, x, y in zip(op['ids'], op['xs'], op['ys']):
+                values = self.nodes.get(itemId) or self.texts.get(itemId)
+                if values is not None:
+                    values[1] = x
+                    values[2] = y
+        elif kind == 'style':
+            for itemId, styleId in zip(op['ids'], op['styleIds']):
+                values = self.nodes.get(itemId) or self.texts.get(itemId)
+                if values is not None:
+                    values[4] = styleId
+                elif itemId in self.arrows:
+                    self.arrows[itemId][2] = styleId
+        elif kind == 'text':
+            values = self.texts.get(op['id'])
+            if values is not None:
+                values[5] = op['text']
+                if values[0] in self.nodes:
+                    self.nodes[values[0]][5] = op['text']
+        elif kind == 'zorder':
+            for itemId, z in zip(op['ids'], op['zs']):
+                values = self.nodes.get(itemId) or self.texts.get(itemId)
+                if values is not None:
+                    values[3] = z
+        else:
+            raise ValueError('unknown journal operation {!r}'.format(kind))
+
+    def insert(self, op):
+        names = op['names']
+        for i, nodeId in enumerate(op['nodeIds']):
+            self.nodes[nodeId] = [op['types'][i], op['xs'][i], op['ys'][i], op['zs'][i], op['styleIds'][i], names[i]]
+            labelId = op['labelIds'][i]
+            if labelId >= 0:
+                self.texts[labelId] = [nodeId, op['labelXs'][i], op['labelYs'][i], 0., op['labelStyleIds'][i], names[i]]
+                self.labels[nodeId] = labelId
+        for i, textId in enumerate(op['textIds']):
+            ownerId = op['textOwnerIds'][i]
+            self.texts[textId] = [ownerId, op['textXs'][i], op['textYs'][i], op['textZs'][i], op['textStyleIds'][i], op['texts'][i]]
+            if ownerId >= 0:
+                self.labels[ownerId] = textId
+        for arrowId, startId, endId, styleId in zip(op['arrowIds'], op['startIds'], op['endIds'], op['arrowStyleIds']):
+            self.arrows[arrowId] = [startId, endId, styleId]
+
+    def remove(self, itemId):
+        if itemId in self.nodes:
+            del self.nodes[itemId]
+            labelId = self.labels.pop(itemId, None)
+            if labelId is not None:
+                self.texts.pop(labelId, None)
+        elif itemId in self.texts:
+            ownerId = self.texts.pop(itemId)[0]
+            if self.labels.get(ownerId) == itemId:
+                del self.labels[ownerId]
+        else:
+            self.arrows.pop(itemId, None)
+
+    def snapshot(self):
+        # arrows whose ends are gone are left out
+        nodes = self.nodes
+        return {'format': SNAPSHOT_FORMAT, 'seq': self.seq,
+                'styles': [[styleId, argb, font] for styleId, (argb, font) in self.styles.items()],
+                'nodes': [[nodeId] + values for nodeId, values in nodes.items()],
+                'texts': [[textId] + values for textId, values in self.texts.items()],
+                'arrows': [[arrowId] + values for arrowId, values in self.arrows.items()
+                            if values[0] in nodes and values[1] in nodes]}
+
+    @classmethod
+    def fromSnapshot(cls, snapshot):
+        if snapshot.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError('not a diagram journal snapshot')
+        state = cls()
+        state.seq = snapshot['seq']
+        state.styles = {styleId: (argb, font) for styleId, argb, font in snapshot['styles']}
+        state.nodes = {values[0]: values[1:] for values in snapshot['nodes']}
+        state.texts = {values[0]: values[1:] for values in snapshot['texts']}
+        state.labels = {values[1]: values[0] for values in snapshot['texts'] if values[1] >= 0}
+        state.arrows = {values[0]: values[1:] for values in snapshot['arrows']}
+        return state
+
+
+def recoverJournal(directory):
+    # the state a crashed session left behind, None when there is none; a
+    # torn last line from a crash mid-write ends the replay
+    snapshotName = os.path.join(directory, SNAPSHOT_FILE)
+    journalName = os.path.join(directory, JOURNAL_FILE)
+    if not os.path.exists(snapshotName) and not os.path.exists(journalName):
+        return None
+    state = JournalState()
+    if os.path.exists(snapshotName):
+        with open(snapshotName, encoding='utf-8') as f:
+            state = JournalState.fromSnapshot(json.load(f))
+    if os.path.exists(journalName):
+        with open(journalName, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    break
+                if op['seq'] <= state.seq:
+                    continue
+                state.apply(op)
+                state.seq = op['seq']
+    return state
+
+
+class Journal:
+    # the files of one session; only used from the writer thread
+    CompactSize = 8 << 20
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.journalName = os.path.join(directory, JOURNAL_FILE)
+        self.snapshotName = os.path.join(directory, SNAPSHOT_FILE)
+        self.state = JournalState()
+        self.file = None
+        self.size = 0
+        self.synced = True
+        self.lastSync = time.monotonic()
+
+    def open(self):
+        # a new session starts from an empty journal, the scene resets it first thing
+        self.file = open(self.journalName, 'w', encoding='utf-8', newline='\n')
+        self.size = 0
+
+    def append(self, ops):
+        state = self.state
+        for op in ops:
+            state.seq += 1
+            op['seq'] = state.seq
+            state.apply(op)
+        # a reset makes everything before it moot, it goes straight into a snapshot
+        if any(op['op'] == 'reset' for op in ops):
+            self.compact()
+            return
+        # one write for the whole batch
+        text = ''.join(json.dumps(op, default=encodeValue, separators=(',', ':')) + '\n' for op in ops)
+        self.file.write(text)
+        self.file.flush()
+        self.size += len(text)
+        self.synced = False
+        if self.size > self.CompactSize:
+            self.compact()
+
+    def sync(self):
+        if not self.synced:
+            os.fsync(self.file.fileno())
+            self.synced = True
+        self.lastSync = time.monotonic()
+
+    def compact(self):
+        # the snapshot replaces the old one atomically, then the journal starts over
+        temporaryName = self.snapshotName + '.tmp'
+        with open(temporaryName, 'w', encoding='utf-8') as f:
+            json.dump(self.state.snapshot(), f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporaryName, self.snapshotName)
+        self.file.close()
+        self.open()
+        self.sync()
+
+    def close(self, discard=False):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if discard:
+            for fileName in (self.journalName, self.snapshotName):
+                if os.path.exists(fileName):
+                    os.remove(fileName)
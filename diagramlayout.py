@@ -0,0 +1,247 @@
+import numpy as np
+
+# Layered (Sugiyama-style) layout on plain arrays, so it can run off the GUI
+# thread: nodes are 0..n-1 with a width and height, edges are (start, end)
+# index arrays and the result is the centre of every node.
+
+
+def csr(keys, count):
+    # edge ids grouped by key, with offsets[k]:offsets[k+1] the slice of key k
+    order = np.argsort(keys, kind='stable')
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=count), out=offsets[1:])
+    return order, offsets
+
+
+def concatRanges(starts, lengths):
+    # [starts[0], starts[0]+1, ..., starts[1], starts[1]+1, ...] without a Python loop
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+
+
+def groupedCummax(values, groups):
+    # running maximum that restarts at every group of a group-sorted array
+    if values.size == 0:
+        return values
+    low = values.min()
+    span = values.max() - low + 1.
+    shifted = values - low + groups*span
+    return np.maximum.accumulate(shifted) - groups*span + low
+
+
+def groupedReverseCummin(values, groups):
+    if values.size == 0:
+        return values
+    low = values.min()
+    span = values.max() - low + 1.
+    shifted = values - low + groups*span
+    return np.minimum.accumulate(shifted[::-1])[::-1] - groups*span + low
+
+
+def backEdges(nodeCount, starts, ends):
+    # depth-first search from the sources; edges closing a cycle are the ones to reverse
+    order, offsets = csr(starts, nodeCount)
+    targets = ends[order].tolist()
+    edgeIds = order.tolist()
+    offsets = offsets.tolist()
+    indegree = np.bincount(ends, minlength=nodeCount)
+    roots = np.argsort(indegree > 0, kind='stable').tolist()
+    state = [0]*nodeCount
+    reverse = np.zeros(len(starts), dtype=bool)
+    for root in roots:
+        if state[root]:
+            continue
+        state[root] = 1
+        stack = [[root, offsets[root]]]
+        while stack:
+            top = stack[-1]
+            node, i = top
+            if i == offsets[node + 1]:
+                state[node] = 2
+                stack.pop()
+                continue
+            top[1] = i + 1
+            target = targets[i]
+            if state[target] == 1:
+                reverse[edgeIds[i]] = True
+            elif state[target] == 0:
+                state[target] = 1
+                stack.append([target, offsets[target]])
+    return reverse
+
+
+def longestPathLayers(nodeCount, starts, ends):
+    # peel the DAG frontier by frontier; a node's layer is its longest path from a source
+    order, offsets = csr(starts, nodeCount)
+    sortedEnds = ends[order]
+    indegree = np.bincount(ends, minlength=nodeCount)
+    layers = np.zeros(nodeCount, dtype=np.int64)
+    frontier = np.flatnonzero(indegree == 0)
+    layer = 0
+    while frontier.size:
+        layers[frontier] = layer
+        targets = sortedEnds[concatRanges(offsets[frontier], offsets[frontier + 1] - offsets[frontier])]
+        targets, counts = np.unique(targets, return_counts=True)
+        indegree[targets] -= counts
+        frontier = targets[indegree[targets] == 0]
+        layer += 1
+    return layers
+
+
+def assignLayers(nodeCount, starts, ends, pinFirst, pinLast):
+    layers = longestPathLayers(nodeCount, starts, ends)
+    indegree = np.bincount(ends, minlength=nodeCount)
+    outdegree = np.bincount(starts, minlength=nodeCount)
+
+    # sources other than start terminals sit just above their first successor
+    # instead of all crowding into the top layer
+    nearest = np.full(nodeCount, np.iinfo(np.int64).max)
+    np.minimum.at(nearest, starts, layers[ends])
+    pulled = (indegree == 0) & (outdegree > 0) & ~pinFirst
+    layers[pulled] = nearest[pulled] - 1
+
+    # end terminals without successors go to a layer of their own at the bottom
+    sinks = pinLast & (outdegree == 0) & (indegree > 0)
+    if sinks.any() and not sinks.all():
+        layers[sinks] = layers[~sinks].max() + 1
+
+    return np.unique(layers, return_inverse=True)[1].reshape(-1)
+
+
+def insertDummies(nodeCount, starts, ends, layers, maxSpan):
+    # split edges spanning several layers into chains of one-layer segments;
+    # edges longer than maxSpan are left out, on dense graphs their chains
+    # would outnumber the real nodes many times over
+    span = layers[ends] - layers[starts]
+    keep = span <= maxSpan
+    starts = starts[keep]
+    ends = ends[keep]
+    span = span[keep]
+    long = span > 1
+    counts = span[long] - 1
+    dummyCount = int(counts.sum())
+    firstDummy = nodeCount + np.cumsum(counts) - counts
+    dummyLayers = np.repeat(layers[starts[long]], counts) + \
+                    np.arange(dummyCount) - np.repeat(firstDummy - nodeCount, counts) + 1
+    chainEnd = np.zeros(dummyCount, dtype=bool)
+    chainEnd[firstDummy + counts - 1 - nodeCount] = True
+    dummies = np.arange(nodeCount, nodeCount + dummyCount)
+
+    segmentStarts = np.concatenate([starts[~long], starts[long], dummies[~chainEnd], dummies[chainEnd]])
+    segmentEnds = np.concatenate([ends[~long], firstDummy, dummies[~chainEnd] + 1, ends[long]])
+    dummyOwners = np.repeat(starts[long], counts)
+    return np.concatenate([layers, dummyLayers]), segmentStarts, segmentEnds, dummyOwners
+
+
+def orderLayers(layers, segmentStarts, segmentEnds, initialKeys, sweeps):
+    # barycenter sweeps: each layer is sorted by the mean position of its
+    # neighbours in the layer above (down) or below (up)
+    nodeCount = len(layers)
+    layerCount = int(layers.max()) + 1 if nodeCount else 0
+    byLayer = np.lexsort((initialKeys, layers))
+    layerOffsets = np.zeros(layerCount + 1, dtype=np.int64)
+    np.cumsum(np.bincount(layers, minlength=layerCount), out=layerOffsets[1:])
+    local = np.empty(nodeCount, dtype=np.int64)
+    local[byLayer] = np.arange(nodeCount) - np.repeat(layerOffsets[:-1], np.diff(layerOffsets))
+    position = local.astype(np.float64)
+    layerNodes = [byLayer[layerOffsets[i]:layerOffsets[i + 1]] for i in range(layerCount)]
+
+    downOrder, downOffsets = csr(layers[segmentEnds], layerCount)
+    upOrder, upOffsets = csr(layers[segmentStarts], layerCount)
+
+    def sweep(layer, order, offsets, ownEnds, otherEnds):
+        nodes = layerNodes[layer]
+        edges = order[offsets[layer]:offsets[layer + 1]]
+        if not edges.size:
+            return
+        slots = local[ownEnds[edges]]
+        sums = np.bincount(slots, weights=position[otherEnds[edges]], minlength=len(nodes))
+        counts = np.bincount(slots, minlength=len(nodes))
+        barycenters = np.where(counts > 0, sums/np.maximum(counts, 1), position[nodes])
+        nodes = nodes[np.argsort(barycenters, kind='stable')]
+        layerNodes[layer] = nodes
+        position[nodes] = np.arange(len(nodes))
+        local[nodes] = np.arange(len(nodes))
+
+    for _ in range(sweeps):
+        for layer in range(1, layerCount):
+            sweep(layer, downOrder, downOffsets, segmentEnds, segmentStarts)
+        for layer in range(layerCount - 2, -1, -1):
+            sweep(layer, upOrder, upOffsets, segmentStarts, segmentEnds)
+    return position
+
+
+def assignCoordinates(layers, position, widths, heights, segmentStarts, segmentEnds,
+                        layerGap, nodeGap, iterations):
+    nodeCount = len(layers)
+    layerCount = int(layers.max()) + 1 if nodeCount else 0
+
+    layerHeights = np.zeros(layerCount)
+    np.maximum.at(layerHeights, layers, heights)
+    layerTops = np.cumsum(layerHeights + layerGap) - layerHeights - layerGap
+    ys = layerTops[layers] + layerHeights[layers]/2
+
+    # sequence by (layer, position); o is the minimum distance of every node
+    # from the first one of its layer
+    sequence = np.lexsort((position, layers))
+    groups = layers[sequence]
+    sequenceWidths = widths[sequence]
+    first = np.ones(nodeCount, dtype=bool)
+    first[1:] = groups[1:] != groups[:-1]
+    separation = np.zeros(nodeCount)
+    separation[1:] = (sequenceWidths[1:] + sequenceWidths[:-1])/2 + nodeGap
+    separation[first] = 0.
+    total = np.cumsum(separation)
+    groupStart = np.maximum.accumulate(np.where(first, np.arange(nodeCount), 0))
+    offsets = total - total[groupStart]
+    layerSpans = np.zeros(layerCount)
+    np.maximum.at(layerSpans, groups, offsets)
+
+    xs = np.empty(nodeCount)
+    xs[sequence] = offsets - layerSpans[groups]/2
+
+    # pull every node towards the mean of its neighbours, then push overlapping
+    # neighbours apart in both directions and average, which keeps the order
+    neighbourCounts = np.bincount(segmentStarts, minlength=nodeCount) + np.bincount(segmentEnds, minlength=nodeCount)
+    connected = neighbourCounts > 0
+    for _ in range(iterations):
+        sums = np.bincount(segmentStarts, weights=xs[segmentEnds], minlength=nodeCount) + \
+                np.bincount(segmentEnds, weights=xs[segmentStarts], minlength=nodeCount)
+        targets = np.where(connected, sums/np.maximum(neighbourCounts, 1), xs)
+        relative = targets[sequence] - offsets
+        resolved = (groupedCummax(relative, groups) + groupedReverseCummin(relative, groups))/2
+        xs[sequence] = resolved + offsets
+    return xs, ys
+
+
+def layeredLayout(widths, heights, starts, ends, pinFirst=None, pinLast=None, initialXs=None,
+                    layerGap=80., nodeGap=40., dummyWidth=20., maxSpan=8, sweeps=4, iterations=12):
+    widths = np.asarray(widths, dtype=np.float64)
+    heights = np.asarray(heights, dtype=np.float64)
+    nodeCount = len(widths)
+    if nodeCount == 0:
+        return np.zeros(0), np.zeros(0)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    pinFirst = np.zeros(nodeCount, dtype=bool) if pinFirst is None else np.asarray(pinFirst, dtype=bool)
+    pinLast = np.zeros(nodeCount, dtype=bool) if pinLast is None else np.asarray(pinLast, dtype=bool)
+    initialXs = np.arange(nodeCount, dtype=np.float64) if initialXs is None else np.asarray(initialXs, dtype=np.float64)
+
+    loops = starts == ends
+    starts = starts[~loops]
+    ends = ends[~loops]
+    reverse = backEdges(nodeCount, starts, ends)
+    starts, ends = np.where(reverse, ends, starts), np.where(reverse, starts, ends)
+
+    layers = assignLayers(nodeCount, starts, ends, pinFirst, pinLast)
+    layers, segmentStarts, segmentEnds, dummyOwners = insertDummies(nodeCount, starts, ends, layers, maxSpan)
+    dummyCount = len(dummyOwners)
+    keys = np.concatenate([initialXs, initialXs[dummyOwners]])
+    position = orderLayers(layers, segmentStarts, segmentEnds, keys, sweeps)
+    xs, ys = assignCoordinates(layers, position,
+                                np.concatenate([widths, np.full(dummyCount, dummyWidth)]),
+                                np.concatenate([heights, np.zeros(dummyCount)]),
+                                segmentStarts, segmentEnds, layerGap, nodeGap, iterations)
+    return xs[:nodeCount], ys[:nodeCount]
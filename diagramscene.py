@@ -1,22 +1,54 @@
 import os
 import sys
-from PyQt5.QtCore import QMimeData, QRect, QSize, pyqtSignal, QLineF, Qt, QPointF, QRectF, QSizeF, pyqtSlot  
-from PyQt5.QtGui import QBrush, QColor, QDrag, QFont, QIcon, QIntValidator, QKeySequence, QPen, QPainterPath, QPainter, QPixmap, QPolygonF, QTransform
+from PyQt5.QtCore import QLockFile, QMarginsF, QMimeData, QObject, QRect, QStandardPaths, QSize, pyqtSignal, QLineF, Qt, QPointF, QRectF, QSizeF, QThread, QTimer, pyqtSlot  
+from PyQt5.QtGui import (QBrush, QColor, QDrag, QFont, QFontMetrics, QIcon, QImage, QIntValidator, QKeySequence, QPen, QPainterPath, QPainterPathStroker, QPainter, QPdfWriter, 
+                        QPixmap, QPolygonF, QTransform)
 from PyQt5.QtWidgets import (QAbstractButton, QAction, QApplication, QButtonGroup, QComboBox, QFontComboBox, QGraphicsItem, QGraphicsTextItem, 
                             QGraphicsLineItem, QGraphicsPolygonItem, QGraphicsScene, QGraphicsView, QGridLayout, QHBoxLayout, QLabel, QListWidget, 
-                            QListWidgetItem, QMainWindow, QMenu, QMessageBox, QSizePolicy, QToolBox, QToolButton, QVBoxLayout, QWidget)
+                            QListWidgetItem, QMainWindow, QMenu, QMessageBox, QFileDialog, QProgressDialog, QSizePolicy, QStyleOptionGraphicsItem, QToolBox, QToolButton, 
+                            QUndoCommand, QUndoStack, QVBoxLayout, QWidget)
 
+from array import array
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 
+import argparse
+import bisect
+import functools
+import heapq
+import itertools
+import json
 import math
+import mmap
+import multiprocessing
+import queue
+import struct
+import time
+
+import diagramformats
+import diagramjournal
+
+try:
+    import diagramlayout
+except ImportError:
+    # auto layout needs NumPy
+    diagramlayout = None
 
 DIR_NAME = os.path.dirname(__file__)
 InsertTextButton = 10
 
+BINARY_DIAGRAM_SUFFIX = '.dgmb'
+VIRTUAL_NODE_THRESHOLD = 5000
+DIAGRAM_FILE_FILTER = 'Diagram files (*.diagram);;Binary diagram files (*.dgmb)'
+
 COLORKEY = {'black': Qt.black, 'white': Qt.white, 'red': Qt.red, 'blue': Qt.blue, 'yellow': Qt.yellow}
 
 class DiagramItem(QGraphicsPolygonItem):
     Type = QGraphicsItem.UserType + 15
+    # below this level of detail the polygon is drawn as its bounding rectangle
+    SimpleShapeLod = 0.3
+    SelectionPen = QPen(Qt.black, 0, Qt.DashLine)
 
     class DiagramType(Enum):
         Step = 0
@@ -24,37 +56,29 @@ class DiagramItem(QGraphicsPolygonItem):
         StartEnd = 2 
         Io = 3
     
+    # flyweight geometry shared by every item and scene, see registerShape()
+    shapeBuilders = {}
+    shapeCache = {}
+    iconCache = {}
+
     def __init__(self, diagramType, contextMenu, parent=None):
         super().__init__(parent=parent)
 
-        path = QPainterPath()
-
-        self.myPolygon = QPolygonF()
-        self.arrows = []
+        self.myPolygon = self.shapePolygon(diagramType)
 
         self.myName = ''
 
+        self.textItem = None
+        self.modelId = None
+        self.undoId = None
+        self.myStyleId = 0
+
         self.widget = None
 
         self.myDiagramType = diagramType
 
         self.myContextMenu = contextMenu
 
-        if self.myDiagramType == self.DiagramType.StartEnd:
-            path.moveTo(200, 50)
-            path.arcTo(150, 0, 50, 50, 0, 90)
-            path.arcTo(50, 0, 50, 50, 90, 90)
-            path.arcTo(50, 50, 50, 50, 180, 90)
-            path.arcTo(150, 50, 50, 50, 270, 90)
-            path.lineTo(200, 25)
-            self.myPolygon = path.toFillPolygon()
-        elif self.myDiagramType == self.DiagramType.Conditional:
-            self.myPolygon << QPointF(-100, 0) << QPointF(0, 100) << QPointF(100, 0) << QPointF(0, -100) << QPointF(-100, 0)
-        elif self.myDiagramType == self.DiagramType.Step:
-            self.myPolygon << QPointF(-100, -100) << QPointF(100, -100) << QPointF(100, 100) << QPointF(-100, 100) << QPointF(-100, -100)
-        else:
-            self.myPolygon << QPointF(-120, -80) << QPointF(-70, 80) << QPointF(120, 80) << QPointF(70, -80) << QPointF(-120, -80)
-
         self.setPolygon(self.myPolygon)
         self.setFlag(QGraphicsItem.ItemIsMovable, True)
         self.setFlag(QGraphicsItem.ItemIsSelectable, True)
@@ -69,6 +93,13 @@ class DiagramItem(QGraphicsPolygonItem):
     def diagramType(self):
         return self.myDiagramType
 
+    def styleId(self):
+        return self.myStyleId
+
+    def setStyle(self, style):
+        self.myStyleId = style.id
+        self.setBrush(style.brush)
+
     def polygon(self):
         return self.myPolygon
 
@@ -81,43 +112,94 @@ class DiagramItem(QGraphicsPolygonItem):
     def getTextItem(self):
         return self.textItem
 
-    def removeArrow(self, arrow):
-        for arr in self.arrows:
-            if arr == arrow:
-                self.arrows.remove(arr)
-
-    def removeArrows(self):
-        # need a copy here since removeArrow() will
-        # modify the arrows container
-        arrowsCopy = self.arrows.copy()
-        for arr in arrowsCopy:
-            arr.startItem().removeArrow(arr)
-            arr.endItem().removeArrow(arr)
-            self.scene().removeItem(arr)
-
-    def addArrow(self, arrow):
-        self.arrows.append(arrow)
+    def paint(self, painter, option, widget):
+        DiagramMetrics.itemsPainted += 1
+        if option.levelOfDetailFromTransform(painter.worldTransform()) >= self.SimpleShapeLod:
+            super().paint(painter, option, widget)
+            return
 
-    def image(self):
+        painter.setPen(self.pen())
+        painter.setBrush(self.brush())
+        painter.drawRect(self.myPolygon.boundingRect())
+        if self.isSelected():
+            painter.setPen(self.SelectionPen)
+            painter.setBrush(Qt.NoBrush)
+            painter.drawRect(self.boundingRect())
+
+    def arrows(self):
+        # arrows are indexed by the scene's DiagramGraph, not kept per item
+        scene = self.scene()
+        if isinstance(scene, DiagramScene):
+            return scene.graph.incidentEdges(self)
+        return []
+
+    @classmethod
+    def registerShape(cls, diagramType, builder):
+        cls.shapeBuilders[diagramType] = builder
+        cls.shapeCache.pop(diagramType, None)
+        cls.iconCache.pop(diagramType, None)
+
+    @classmethod
+    def shapePolygon(cls, diagramType):
+        # QPolygonF is implicitly shared, so items hold references, not copies
+        polygon = cls.shapeCache.get(diagramType)
+        if polygon is None:
+            polygon = cls.shapeCache[diagramType] = cls.shapeBuilders[diagramType]()
+        return polygon
+
+    @classmethod
+    def shapeImage(cls, diagramType):
         pixmap = QPixmap(250, 250)
         pixmap.fill(Qt.transparent)
         painter = QPainter(pixmap)
         painter.setPen(QPen(Qt.black, 8))
         painter.translate(125, 125)
-        painter.drawPolyline(self.myPolygon)
+        painter.drawPolyline(cls.shapePolygon(diagramType))
         painter.end()
 
         return pixmap
 
+    @classmethod
+    def shapeIcon(cls, diagramType):
+        icon = cls.iconCache.get(diagramType)
+        if icon is None:
+            icon = cls.iconCache[diagramType] = QIcon(cls.shapeImage(diagramType))
+        return icon
+
+    def image(self):
+        return self.shapeIcon(self.myDiagramType).pixmap(250, 250)
+
     def contextMenuEvent(self, event):
         self.scene().clearSelection()
         self.setSelected(True)
         self.myContextMenu.exec_(event.screenPos())
 
     def itemChange(self, change, value):
-        if change == QGraphicsItem.ItemPositionChange:
-            for arr in self.arrows:
-                arr.updatePosition()
+        # arrows read the new position, so they are updated after the change
+        if change == QGraphicsItem.ItemPositionHasChanged or change == QGraphicsItem.ItemTransformHasChanged:
+            scene = self.scene()
+            if isinstance(scene, DiagramScene):
+                for arr in scene.graph.incidentEdges(self):
+                    scene.scheduleArrowUpdate(arr)
+                scene.noteNodeMoved(self)
+                scene.includeInSceneRect(self.sceneBoundingRect())
+                if scene.router is not None:
+                    scene.router.invalidateRect(self.sceneBoundingRect())
+        elif change == QGraphicsItem.ItemPositionChange:
+            # arrows routed around the old position may now have a shorter way
+            scene = self.scene()
+            if isinstance(scene, DiagramScene) and scene.router is not None:
+                scene.router.invalidateRect(self.sceneBoundingRect())
+        elif change == QGraphicsItem.ItemSceneHasChanged:
+            scene = self.scene()
+            if isinstance(scene, DiagramScene):
+                scene.includeInSceneRect(self.sceneBoundingRect())
+                if scene.router is not None:
+                    scene.router.invalidateRect(self.sceneBoundingRect())
+        elif change == QGraphicsItem.ItemZValueHasChanged:
+            scene = self.scene()
+            if isinstance(scene, DiagramScene):
+                scene.noteZValueChanged(self)
 
         return value
 
@@ -162,8 +244,95 @@ class DiagramItem(QGraphicsPolygonItem):
         super().mouseDoubleClickEvent(mouseEvent)
 
     
+def startEndPolygon():
+    path = QPainterPath()
+    path.moveTo(200, 50)
+    path.arcTo(150, 0, 50, 50, 0, 90)
+    path.arcTo(50, 0, 50, 50, 90, 90)
+    path.arcTo(50, 50, 50, 50, 180, 90)
+    path.arcTo(150, 50, 50, 50, 270, 90)
+    path.lineTo(200, 25)
+    return path.toFillPolygon()
+
+
+def conditionalPolygon():
+    return QPolygonF([QPointF(-100, 0), QPointF(0, 100), QPointF(100, 0), QPointF(0, -100), QPointF(-100, 0)])
+
+
+def stepPolygon():
+    return QPolygonF([QPointF(-100, -100), QPointF(100, -100), QPointF(100, 100), QPointF(-100, 100), QPointF(-100, -100)])
+
+
+def ioPolygon():
+    return QPolygonF([QPointF(-120, -80), QPointF(-70, 80), QPointF(120, 80), QPointF(70, -80), QPointF(-120, -80)])
+
+
+DiagramItem.registerShape(DiagramItem.DiagramType.StartEnd, startEndPolygon)
+DiagramItem.registerShape(DiagramItem.DiagramType.Conditional, conditionalPolygon)
+DiagramItem.registerShape(DiagramItem.DiagramType.Step, stepPolygon)
+DiagramItem.registerShape(DiagramItem.DiagramType.Io, ioPolygon)
+
+
+# one node for DiagramScene.insertItems(); an empty name gets an automatic label
+DiagramItemRecord = namedtuple('DiagramItemRecord', 
+                                ['diagramType', 'pos', 'name', 'color', 'zValue', 'font', 'textColor', 'labelPos'], 
+                                defaults=('', None, 0., None, None, None))
+
+# the look of an item, interned by StylePalette; treat as immutable, the pens,
+# brushes and fonts are shared by every item with the style
+DiagramStyle = namedtuple('DiagramStyle', ['id', 'color', 'pen', 'brush', 'selectionPen', 'font', 'boxColor'])
+
+
+class StylePalette:
+    # styles by id, interned by colour and font key; items keep the id
+    def __init__(self):
+        self.styles = []
+        self.ids = {}
+        self.fonts = {}
+        self.intern(QColor(Qt.black))
+
+    def __len__(self):
+        return len(self.styles)
+
+    def style(self, styleId):
+        return self.styles[styleId]
+
+    def intern(self, color, font=None):
+        color = QColor(color)
+        fontKey = None if font is None else font.key()
+        key = (color.rgba(), fontKey)
+        styleId = self.ids.get(key)
+        if styleId is None:
+            if font is not None:
+                font = self.fonts.setdefault(fontKey, QFont(font))
+            boxColor = QColor(color)
+            boxColor.setAlpha(64)
+            styleId = self.ids[key] = len(self.styles)
+            self.styles.append(DiagramStyle(styleId, color, QPen(color, 2, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin),
+                                            QBrush(color), QPen(color, 1, Qt.DashLine), font, boxColor))
+        return self.styles[styleId]
+
+
+# node shapes named by other graph tools, see diagramformats
+GRAPH_SHAPE_TYPES = {'box': DiagramItem.DiagramType.Step, 'rect': DiagramItem.DiagramType.Step,
+                     'rectangle': DiagramItem.DiagramType.Step, 'square': DiagramItem.DiagramType.Step,
+                     'process': DiagramItem.DiagramType.Step,
+                     'diamond': DiagramItem.DiagramType.Conditional, 'rhombus': DiagramItem.DiagramType.Conditional,
+                     'decision': DiagramItem.DiagramType.Conditional,
+                     'ellipse': DiagramItem.DiagramType.StartEnd, 'oval': DiagramItem.DiagramType.StartEnd,
+                     'circle': DiagramItem.DiagramType.StartEnd, 'terminator': DiagramItem.DiagramType.StartEnd,
+                     'roundrectangle': DiagramItem.DiagramType.StartEnd,
+                     'parallelogram': DiagramItem.DiagramType.Io, 'data': DiagramItem.DiagramType.Io}
+GRAPH_SHAPE_TYPES.update((diagramType.name.lower(), diagramType) for diagramType in DiagramItem.DiagramType)
+GRAPH_TYPE_SHAPES = {DiagramItem.DiagramType.Step: 'box', DiagramItem.DiagramType.Conditional: 'diamond',
+                     DiagramItem.DiagramType.StartEnd: 'ellipse', DiagramItem.DiagramType.Io: 'parallelogram'}
+# nodes drawn by other tools are about a third the size of ours
+GRAPH_POSITION_SCALE = 3.
+
+
 class Arrow(QGraphicsLineItem):
     Type = QGraphicsItem.UserType + 4
+    ArrowHeadLod = 0.4
     
     def __init__(self, startItem, endItem, parent=None):
         super().__init__(parent=parent)
@@ -172,16 +341,47 @@ class Arrow(QGraphicsLineItem):
         self.myEndItem = endItem
         
         self.arrowHead = QPolygonF()
-        self.myColor = QColor(Qt.black)
+        self.myStyleId = 0
+        self.undoId = None
+
+        # geometry is cached and only recomputed when an endpoint moves
+        self.myGeometryDirty = True
+        self.myItemsCollide = False
+        self.modelId = None
+        # orthogonal mode: bend points from the start centre to the end
+        # centre, and the drawn polyline clipped at the end item
+        self.myRoute = None
+        self.myPolyline = None
 
         self.setFlag(QGraphicsItem.ItemIsSelectable, True)
-        self.setPen(QPen(self.myColor, 2, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
+        self.setPen(DiagramScene.styles.style(0).pen)
+        self.myBoundingRect = self.lineBoundingRect(self.line())
 
     def type(self):
         return self.Type
 
-    def setColor(self, color):
-        self.myColor = color
+    def styleId(self):
+        return self.myStyleId
+
+    def setStyle(self, style):
+        # a colour change does not update the arrow, the caller repaints
+        self.myStyleId = style.id
+
+    def color(self):
+        return DiagramScene.styles.style(self.myStyleId).color
+
+    def setItems(self, startItem, endItem):
+        self.myStartItem = startItem
+        self.myEndItem = endItem
+        self.myRoute = None
+        self.invalidateGeometry()
+
+    def route(self):
+        return self.myRoute
+
+    def setRoute(self, route):
+        self.myRoute = route
+        self.updatePosition()
 
     def startItem(self):
         return self.myStartItem
@@ -190,66 +390,142 @@ class Arrow(QGraphicsLineItem):
         return self.myEndItem
 
     def boundingRect(self):
+        # queried for every item on every frame, so it is cached with the geometry
+        return self.myBoundingRect
+
+    def lineBoundingRect(self, line):
         extra = (self.pen().width() + 20) / 2.0
 
         return QRectF(
-                    self.line().p1(), 
-                    QSizeF(self.line().p2().x() - self.line().p1().x(),
-                    self.line().p2().y() - self.line().p1().y())
+                    line.p1(), 
+                    QSizeF(line.p2().x() - line.p1().x(),
+                    line.p2().y() - line.p1().y())
                     ).normalized().adjusted(-extra, -extra, extra, extra)
 
     def shape(self):
-        path = super().shape() #QGraphicsLineItem.shape(self)
+        if self.myPolyline is not None:
+            path = QPainterPath()
+            path.addPolygon(self.myPolyline)
+            stroker = QPainterPathStroker()
+            stroker.setWidth(self.pen().widthF() + 6)
+            path = stroker.createStroke(path)
+        else:
+            path = super().shape() #QGraphicsLineItem.shape(self)
         path.addPolygon(self.arrowHead)
         
         return path
 
+    def invalidateGeometry(self):
+        self.myGeometryDirty = True
+
+    def isGeometryDirty(self):
+        return self.myGeometryDirty
+
     def updatePosition(self):
-        line = QLineF(
-            self.mapFromItem(self.myStartItem, 0, 0), 
-            self.mapFromItem(self.myEndItem, 0, 0)            
-        )
-        self.setLine(line)
+        self.invalidateGeometry()
+        self.updateGeometry()
 
-    def paint(self, painter, option, widget):
-        if self.myStartItem.collidesWithItem(self.myEndItem):
+    def updateGeometry(self):
+        if not self.myGeometryDirty:
             return
-        
-        myPen = self.pen()
-        myPen.setColor(self.myColor)
+        self.myGeometryDirty = False
+
         arrowSize = 20
-        painter.setPen(myPen)
-        painter.setBrush(self.myColor)
+        startPos = self.myStartItem.pos()
+        endPos = self.myEndItem.pos()
+
+        self.myItemsCollide = self.myStartItem.collidesWithItem(self.myEndItem)
 
-        centerLine = QLineF(self.myStartItem.pos(), self.myEndItem.pos())
+        route = self.myRoute
+        scene = self.scene()
+        if isinstance(scene, DiagramScene):
+            scene.metrics.arrowsRecomputed += 1
+            router = scene.router
+        else:
+            router = None
+        if router is None:
+            route = None
+        elif route is None or len(route) < 2 or route[0] != startPos or route[-1] != endPos:
+            # an endpoint moved: bend half way until the router has a real route
+            middle = (startPos.y() + endPos.y())/2
+            route = [startPos, QPointF(startPos.x(), middle), QPointF(endPos.x(), middle), endPos]
+            router.schedule(self)
+        self.myRoute = route
+
+        # the head sits on the last segment, clipped at the end polygon
+        if route is not None:
+            startPos = route[-2]
+        centerLine = QLineF(startPos, endPos)
         endPolygon = self.myEndItem.polygon()
-        p1 = endPolygon.first() + self.myEndItem.pos()
-        intersectPoint = QPointF()
+        p1 = endPolygon.first() + endPos
+        intersectPoint = QPointF(endPos)
         for i in range(1, endPolygon.count()):
-            p2 = endPolygon.at(i) + self.myEndItem.pos()
+            p2 = endPolygon.at(i) + endPos
             polyLine = QLineF(p1, p2)
-            intersectionType = polyLine.intersect(centerLine, intersectPoint)
+            point = QPointF()
+            intersectionType = polyLine.intersect(centerLine, point)
             if intersectionType == QLineF.BoundedIntersection:
+                intersectPoint = point
                 break
             p1 = p2
 
-        self.setLine(QLineF(intersectPoint, self.myStartItem.pos()))
+        # setLine() calls prepareGeometryChange(), which must not happen in paint()
+        line = QLineF(intersectPoint, startPos)
+        self.setLine(line)
+        if route is not None:
+            self.myPolyline = QPolygonF(route[:-1] + [intersectPoint])
+            extra = (self.pen().width() + 20) / 2.0
+            self.myBoundingRect = self.myPolyline.boundingRect().adjusted(-extra, -extra, extra, extra)
+        else:
+            self.myPolyline = None
+            self.myBoundingRect = self.lineBoundingRect(line)
+
+        angle = math.atan2(-line.dy(), line.dx())
+
+        arrowP1 = line.p1() + QPointF(math.sin(angle + math.pi/3)*arrowSize, 
+                                        math.cos(angle + math.pi/3) * arrowSize)
 
-        angle = math.atan2(-self.line().dy(), self.line().dx())
+        arrowP2 = line.p1() + QPointF(math.sin(angle + math.pi - math.pi/3)*arrowSize,
+                                        math.cos(angle + math.pi - math.pi/3)*arrowSize)
 
-        arrowP1 = self.line().p1() + + QPointF(math.sin(angle + math.pi/3)*arrowSize, 
-                                                math.cos(angle + math.pi/3) * arrowSize)
+        arrowHead = QPolygonF()
+        arrowHead << line.p1() << arrowP1 << arrowP2
+        self.arrowHead = arrowHead
 
-        arrowP2 = self.line().p1() + QPointF(math.sin(angle + math.pi - math.pi/3)*arrowSize,
-                                                math.cos(angle + math.pi - math.pi/3)*arrowSize)
+    def paint(self, painter, option, widget):
+        DiagramMetrics.itemsPainted += 1
+        if self.myItemsCollide:
+            return
         
-        self.arrowHead.clear()
-        self.arrowHead << self.line().p1() << arrowP1 << arrowP2
+        style = DiagramScene.styles.style(self.myStyleId)
+        myPen = style.pen
+
+        # zoomed out: a plain line, no head and no selection marks
+        if option.levelOfDetailFromTransform(painter.worldTransform()) < self.ArrowHeadLod:
+            myPen = QPen(myPen)
+            myPen.setCosmetic(True)
+            myPen.setWidth(1)
+            painter.setPen(myPen)
+            if self.myPolyline is not None:
+                painter.drawPolyline(self.myPolyline)
+            else:
+                painter.drawLine(self.line())
+            return
+
+        painter.setPen(myPen)
+        painter.setBrush(style.brush)
 
-        painter.drawLine(self.line())
+        if self.myPolyline is not None:
+            painter.drawPolyline(self.myPolyline)
+        else:
+            painter.drawLine(self.line())
         painter.drawPolygon(self.arrowHead)
         if self.isSelected():
-            painter.setPen(QPen(self.myColor, 1, Qt.DashLine))
+            painter.setPen(style.selectionPen)
+            if self.myPolyline is not None:
+                for dx, dy in ((4.0, 4.0), (-4.0, -4.0)):
+                    painter.drawPolyline(self.myPolyline.translated(dx, dy))
+                return
             myLine = self.line()
             myLine.translate(0, 4.0)
             painter.drawLine(myLine)
@@ -258,6 +534,9 @@ class Arrow(QGraphicsLineItem):
 
 class DiagramTextItem(QGraphicsTextItem):
     Type = QGraphicsItem.UserType + 3
+    # labels are drawn as boxes below TextLod and hidden below TextBoxLod
+    TextLod = 0.5
+    TextBoxLod = 0.2
 
     lostFocus = pyqtSignal(QGraphicsTextItem)
     selectedChange = pyqtSignal(QGraphicsItem)
@@ -267,14 +546,35 @@ class DiagramTextItem(QGraphicsTextItem):
 
         self.setFlag(QGraphicsItem.ItemIsMovable)
         self.setFlag(QGraphicsItem.ItemIsSelectable)
+        self.setFlag(QGraphicsItem.ItemSendsGeometryChanges)
         self.itemOwner = None
+        self.myStyleId = None
+        self.undoId = None
+        # the text when editing began, compared with the edit when focus is lost
+        self.myEditText = None
 
     def type(self):
         return self.Type
 
+    def styleId(self):
+        return self.myStyleId
+
+    def setStyle(self, style):
+        # relaying out the document is the expensive part, so only what changed is set
+        previous = None if self.myStyleId is None else DiagramScene.styles.style(self.myStyleId)
+        self.myStyleId = style.id
+        if previous is None or previous.font is not style.font:
+            self.setFont(style.font)
+        if previous is None or previous.color != style.color:
+            self.setDefaultTextColor(style.color)
+
     def itemChange(self, change, value):
         if change == QGraphicsItem.ItemSelectedHasChanged:
             self.selectedChange.emit(self)
+        elif change == QGraphicsItem.ItemPositionHasChanged or change == QGraphicsItem.ItemSceneHasChanged:
+            scene = self.scene()
+            if isinstance(scene, DiagramScene):
+                scene.includeInSceneRect(self.sceneBoundingRect())
         return value
 
     def focusOutEvent(self, event):
@@ -285,15 +585,1488 @@ class DiagramTextItem(QGraphicsTextItem):
     def mouseDoubleClickEvent(self, event):
         if self.textInteractionFlags() == Qt.NoTextInteraction:
             self.setTextInteractionFlags(Qt.TextEditorInteraction)
+            self.myEditText = self.toPlainText()
         super().mouseDoubleClickEvent(event)
 
+    def editText(self):
+        return self.myEditText
+
+    def setEditText(self, text):
+        self.myEditText = text
+
     def setItemOwner(self, item):
         self.itemOwner = item
 
     def getOwner(self):
         return self.itemOwner
 
+    def paint(self, painter, option, widget):
+        DiagramMetrics.itemsPainted += 1
+        lod = option.levelOfDetailFromTransform(painter.worldTransform())
+        if lod >= self.TextLod or self.hasFocus():
+            super().paint(painter, option, widget)
+        elif lod >= self.TextBoxLod and self.myStyleId is not None:
+            painter.fillRect(self.boundingRect().adjusted(4, 4, -4, -4), DiagramScene.styles.style(self.myStyleId).boxColor)
+
+class DiagramGraph:
+    def __init__(self):
+        # node -> {neighbour: arrow}, so edge insert/delete/lookup are O(1)
+        self.outEdges = {}
+        self.inEdges = {}
+        self.myEdgeCount = 0
+
+    def addNode(self, node):
+        if node not in self.outEdges:
+            self.outEdges[node] = {}
+            self.inEdges[node] = {}
+
+    def removeNode(self, node):
+        arrows = self.incidentEdges(node)
+        for arrow in arrows:
+            self.removeEdge(arrow)
+        self.outEdges.pop(node, None)
+        self.inEdges.pop(node, None)
+        return arrows
+
+    def hasNode(self, node):
+        return node in self.outEdges
+
+    def addEdge(self, arrow):
+        startItem = arrow.startItem()
+        endItem = arrow.endItem()
+        self.addNode(startItem)
+        self.addNode(endItem)
+        if endItem in self.outEdges[startItem]:
+            return False
+        self.outEdges[startItem][endItem] = arrow
+        self.inEdges[endItem][startItem] = arrow
+        self.myEdgeCount += 1
+        return True
+
+    def removeEdge(self, arrow):
+        startItem = arrow.startItem()
+        endItem = arrow.endItem()
+        if self.edge(startItem, endItem) is not arrow:
+            return False
+        del self.outEdges[startItem][endItem]
+        del self.inEdges[endItem][startItem]
+        self.myEdgeCount -= 1
+        return True
+
+    def edge(self, startItem, endItem):
+        edges = self.outEdges.get(startItem)
+        if edges is None:
+            return None
+        return edges.get(endItem)
+
+    def hasEdge(self, startItem, endItem):
+        return self.edge(startItem, endItem) is not None
+
+    def edgesBetween(self, item1, item2):
+        return [arrow for arrow in (self.edge(item1, item2), self.edge(item2, item1)) if arrow is not None]
+
+    def successors(self, node):
+        return list(self.outEdges.get(node, ()))
+
+    def predecessors(self, node):
+        return list(self.inEdges.get(node, ()))
+
+    def neighbours(self, node):
+        neighbours = dict.fromkeys(self.outEdges.get(node, ()))
+        neighbours.update(dict.fromkeys(self.inEdges.get(node, ())))
+        return list(neighbours)
+
+    def outgoingEdges(self, node):
+        return list(self.outEdges.get(node, {}).values())
+
+    def incomingEdges(self, node):
+        return list(self.inEdges.get(node, {}).values())
+
+    def incidentEdges(self, node):
+        return self.outgoingEdges(node) + self.incomingEdges(node)
+
+    def degree(self, node):
+        return len(self.outEdges.get(node, ())) + len(self.inEdges.get(node, ()))
+
+    def nodes(self):
+        return list(self.outEdges)
+
+    def edges(self):
+        return [arrow for edges in self.outEdges.values() for arrow in edges.values()]
+
+    def nodeCount(self):
+        return len(self.outEdges)
+
+    def edgeCount(self):
+        return self.myEdgeCount
+
+    def clear(self):
+        self.outEdges.clear()
+        self.inEdges.clear()
+        self.myEdgeCount = 0
+
+
+class AlignmentIndex:
+    def __init__(self, rects=()):
+        # sorted left/centre/right (top/centre/bottom) coordinates, so the
+        # nearest alignment for a dragged item is a bisect instead of a scan
+        xs = []
+        ys = []
+        for rect in rects:
+            for x in (rect.left(), rect.center().x(), rect.right()):
+                xs.append((x, rect))
+            for y in (rect.top(), rect.center().y(), rect.bottom()):
+                ys.append((y, rect))
+        xs.sort(key=lambda entry: entry[0])
+        ys.sort(key=lambda entry: entry[0])
+        self.xKeys = [entry[0] for entry in xs]
+        self.xRects = [entry[1] for entry in xs]
+        self.yKeys = [entry[0] for entry in ys]
+        self.yRects = [entry[1] for entry in ys]
+
+    def isEmpty(self):
+        return not self.xKeys
+
+    @staticmethod
+    def nearest(keys, rects, values, tolerance):
+        # values are the moving item's three coordinates on one axis; returns
+        # (offset, coordinate, rect) of the closest match within tolerance
+        best = None
+        for value in values:
+            i = bisect.bisect_left(keys, value)
+            for k in (i - 1, i):
+                if 0 <= k < len(keys) and abs(keys[k] - value) <= tolerance:
+                    offset = keys[k] - value
+                    if best is None or abs(offset) < abs(best[0]):
+                        best = (offset, keys[k], rects[k])
+        return best
+
+    def nearestX(self, rect, tolerance):
+        return self.nearest(self.xKeys, self.xRects, (rect.center().x(), rect.left(), rect.right()), tolerance)
+
+    def nearestY(self, rect, tolerance):
+        return self.nearest(self.yKeys, self.yRects, (rect.center().y(), rect.top(), rect.bottom()), tolerance)
+
+
+class ZOrderIndex:
+    # node stacking as sorted (z, sequence) keys. Qt stacks items of equal z
+    # in insertion order, which the sequence numbers reproduce, and changing
+    # z keeps an item's sequence
+    def __init__(self):
+        self.keys = []
+        self.itemKeys = {}
+        self.sequenceItems = {}
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, item):
+        return item in self.itemKeys
+
+    def clear(self):
+        self.keys = []
+        self.itemKeys = {}
+        self.sequenceItems = {}
+
+    def add(self, item, z):
+        if item in self.itemKeys:
+            self.remove(item)
+        key = (z, self.sequence)
+        self.sequence += 1
+        bisect.insort(self.keys, key)
+        self.itemKeys[item] = key
+        self.sequenceItems[key[1]] = item
+
+    def remove(self, item):
+        key = self.itemKeys.pop(item, None)
+        if key is not None:
+            del self.keys[bisect.bisect_left(self.keys, key)]
+            del self.sequenceItems[key[1]]
+
+    def move(self, item, z):
+        key = self.itemKeys.get(item)
+        if key is None or key[0] == z:
+            return
+        del self.keys[bisect.bisect_left(self.keys, key)]
+        key = (z, key[1])
+        bisect.insort(self.keys, key)
+        self.itemKeys[item] = key
+
+    def key(self, item):
+        return self.itemKeys[item]
+
+    def top(self):
+        return self.keys[-1][0] if self.keys else None
+
+    def bottom(self):
+        return self.keys[0][0] if self.keys else None
+
+    def ordered(self, items):
+        # bottom to top
+        return sorted((item for item in items if item in self.itemKeys), key=self.itemKeys.__getitem__)
+
+    def items(self):
+        return [self.sequenceItems[sequence] for z, sequence in self.keys]
+
+    def zAbove(self, item):
+        # the z of the key above item, None if item is on top
+        index = bisect.bisect_right(self.keys, self.itemKeys[item])
+        return self.keys[index][0] if index < len(self.keys) else None
+
+    def zBelow(self, item):
+        index = bisect.bisect_left(self.keys, self.itemKeys[item])
+        return self.keys[index - 1][0] if index > 0 else None
+
+
+class RollingHistogram:
+    # the last samples in a ring buffer; bucketing only happens on export
+    def __init__(self, size):
+        self.samples = [0.]*size
+        self.count = 0
+
+    def add(self, value):
+        self.samples[self.count % len(self.samples)] = value
+        self.count += 1
+
+    def last(self):
+        return self.samples[(self.count - 1) % len(self.samples)] if self.count else 0.
+
+    def values(self):
+        return self.samples[:self.count] if self.count < len(self.samples) else list(self.samples)
+
+    def percentile(self, fraction):
+        values = sorted(self.values())
+        return values[min(len(values) - 1, int(len(values)*fraction))] if values else 0.
+
+    def export(self, bounds):
+        values = sorted(self.values())
+        buckets = [0]*(len(bounds) + 1)
+        for value in values:
+            buckets[bisect.bisect_left(bounds, value)] += 1
+        return {'total': self.count, 'samples': len(values),
+                'mean': sum(values)/len(values) if values else 0.,
+                'p50': self.percentile(0.5), 'p95': self.percentile(0.95), 'max': values[-1] if values else 0.,
+                'bounds': list(bounds), 'buckets': buckets}
+
+
+class DiagramMetrics:
+    # cheap enough to leave on: recording is a counter increment or a store
+    # into a ring buffer, histograms are only built when exported
+    History = 600
+    TimeBounds = (0.5, 1., 2., 4., 8., 16., 33., 66., 133., 266.)
+    CountBounds = (0, 1, 10, 100, 1000, 10000)
+    Timings = ('paint', 'mousePress', 'mouseMove', 'mouseRelease', 'route')
+    Counts = ('itemsPainted', 'arrowsRecomputed', 'indexRebuilds', 'routesComputed')
+
+    # items paint on the GUI thread inside one view paint event at a time,
+    # so a single process wide counter is enough and needs no scene lookup
+    itemsPainted = 0
+
+    def __init__(self):
+        self.timings = {name: RollingHistogram(self.History) for name in self.Timings}
+        self.counts = {name: RollingHistogram(self.History) for name in self.Counts}
+        # per frame counters, folded into the histograms by endFrame()
+        self.arrowsRecomputed = 0
+        self.indexRebuilds = 0
+        self.routesComputed = 0
+
+    def addTiming(self, name, seconds):
+        self.timings[name].add(seconds*1000)
+
+    def beginFrame(self):
+        DiagramMetrics.itemsPainted = 0
+
+    def endFrame(self, seconds):
+        counts = self.counts
+        self.timings['paint'].add(seconds*1000)
+        counts['itemsPainted'].add(DiagramMetrics.itemsPainted)
+        counts['arrowsRecomputed'].add(self.arrowsRecomputed)
+        counts['indexRebuilds'].add(self.indexRebuilds)
+        counts['routesComputed'].add(self.routesComputed)
+        self.arrowsRecomputed = 0
+        self.indexRebuilds = 0
+        self.routesComputed = 0
+
+    def frames(self):
+        return self.timings['paint'].count
+
+    def export(self):
+        # times in milliseconds, counts per painted frame
+        result = {name: histogram.export(self.TimeBounds) for name, histogram in self.timings.items()}
+        result.update((name, histogram.export(self.CountBounds)) for name, histogram in self.counts.items())
+        return result
+
+    def summary(self):
+        timings = self.timings
+        counts = self.counts
+        return ['frame   {:6.1f} ms  p95 {:6.1f} ms'.format(timings['paint'].last(), timings['paint'].percentile(0.95)),
+                'painted {:6d} items'.format(int(counts['itemsPainted'].last())),
+                'arrows  {:6d} recomputed'.format(int(counts['arrowsRecomputed'].last())),
+                'index   {:6d} rebuilds'.format(int(counts['indexRebuilds'].last())),
+                'routes  {:6d} computed'.format(int(counts['routesComputed'].last()))] + \
+                ['{:<7} {:6.2f} ms  p95 {:6.2f} ms'.format(name[5:].lower(), timings[name].last(), timings[name].percentile(0.95))
+                 for name in ('mousePress', 'mouseMove', 'mouseRelease')]
+
+
+def measured(name):
+    # times a scene event handler into the scene's metrics
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(self, event):
+            start = time.perf_counter()
+            try:
+                return handler(self, event)
+            finally:
+                self.metrics.addTiming(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+class StringColumn:
+    # strings by index, decoded from a utf-8 string table when read, so a
+    # large binary document opens without a str object per node
+    def __init__(self, data, offsets, stringIds):
+        self.data = data
+        self.offsets = offsets
+        self.stringIds = stringIds
+        # strings written or appended since
+        self.strings = {}
+        self.count = len(stringIds)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        text = self.strings.get(index)
+        if text is None:
+            stringId = self.stringIds[index]
+            text = str(self.data[self.offsets[stringId]:self.offsets[stringId+1]], 'utf-8')
+        return text
+
+    def __setitem__(self, index, text):
+        if not 0 <= index < self.count:
+            raise IndexError('string index out of range')
+        self.strings[index] = text
+
+    def append(self, text):
+        self.strings[self.count] = text
+        self.count += 1
+
+
+class DiagramModel:
+    CellSize = 1024.
+    NoFont = -1
+    # z writes past this many at once rebuild the z index instead of updating it
+    ZIndexBatch = 64
+
+    def __init__(self):
+        # one slot per node/edge id; removed ids stay as tombstones so ids are stable
+        self.types = array('B')
+        self.xs = array('d')
+        self.ys = array('d')
+        self.zs = array('d')
+        self.colors = array('I')
+        self.textColors = array('I')
+        self.labelXs = array('d')
+        self.labelYs = array('d')
+        self.nodeFonts = array('i')
+        self.names = []
+        self.alive = bytearray()
+
+        self.edgeStarts = array('I')
+        self.edgeEnds = array('I')
+        self.edgeColors = array('I')
+        self.edgeAlive = bytearray()
+        # node id -> {edge id: None}, an ordered set so a hub loses edges in O(1)
+        self.nodeEdges = {}
+        # the edges a binary document was loaded with are not in nodeEdges:
+        # their ids sorted by start and by end node give the edges of a node
+        # by bisection, and removed ones are only marked in edgeAlive
+        self.loadedEdgeCount = 0
+        self.outEdges = array('I')
+        self.inEdges = array('I')
+
+        self.fonts = []
+        self.fontIndex = {}
+        self.texts = []
+
+        # spatial hash: cell -> node ids
+        self.cells = {}
+        # sorted z values of the live nodes, built on first use so loading
+        # does not pay an insert per node
+        self.zIndex = None
+        self.myNodeCount = 0
+        self.myEdgeCount = 0
+
+    def cell(self, x, y):
+        return (int(x // self.CellSize), int(y // self.CellSize))
+
+    def fontId(self, font):
+        if font not in self.fontIndex:
+            self.fontIndex[font] = len(self.fonts)
+            self.fonts.append(font)
+        return self.fontIndex[font]
+
+    def addNode(self, diagramType, x, y, name, color, z, font, textColor, labelX, labelY):
+        nodeId = len(self.types)
+        self.types.append(diagramType)
+        self.xs.append(x)
+        self.ys.append(y)
+        self.zs.append(z)
+        self.colors.append(color)
+        self.textColors.append(textColor)
+        self.labelXs.append(labelX)
+        self.labelYs.append(labelY)
+        self.nodeFonts.append(font)
+        self.names.append(name)
+        self.alive.append(1)
+        self.cells.setdefault(self.cell(x, y), set()).add(nodeId)
+        if self.zIndex is not None:
+            bisect.insort(self.zIndex, z)
+        self.myNodeCount += 1
+        return nodeId
+
+    def restoreNode(self, nodeId, diagramType, x, y, name, color, z, font, textColor, labelX, labelY):
+        # brings a removed node back under its old id
+        if self.alive[nodeId]:
+            return
+        self.types[nodeId] = diagramType
+        self.xs[nodeId] = x
+        self.ys[nodeId] = y
+        self.zs[nodeId] = z
+        self.colors[nodeId] = color
+        self.textColors[nodeId] = textColor
+        self.labelXs[nodeId] = labelX
+        self.labelYs[nodeId] = labelY
+        self.nodeFonts[nodeId] = font
+        self.names[nodeId] = name
+        self.alive[nodeId] = 1
+        self.cells.setdefault(self.cell(x, y), set()).add(nodeId)
+        if self.zIndex is not None:
+            bisect.insort(self.zIndex, z)
+        self.myNodeCount += 1
+
+    def updateNode(self, nodeId, diagramType, x, y, name, color, z, font, textColor, labelX, labelY):
+        self.moveNode(nodeId, x, y)
+        self.names[nodeId] = name
+        self.colors[nodeId] = color
+        self.setZ(nodeId, z)
+        self.nodeFonts[nodeId] = font
+        self.textColors[nodeId] = textColor
+        self.labelXs[nodeId] = labelX
+        self.labelYs[nodeId] = labelY
+
+    def moveNode(self, nodeId, x, y):
+        oldCell = self.cell(self.xs[nodeId], self.ys[nodeId])
+        newCell = self.cell(x, y)
+        if oldCell != newCell:
+            self.cells[oldCell].discard(nodeId)
+            self.cells.setdefault(newCell, set()).add(nodeId)
+        self.xs[nodeId] = x
+        self.ys[nodeId] = y
+
+    def setZ(self, nodeId, z):
+        oldZ = self.zs[nodeId]
+        if oldZ == z:
+            return
+        self.zs[nodeId] = z
+        if self.zIndex is not None and self.alive[nodeId]:
+            del self.zIndex[bisect.bisect_left(self.zIndex, oldZ)]
+            bisect.insort(self.zIndex, z)
+
+    def setZValues(self, nodeIds, zs):
+        if len(nodeIds) > self.ZIndexBatch:
+            self.zIndex = None
+        for nodeId, z in zip(nodeIds, zs):
+            self.setZ(nodeId, z)
+
+    def zRange(self):
+        # (top, bottom) of the live nodes
+        if self.zIndex is None:
+            self.zIndex = array('d', sorted(itertools.compress(self.zs, self.alive)))
+        if not self.zIndex:
+            return None, None
+        return self.zIndex[-1], self.zIndex[0]
+
+    def removeNode(self, nodeId):
+        if not self.alive[nodeId]:
+            return []
+        edges = self.edgesOf(nodeId)
+        for edgeId in edges:
+            self.removeEdge(edgeId)
+        self.cells[self.cell(self.xs[nodeId], self.ys[nodeId])].discard(nodeId)
+        self.nodeEdges.pop(nodeId, None)
+        if self.zIndex is not None:
+            del self.zIndex[bisect.bisect_left(self.zIndex, self.zs[nodeId])]
+        self.alive[nodeId] = 0
+        self.names[nodeId] = ''
+        self.myNodeCount -= 1
+        return edges
+
+    def addEdge(self, start, end, color):
+        edgeId = len(self.edgeStarts)
+        self.edgeStarts.append(start)
+        self.edgeEnds.append(end)
+        self.edgeColors.append(color)
+        self.edgeAlive.append(1)
+        self.nodeEdges.setdefault(start, {})[edgeId] = None
+        self.nodeEdges.setdefault(end, {})[edgeId] = None
+        self.myEdgeCount += 1
+        return edgeId
+
+    def restoreEdge(self, edgeId, start, end, color):
+        if self.edgeAlive[edgeId]:
+            return
+        self.edgeStarts[edgeId] = start
+        self.edgeEnds[edgeId] = end
+        self.edgeColors[edgeId] = color
+        self.edgeAlive[edgeId] = 1
+        if edgeId >= self.loadedEdgeCount:
+            self.nodeEdges.setdefault(start, {})[edgeId] = None
+            self.nodeEdges.setdefault(end, {})[edgeId] = None
+        self.myEdgeCount += 1
+
+    def isEdge(self, edgeId):
+        return 0 <= edgeId < len(self.edgeAlive) and self.edgeAlive[edgeId] == 1
+
+    def removeEdge(self, edgeId):
+        if not self.edgeAlive[edgeId]:
+            return
+        self.edgeAlive[edgeId] = 0
+        for nodeId in (self.edgeStarts[edgeId], self.edgeEnds[edgeId]):
+            edges = self.nodeEdges.get(nodeId)
+            if edges is not None:
+                edges.pop(edgeId, None)
+        self.myEdgeCount -= 1
+
+    def edgesOf(self, nodeId):
+        edges = self.nodeEdges.get(nodeId, ())
+        if not self.loadedEdgeCount:
+            return list(edges)
+        alive = self.edgeAlive
+        loaded = itertools.chain(self.loadedEdges(self.outEdges, self.edgeStarts, nodeId), 
+                                 self.loadedEdges(self.inEdges, self.edgeEnds, nodeId))
+        # a loop is in both runs
+        return list(dict.fromkeys(itertools.chain((edgeId for edgeId in loaded if alive[edgeId]), edges)))
+
+    def loadedEdges(self, edgeIds, nodeIds, nodeId):
+        # the run of nodeId in edgeIds, which are sorted by nodeIds
+        first = bisect.bisect_left(edgeIds, nodeId, key=nodeIds.__getitem__)
+        last = bisect.bisect_right(edgeIds, nodeId, lo=first, key=nodeIds.__getitem__)
+        return edgeIds[first:last]
+
+    def neighbours(self, nodeId):
+        # the far end of every edge of the node
+        starts = self.edgeStarts
+        ends = self.edgeEnds
+        return [ends[edgeId] if starts[edgeId] == nodeId else starts[edgeId] for edgeId in self.edgesOf(nodeId)]
+
+    def isNode(self, nodeId):
+        return 0 <= nodeId < len(self.alive) and self.alive[nodeId] == 1
+
+    def nodeCount(self):
+        return self.myNodeCount
+
+    def edgeCount(self):
+        return self.myEdgeCount
+
+    def nodeIds(self):
+        return [nodeId for nodeId in range(len(self.alive)) if self.alive[nodeId]]
+
+    def nodesInRect(self, rect):
+        left, top, right, bottom = rect.left(), rect.top(), rect.right(), rect.bottom()
+        firstColumn, firstRow = self.cell(left, top)
+        lastColumn, lastRow = self.cell(right, bottom)
+        cells = self.cells
+        # very large rects visit the occupied cells instead of every cell in range
+        if (lastColumn-firstColumn+1)*(lastRow-firstRow+1) > len(cells):
+            candidates = [nodeIds for key, nodeIds in cells.items() 
+                            if firstColumn <= key[0] <= lastColumn and firstRow <= key[1] <= lastRow]
+        else:
+            candidates = [cells.get((column, row), ()) for column in range(firstColumn, lastColumn+1) 
+                            for row in range(firstRow, lastRow+1)]
+        xs = self.xs
+        ys = self.ys
+        return [nodeId for nodeIds in candidates for nodeId in nodeIds 
+                if left <= xs[nodeId] <= right and top <= ys[nodeId] <= bottom]
+
+    def boundingRect(self):
+        nodeIds = self.nodeIds()
+        if not nodeIds:
+            return QRectF()
+        xs = [self.xs[i] for i in nodeIds]
+        ys = [self.ys[i] for i in nodeIds]
+        return QRectF(QPointF(min(xs), min(ys)), QPointF(max(xs), max(ys)))
+
+    @classmethod
+    def fromDocument(cls, document):
+        model = cls()
+        for font in document.fonts:
+            model.fontId(font)
+        for diagramType, x, y, name, color, z, font, textColor, labelX, labelY in document.nodes:
+            model.addNode(diagramType, x, y, name, colorToArgb(color), z, cls.NoFont if font is None else font, 
+                            colorToArgb(textColor), labelX or 0., labelY or 0.)
+        for start, end, color in document.arrows:
+            model.addEdge(start, end, colorToArgb(color))
+        model.texts = list(document.texts)
+        return model
+
+    @classmethod
+    def fromBinary(cls, reader):
+        # copies the mapped columns straight into the model arrays
+        model = cls()
+        nodes = reader.nodes
+        count = reader.nodeCount()
+        for column, name in ((model.types, 'type'), (model.xs, 'x'), (model.ys, 'y'), (model.zs, 'z'), 
+                                (model.colors, 'color'), (model.textColors, 'textColor'), 
+                                (model.labelXs, 'labelX'), (model.labelYs, 'labelY')):
+            column.frombytes(nodes[name].tobytes())
+
+        fontIds = {font: model.fontId(reader.string(font)) for font in sorted(set(nodes['font'])) 
+                    if font != DiagramBinaryReader.NoFont}
+        fontIds[DiagramBinaryReader.NoFont] = cls.NoFont
+        model.nodeFonts = array('i', map(fontIds.__getitem__, nodes['font']))
+        # names stay encoded in a copy of the string table until they are read;
+        # a table that is not utf-8 is refused here rather than when a name is shown
+        data = reader.stringTable()
+        data.decode('utf-8')
+        model.names = StringColumn(data, array('I', reader.stringOffsets.tobytes()), array('I', nodes['name'].tobytes()))
+        model.alive = bytearray(b'\x01')*count
+        model.myNodeCount = count
+
+        cells = model.cells
+        size = cls.CellSize
+        columns = map(int, map(size.__rfloordiv__, model.xs))
+        rows = map(int, map(size.__rfloordiv__, model.ys))
+        for nodeId, key in enumerate(zip(columns, rows)):
+            nodeIds = cells.get(key)
+            if nodeIds is None:
+                nodeIds = cells[key] = set()
+            nodeIds.add(nodeId)
+
+        arrows = reader.arrows
+        arrowCount = reader.arrowCount()
+        for column, name in ((model.edgeStarts, 'start'), (model.edgeEnds, 'end'), (model.edgeColors, 'color')):
+            column.frombytes(arrows[name].tobytes())
+        if arrowCount and max(max(model.edgeStarts), max(model.edgeEnds)) >= count:
+            raise ValueError('binary diagram document has arrows between missing nodes')
+        model.edgeAlive = bytearray(b'\x01')*arrowCount
+        model.myEdgeCount = model.loadedEdgeCount = arrowCount
+        # the file keeps arrows sorted by start node, so the first sort is a single pass
+        model.outEdges = array('I', sorted(range(arrowCount), key=model.edgeStarts.__getitem__))
+        model.inEdges = array('I', sorted(range(arrowCount), key=model.edgeEnds.__getitem__))
+
+        model.texts = reader.toDocument([]).texts
+        return model
+
+    @classmethod
+    def fromJournal(cls, state):
+        # the nodes are numbered afresh, the scene starts a new journal from the model
+        model = cls()
+        styles = state.styles
+        nodeIds = {}
+        for nodeId, (diagramType, x, y, z, styleId, name) in state.nodes.items():
+            label = state.texts.get(state.labels.get(nodeId))
+            if label is None:
+                font, textColor, labelX, labelY = cls.NoFont, 0, 0., 0.
+            else:
+                textColor, font = styles[label[4]]
+                font = cls.NoFont if font is None else model.fontId(font)
+                labelX, labelY = label[1], label[2]
+            nodeIds[nodeId] = model.addNode(diagramType, x, y, name, styles[styleId][0], z, font, textColor, labelX, labelY)
+        for startId, endId, styleId in state.arrows.values():
+            if startId in nodeIds and endId in nodeIds:
+                model.addEdge(nodeIds[startId], nodeIds[endId], styles[styleId][0])
+        for ownerId, x, y, z, styleId, text in state.texts.values():
+            if ownerId < 0:
+                argb, font = styles[styleId]
+                model.texts.append([text, x, y, model.fontId(font) if font is not None else cls.NoFont, argbToColor(argb), z])
+        return model
+
+    def toDocument(self):
+        document = DiagramDocument()
+        document.fonts = list(self.fonts)
+        nodeIds = {}
+        for nodeId in self.nodeIds():
+            nodeIds[nodeId] = len(document.nodes)
+            font = self.nodeFonts[nodeId]
+            if font == self.NoFont:
+                label = [None, None, None, None]
+            else:
+                label = [font, argbToColor(self.textColors[nodeId]), self.labelXs[nodeId], self.labelYs[nodeId]]
+            document.nodes.append([self.types[nodeId], self.xs[nodeId], self.ys[nodeId], self.names[nodeId], 
+                                    argbToColor(self.colors[nodeId]), self.zs[nodeId]] + label)
+        for edgeId in range(len(self.edgeAlive)):
+            if self.edgeAlive[edgeId]:
+                document.arrows.append([nodeIds[self.edgeStarts[edgeId]], nodeIds[self.edgeEnds[edgeId]], 
+                                        argbToColor(self.edgeColors[edgeId])])
+        document.texts = list(self.texts)
+        return document
+
+
+def orthogonalRoute(start, end, obstacles, bounds, bendCost, maxExpansions=3000):
+    # A* over the sparse grid spanned by the obstacle edges, the endpoints and
+    # the corridor bounds; returns the bend points, or None if boxed in or the
+    # search gives up after maxExpansions states; coinciding endpoints have no route
+    if start == end:
+        return None
+    left, top, right, bottom = bounds.left(), bounds.top(), bounds.right(), bounds.bottom()
+    xs = {start.x(), end.x(), left, right}
+    ys = {start.y(), end.y(), top, bottom}
+    for rect in obstacles:
+        xs.update(x for x in (rect.left(), rect.right()) if left < x < right)
+        ys.update(y for y in (rect.top(), rect.bottom()) if top < y < bottom)
+    xs = sorted(xs)
+    ys = sorted(ys)
+    columns = len(xs)
+    rows = len(ys)
+
+    # grid lines include every obstacle edge, so a grid edge is either wholly
+    # inside an obstacle or wholly outside; h/v index the edge leaving (i, j)
+    # to the right and downwards
+    hBlocked = bytearray(columns*rows)
+    vBlocked = bytearray(columns*rows)
+    for rect in obstacles:
+        # edges running inside the rect, and grid lines strictly inside it
+        firstEdgeColumn = bisect.bisect_left(xs, rect.left())
+        lastEdgeColumn = bisect.bisect_right(xs, rect.right()) - 1
+        firstInnerColumn = bisect.bisect_right(xs, rect.left())
+        lastInnerColumn = bisect.bisect_left(xs, rect.right())
+        firstEdgeRow = bisect.bisect_left(ys, rect.top())
+        lastEdgeRow = bisect.bisect_right(ys, rect.bottom()) - 1
+        firstInnerRow = bisect.bisect_right(ys, rect.top())
+        lastInnerRow = bisect.bisect_left(ys, rect.bottom())
+        count = lastEdgeColumn - firstEdgeColumn
+        if count > 0:
+            for j in range(firstInnerRow, lastInnerRow):
+                hBlocked[j*columns + firstEdgeColumn:j*columns + lastEdgeColumn] = bytes(count*[1])
+        count = lastInnerColumn - firstInnerColumn
+        if count > 0:
+            for j in range(firstEdgeRow, lastEdgeRow):
+                vBlocked[j*columns + firstInnerColumn:j*columns + lastInnerColumn] = bytes(count*[1])
+
+    startNode = ys.index(start.y())*columns + xs.index(start.x())
+    endNode = ys.index(end.y())*columns + xs.index(end.x())
+    ex = end.x()
+    ey = end.y()
+    # states are node*3 + direction of arrival: 0 horizontal, 1 vertical, 2 none
+    startState = startNode*3 + 2
+    costs = {startState: 0.}
+    previous = {}
+    heap = [(abs(start.x() - ex) + abs(start.y() - ey), 0., startState)]
+    while heap and maxExpansions > 0:
+        _, cost, state = heapq.heappop(heap)
+        if cost > costs.get(state, math.inf):
+            continue
+        maxExpansions -= 1
+        node, direction = divmod(state, 3)
+        if node == endNode:
+            points = []
+            while True:
+                node = state//3
+                point = QPointF(xs[node % columns], ys[node//columns])
+                # drop the middle of straight runs
+                if len(points) >= 2 and (points[-1].x() == point.x() == points[-2].x() or 
+                                            points[-1].y() == point.y() == points[-2].y()):
+                    points[-1] = point
+                else:
+                    points.append(point)
+                if state == startState:
+                    break
+                state = previous[state]
+            points.reverse()
+            return points if len(points) >= 2 else None
+        i = node % columns
+        j = node//columns
+        moves = []
+        if i + 1 < columns and not hBlocked[node]:
+            moves.append((node + 1, 0))
+        if i > 0 and not hBlocked[node - 1]:
+            moves.append((node - 1, 0))
+        if j + 1 < rows and not vBlocked[node]:
+            moves.append((node + columns, 1))
+        if j > 0 and not vBlocked[node - columns]:
+            moves.append((node - columns, 1))
+        x = xs[i]
+        y = ys[j]
+        for nextNode, nextDirection in moves:
+            nx = xs[nextNode % columns]
+            ny = ys[nextNode//columns]
+            nextCost = cost + abs(nx - x) + abs(ny - y)
+            if direction != 2 and direction != nextDirection:
+                nextCost += bendCost
+            nextState = nextNode*3 + nextDirection
+            if nextCost < costs.get(nextState, math.inf):
+                costs[nextState] = nextCost
+                previous[nextState] = state
+                heapq.heappush(heap, (nextCost + abs(nx - ex) + abs(ny - ey), nextCost, nextState))
+    return None
+
+
+class ArrowRouter:
+    # corridors of routed arrows are kept in a spatial hash, so a moved node
+    # only reroutes the arrows whose corridor it touches
+    CellSize = 512
+    Padding = 15
+    CorridorMargin = 150
+    BendCost = 40
+    FrameBudget = 0.008
+    # long arrows and corridors crowded with more nodes than this keep the
+    # simple bend route, the search grid grows with the square of the obstacle count
+    MaxRouteLength = 4000
+    MaxObstacles = 30
+
+    def __init__(self, scene):
+        self.scene = scene
+        self.corridors = {}
+        self.cells = {}
+        self.pending = {}
+        self.routesComputed = 0
+        self.timer = QTimer(scene)
+        self.timer.timeout.connect(self.processPending)
+
+    def cellRange(self, rect):
+        size = self.CellSize
+        return range(math.floor(rect.left()/size), math.floor(rect.right()/size) + 1), \
+                range(math.floor(rect.top()/size), math.floor(rect.bottom()/size) + 1)
+
+    def setCorridor(self, arrow, rect):
+        self.removeCorridor(arrow)
+        columns, rows = self.cellRange(rect)
+        keys = [(column, row) for column in columns for row in rows]
+        for key in keys:
+            self.cells.setdefault(key, set()).add(arrow)
+        self.corridors[arrow] = (rect, keys)
+
+    def removeCorridor(self, arrow):
+        entry = self.corridors.pop(arrow, None)
+        if entry is not None:
+            for key in entry[1]:
+                arrows = self.cells[key]
+                arrows.discard(arrow)
+                if not arrows:
+                    del self.cells[key]
+
+    def removeArrow(self, arrow):
+        self.removeCorridor(arrow)
+        self.pending.pop(arrow, None)
+
+    def clear(self):
+        self.corridors = {}
+        self.cells = {}
+        self.pending = {}
+        self.timer.stop()
+
+    def schedule(self, arrow):
+        self.pending[arrow] = None
+        if not self.timer.isActive():
+            self.timer.start(0)
+
+    def invalidateRect(self, rect):
+        columns, rows = self.cellRange(rect)
+        cells = self.cells
+        for column in columns:
+            for row in rows:
+                for arrow in cells.get((column, row), ()):
+                    if arrow not in self.pending and self.corridors[arrow][0].intersects(rect):
+                        self.schedule(arrow)
+
+    def processPending(self):
+        # route until this frame's budget is spent, the rest waits for the next one
+        start = time.perf_counter()
+        deadline = start + self.FrameBudget
+        while self.pending and time.perf_counter() < deadline:
+            arrow = next(iter(self.pending))
+            del self.pending[arrow]
+            if arrow.scene() is self.scene:
+                self.routeArrow(arrow)
+        if not self.pending:
+            self.timer.stop()
+        self.scene.metrics.addTiming('route', time.perf_counter() - start)
+
+    def routeArrow(self, arrow):
+        startItem = arrow.startItem()
+        endItem = arrow.endItem()
+        start = startItem.pos()
+        end = endItem.pos()
+        self.routesComputed += 1
+        self.scene.metrics.routesComputed += 1
+        if max(abs(end.x() - start.x()), abs(end.y() - start.y())) > self.MaxRouteLength:
+            self.removeCorridor(arrow)
+            return
+        route = None
+        margin = self.CorridorMargin
+        padding = self.Padding
+        for _ in range(2):
+            corridor = QRectF(start, end).normalized().adjusted(-margin, -margin, margin, margin)
+            obstacles = [item.sceneBoundingRect().adjusted(-padding, -padding, padding, padding) 
+                            for item in self.scene.items(corridor, Qt.IntersectsItemBoundingRect) 
+                            if isinstance(item, DiagramItem) and item is not startItem and item is not endItem]
+            if len(obstacles) > self.MaxObstacles:
+                break
+            route = orthogonalRoute(start, end, obstacles, corridor, self.BendCost)
+            if route is not None:
+                break
+            margin *= 4
+        self.setCorridor(arrow, corridor)
+        if route is not None:
+            arrow.setRoute(route)
+
+
+def gridPen(color):
+    pen = QPen(color, 0)
+    pen.setCosmetic(True)
+    return pen
+
+
+def arrayBytes(*arrays):
+    return sum(values.itemsize*len(values) for values in arrays)
+
+
+class DiagramItemRecords:
+    # the nodes, labels, free text and arrows of one insert or delete, kept in
+    # columns like DiagramModel: a few arrays per command, not an object per item
+    def __init__(self):
+        self.nodeIds = array('q')
+        self.labelIds = array('q')
+        self.types = array('b')
+        self.xs = array('d')
+        self.ys = array('d')
+        self.zs = array('d')
+        self.styleIds = array('l')
+        self.labelXs = array('d')
+        self.labelYs = array('d')
+        self.labelStyleIds = array('l')
+        self.names = []
+        self.textIds = array('q')
+        # the node a lone label belonged to, -1 for free text
+        self.textOwnerIds = array('q')
+        self.textXs = array('d')
+        self.textYs = array('d')
+        self.textZs = array('d')
+        self.textStyleIds = array('l')
+        self.texts = []
+        self.arrowIds = array('q')
+        self.startIds = array('q')
+        self.endIds = array('q')
+        self.arrowStyleIds = array('l')
+
+    def __len__(self):
+        return len(self.nodeIds) + len(self.textIds) + len(self.arrowIds)
+
+    def cost(self):
+        return arrayBytes(self.nodeIds, self.labelIds, self.types, self.xs, self.ys, self.zs, self.styleIds, 
+                          self.labelXs, self.labelYs, self.labelStyleIds, self.textIds, self.textOwnerIds, self.textXs, 
+                          self.textYs, self.textZs, self.textStyleIds, self.arrowIds, self.startIds, self.endIds, 
+                          self.arrowStyleIds) + sum(len(text) for text in self.names) + sum(len(text) for text in self.texts)
+
+    def add(self, scene, items):
+        for item in items:
+            if item.type() == DiagramItem.Type:
+                # a node whose label was deleted on its own has none
+                label = item.getTextItem()
+                labelPos = label.pos() if label is not None else QPointF()
+                self.nodeIds.append(scene.undoId(item))
+                self.labelIds.append(scene.undoId(label) if label is not None else -1)
+                self.types.append(item.diagramType().value)
+                self.xs.append(item.pos().x())
+                self.ys.append(item.pos().y())
+                self.zs.append(item.zValue())
+                self.styleIds.append(item.styleId())
+                self.labelXs.append(labelPos.x())
+                self.labelYs.append(labelPos.y())
+                self.labelStyleIds.append(scene.textStyle(label).id if label is not None else 0)
+                self.names.append(item.getMyName())
+            elif item.type() == DiagramTextItem.Type:
+                owner = item.getOwner()
+                self.textIds.append(scene.undoId(item))
+                self.textOwnerIds.append(-1 if owner is None else scene.undoId(owner))
+                self.textXs.append(item.pos().x())
+                self.textYs.append(item.pos().y())
+                self.textZs.append(item.zValue())
+                self.textStyleIds.append(scene.textStyle(item).id)
+                self.texts.append(item.toPlainText())
+            elif item.type() == Arrow.Type:
+                self.arrowIds.append(scene.undoId(item))
+                self.startIds.append(scene.undoId(item.startItem()))
+                self.endIds.append(scene.undoId(item.endItem()))
+                self.arrowStyleIds.append(item.styleId())
+
+    @classmethod
+    def fromModel(cls, scene):
+        # every node and edge of a virtual diagram, in view or not
+        records = cls()
+        model = scene.model()
+        styles = {}
+
+        def styleId(argb, fontId=DiagramModel.NoFont):
+            key = (argb, fontId)
+            if key not in styles:
+                styles[key] = scene.styles.intern(scene.modelColor(argb), scene.modelFont(fontId)).id
+            return styles[key]
+
+        # a node without a font gets the default label once it is materialised
+        defaultStyleId = scene.styles.intern(scene.textColor(), scene.font()).id
+        for nodeId in model.nodeIds():
+            fontId = model.nodeFonts[nodeId]
+            if fontId == DiagramModel.NoFont:
+                labelPos = scene.defaultLabelPos(DiagramItem.DiagramType(model.types[nodeId]))
+                labelX, labelY, labelStyleId = labelPos.x(), labelPos.y(), defaultStyleId
+            else:
+                labelX, labelY = model.labelXs[nodeId], model.labelYs[nodeId]
+                labelStyleId = styleId(model.textColors[nodeId], fontId)
+            records.nodeIds.append(scene.modelUndoId(nodeId, scene.NodeIdKind))
+            records.labelIds.append(scene.modelUndoId(nodeId, scene.LabelIdKind))
+            records.types.append(model.types[nodeId])
+            records.xs.append(model.xs[nodeId])
+            records.ys.append(model.ys[nodeId])
+            records.zs.append(model.zs[nodeId])
+            records.styleIds.append(styleId(model.colors[nodeId]))
+            records.labelXs.append(labelX)
+            records.labelYs.append(labelY)
+            records.labelStyleIds.append(labelStyleId)
+            records.names.append(model.names[nodeId])
+        records.addModelArrows(scene, [edgeId for edgeId in range(len(model.edgeAlive)) if model.edgeAlive[edgeId]])
+        return records
+
+    def addModelArrows(self, scene, edgeIds):
+        # edges of a virtual diagram whose items are released
+        model = scene.model()
+        for edgeId in edgeIds:
+            self.arrowIds.append(scene.modelUndoId(edgeId, scene.ArrowIdKind))
+            self.startIds.append(scene.modelUndoId(model.edgeStarts[edgeId], scene.NodeIdKind))
+            self.endIds.append(scene.modelUndoId(model.edgeEnds[edgeId], scene.NodeIdKind))
+            self.arrowStyleIds.append(scene.styles.intern(scene.modelColor(model.edgeColors[edgeId])).id)
+
+    def restore(self, scene):
+        if scene.isVirtual():
+            self.restoreModel(scene)
+            return
+        styles = scene.styles
+        records = []
+        for i in range(len(self.nodeIds)):
+            labelStyle = styles.style(self.labelStyleIds[i])
+            records.append((DiagramItem.DiagramType(self.types[i]), QPointF(self.xs[i], self.ys[i]), self.names[i], 
+                            styles.style(self.styleIds[i]).color, self.zs[i], labelStyle.font, labelStyle.color, 
+                            QPointF(self.labelXs[i], self.labelYs[i])))
+        for item, nodeId, labelId in zip(scene.insertItems(records), self.nodeIds, self.labelIds):
+            scene.registerUndoId(item, nodeId)
+            if labelId >= 0:
+                scene.registerUndoId(item.getTextItem(), labelId)
+            else:
+                scene.removeItem(item.getTextItem())
+                item.setTextItemOwnership(None)
+        self.restoreTexts(scene)
+        for arrowId, startId, endId, styleId in zip(self.arrowIds, self.startIds, self.endIds, self.arrowStyleIds):
+            arrow = scene.addArrow(scene.itemForId(startId), scene.itemForId(endId), styles.style(styleId).color)
+            if arrow is not None:
+                scene.registerUndoId(arrow, arrowId)
+
+    def restoreModel(self, scene):
+        # nodes and edges go back into the model under their old ids and
+        # become items again if they are in view
+        model = scene.model()
+        styles = scene.styles
+        kinds = scene.IdKinds
+        for i in range(len(self.nodeIds)):
+            labelStyle = styles.style(self.labelStyleIds[i])
+            hasLabel = self.labelIds[i] >= 0
+            model.restoreNode(self.nodeIds[i]//kinds, self.types[i], self.xs[i], self.ys[i], self.names[i], 
+                                styles.style(self.styleIds[i]).color.rgba(), self.zs[i], 
+                                model.fontId(labelStyle.font.toString()) if hasLabel else DiagramModel.NoFont, 
+                                labelStyle.color.rgba() if hasLabel else 0, self.labelXs[i], self.labelYs[i])
+        self.restoreTexts(scene)
+        for arrowId, startId, endId, styleId in zip(self.arrowIds, self.startIds, self.endIds, self.arrowStyleIds):
+            model.restoreEdge(arrowId//kinds, startId//kinds, endId//kinds, styles.style(styleId).color.rgba())
+        scene.refreshViewport()
+
+    def restoreTexts(self, scene):
+        styles = scene.styles
+        for i in range(len(self.textIds)):
+            style = styles.style(self.textStyleIds[i])
+            owner = scene.itemForId(self.textOwnerIds[i]) if self.textOwnerIds[i] >= 0 else None
+            if owner is None and self.textOwnerIds[i] >= 0 and scene.isVirtual():
+                # the label of a released node lives in its model row
+                model = scene.model()
+                nodeId = self.textOwnerIds[i]//scene.IdKinds
+                if model.isNode(nodeId):
+                    model.names[nodeId] = self.texts[i]
+                    model.labelXs[nodeId] = self.textXs[i]
+                    model.labelYs[nodeId] = self.textYs[i]
+                    model.textColors[nodeId] = style.color.rgba()
+                    model.nodeFonts[nodeId] = model.fontId(style.font.toString())
+                continue
+            textItem = scene.createTextItem(QPointF(self.textXs[i], self.textYs[i]), self.texts[i], style.font, 
+                                            style.color, self.textZs[i])
+            if owner is not None:
+                textItem.setParentItem(owner)
+                textItem.setItemOwner(owner)
+                owner.setTextItemOwnership(textItem)
+            else:
+                scene.addItem(textItem)
+            scene.registerUndoId(textItem, self.textIds[i])
+
+    def remove(self, scene):
+        scene.removeIds(self.removedIds())
+
+    def removedIds(self):
+        return self.arrowIds + self.textIds + self.nodeIds
+
+    def columns(self):
+        # the arrays themselves, for the journal; records are not changed once made
+        return dict(vars(self))
+
+    @classmethod
+    def fromJournal(cls, state, styleIds):
+        # styleIds maps the style ids of the journal to this session's palette
+        records = cls()
+        nodes = state.nodes
+        for nodeId, (diagramType, x, y, z, styleId, name) in nodes.items():
+            labelId = state.labels.get(nodeId, -1)
+            label = state.texts.get(labelId)
+            records.nodeIds.append(nodeId)
+            records.labelIds.append(labelId)
+            records.types.append(diagramType)
+            records.xs.append(x)
+            records.ys.append(y)
+            records.zs.append(z)
+            records.styleIds.append(styleIds[styleId])
+            records.labelXs.append(label[1] if label is not None else 0.)
+            records.labelYs.append(label[2] if label is not None else 0.)
+            records.labelStyleIds.append(styleIds[label[4]] if label is not None else 0)
+            records.names.append(name)
+        for textId, (ownerId, x, y, z, styleId, text) in state.texts.items():
+            if ownerId >= 0:
+                continue
+            records.textIds.append(textId)
+            records.textOwnerIds.append(-1)
+            records.textXs.append(x)
+            records.textYs.append(y)
+            records.textZs.append(z)
+            records.textStyleIds.append(styleIds[styleId])
+            records.texts.append(text)
+        for arrowId, (startId, endId, styleId) in state.arrows.items():
+            if startId in nodes and endId in nodes:
+                records.arrowIds.append(arrowId)
+                records.startIds.append(startId)
+                records.endIds.append(endId)
+                records.arrowStyleIds.append(styleIds[styleId])
+        return records
+
+
+class DiagramCommand(QUndoCommand):
+    # commands are pushed after the change is made, so the first redo does
+    # nothing; items are referred to by their stable undo ids
+    Overhead = 200
+
+    def __init__(self, scene, text):
+        super().__init__(text)
+        self.scene = scene
+        self.done = True
+
+    def redo(self):
+        if self.done:
+            self.done = False
+        else:
+            self.replay(True)
+        self.scene.journalCommand(self, True)
+
+    def undo(self):
+        self.replay(False)
+        self.scene.journalCommand(self, False)
+
+    def replay(self, forward):
+        self.scene.replaying = True
+        try:
+            self.apply(forward)
+        finally:
+            self.scene.replaying = False
+
+    def cost(self):
+        return self.Overhead
+
+    def evict(self):
+        # dropped by the stack once undo reaches it
+        self.setObsolete(True)
+
+
+class ItemsCommand(DiagramCommand):
+    def __init__(self, scene, text, records, inserted):
+        super().__init__(scene, text)
+        self.records = records
+        self.inserted = inserted
+
+    def apply(self, forward):
+        if forward == self.inserted:
+            self.scene.restoreItems(self.records)
+        else:
+            self.records.remove(self.scene)
+
+    def operation(self, forward):
+        if forward == self.inserted:
+            return dict(self.records.columns(), op='insert')
+        return {'op': 'remove', 'ids': self.records.removedIds()}
+
+    def cost(self):
+        return self.Overhead + self.records.cost()
+
+    def evict(self):
+        self.records = None
+        super().evict()
+
+
+class TranslateCommand(DiagramCommand):
+    # one command per drag: the moves of a drag share their ids and add up
+    MergeId = 1
+
+    def __init__(self, scene, ids, dx, dy, dragId):
+        super().__init__(scene, 'Move')
+        self.ids = ids
+        self.dx = dx
+        self.dy = dy
+        self.dragId = dragId
+
+    def id(self):
+        return self.MergeId
+
+    def mergeWith(self, other):
+        if not isinstance(other, TranslateCommand) or other.dragId != self.dragId:
+            return False
+        self.dx += other.dx
+        self.dy += other.dy
+        if not self.dx and not self.dy:
+            self.setObsolete(True)
+        return True
+
+    def apply(self, forward):
+        sign = 1 if forward else -1
+        self.scene.translateIds(self.ids, sign*self.dx, sign*self.dy)
+
+    def operation(self, forward):
+        sign = 1 if forward else -1
+        return {'op': 'translate', 'ids': self.ids, 'dx': sign*self.dx, 'dy': sign*self.dy}
+
+    def cost(self):
+        return self.Overhead + arrayBytes(self.ids)
+
+    def evict(self):
+        self.ids = array('q')
+        super().evict()
+
+
+class MoveCommand(DiagramCommand):
+    def __init__(self, scene, text, ids, oldXs, oldYs, xs, ys):
+        super().__init__(scene, text)
+        self.ids = ids
+        self.positions = (oldXs, oldYs, xs, ys)
+
+    def apply(self, forward):
+        oldXs, oldYs, xs, ys = self.positions
+        if forward:
+            self.scene.moveIdsTo(self.ids, xs, ys)
+        else:
+            self.scene.moveIdsTo(self.ids, oldXs, oldYs)
+
+    def operation(self, forward):
+        oldXs, oldYs, xs, ys = self.positions
+        return {'op': 'move', 'ids': self.ids, 'xs': xs if forward else oldXs, 'ys': ys if forward else oldYs}
+
+    def cost(self):
+        return self.Overhead + arrayBytes(self.ids, *self.positions)
+
+    def evict(self):
+        self.ids = array('q')
+        self.positions = (array('d'),)*4
+        super().evict()
+
+
+class StyleCommand(DiagramCommand):
+    def __init__(self, scene, text, ids, oldStyleIds, styleIds):
+        super().__init__(scene, text)
+        self.ids = ids
+        self.oldStyleIds = oldStyleIds
+        self.styleIds = styleIds
+
+    def apply(self, forward):
+        self.scene.applyIdStyles(self.ids, self.styleIds if forward else self.oldStyleIds)
+
+    def operation(self, forward):
+        return {'op': 'style', 'ids': self.ids, 'styleIds': self.styleIds if forward else self.oldStyleIds}
+
+    def cost(self):
+        return self.Overhead + arrayBytes(self.ids, self.oldStyleIds, self.styleIds)
+
+    def evict(self):
+        self.ids = self.oldStyleIds = self.styleIds = array('q')
+        super().evict()
+
+
+class TextCommand(DiagramCommand):
+    def __init__(self, scene, textId, oldText, text):
+        super().__init__(scene, 'Rename' if scene.itemForId(textId).getOwner() is not None else 'Edit Text')
+        self.textId = textId
+        self.oldText = oldText
+        self.text = text
+
+    def apply(self, forward):
+        self.scene.setIdText(self.textId, self.text if forward else self.oldText)
+
+    def operation(self, forward):
+        return {'op': 'text', 'id': self.textId, 'text': self.text if forward else self.oldText}
+
+    def cost(self):
+        return self.Overhead + len(self.oldText) + len(self.text)
+
+    def evict(self):
+        self.oldText = self.text = ''
+        super().evict()
+
+
+class ZOrderCommand(DiagramCommand):
+    # holds every z value the change touched, compaction included
+    def __init__(self, scene, text, ids, oldZs, zs):
+        super().__init__(scene, text)
+        self.ids = ids
+        self.oldZs = oldZs
+        self.zs = zs
+
+    def apply(self, forward):
+        self.scene.setIdZValues(self.ids, self.zs if forward else self.oldZs)
+
+    def operation(self, forward):
+        return {'op': 'zorder', 'ids': self.ids, 'zs': self.zs if forward else self.oldZs}
+
+    def cost(self):
+        return self.Overhead + arrayBytes(self.ids, self.oldZs, self.zs)
+
+    def evict(self):
+        self.ids = array('q')
+        self.oldZs = self.zs = array('d')
+        super().evict()
+
+
+class DiagramUndoStack(QUndoStack):
+    # a QUndoStack with a memory limit: past it the oldest commands drop their
+    # deltas and are discarded as soon as undo reaches them
+    DefaultMemoryLimit = 64 << 20
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.myMemoryLimit = self.DefaultMemoryLimit
+        self.myCost = 0
+        # the commands at the bottom that are already evicted
+        self.evictedCount = 0
+        self.dropping = False
+        self.indexChanged.connect(self.dropEvicted)
+
+    def memoryLimit(self):
+        return self.myMemoryLimit
+
+    def setMemoryLimit(self, limit):
+        self.myMemoryLimit = limit
+        self.evict()
+
+    def cost(self):
+        return self.myCost
+
+    def push(self, command):
+        # commands above the index are deleted by the push, the top one may absorb command
+        index = self.index()
+        top = self.command(index - 1) if index else None
+        topCost = top.cost() if top is not None else 0
+        self.myCost -= sum(self.command(i).cost() for i in range(index, self.count()))
+        super().push(command)
+        index = self.index()
+        newTop = self.command(index - 1) if index else None
+        if newTop is command:
+            self.myCost += command.cost()
+        elif newTop is top:
+            self.myCost += top.cost() - topCost
+        else:
+            self.myCost -= topCost
+        self.evict()
+
+    def clear(self):
+        super().clear()
+        self.myCost = 0
+        self.evictedCount = 0
+
+    def evict(self):
+        # the command just done is always kept
+        while self.myCost > self.myMemoryLimit and self.evictedCount < self.index() - 1:
+            command = self.command(self.evictedCount)
+            self.myCost -= command.cost()
+            command.evict()
+            self.evictedCount += 1
+
+    def dropEvicted(self, index):
+        if self.dropping:
+            return
+        self.dropping = True
+        try:
+            while self.index() and self.index() <= self.evictedCount:
+                super().undo()
+                self.evictedCount -= 1
+        finally:
+            self.dropping = False
+
+
+class JournalWriter(QThread):
+    # appends the scene's operations to a diagramjournal.Journal off the GUI
+    # thread: whatever queued up is written in one batch, and fsync runs at
+    # most once per SyncInterval, or once the queue goes quiet
+    SyncInterval = 1.
+
+    failed = pyqtSignal(str)
+
+    def __init__(self, journal, parent=None):
+        super().__init__(parent)
+        self.journal = journal
+        self.queue = queue.Queue()
+
+    def post(self, op):
+        self.queue.put(op)
+
+    def stop(self):
+        self.queue.put(None)
+        self.wait()
+
+    def run(self):
+        journal = self.journal
+        try:
+            journal.open()
+            while True:
+                try:
+                    op = self.queue.get(timeout=None if journal.synced else self.SyncInterval)
+                except queue.Empty:
+                    journal.sync()
+                    continue
+                ops = [op]
+                while True:
+                    try:
+                        ops.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stopping = None in ops
+                journal.append([op for op in ops if op is not None])
+                if stopping:
+                    journal.sync()
+                    return
+                if time.monotonic() - journal.lastSync >= self.SyncInterval:
+                    journal.sync()
+        except (OSError, ValueError) as e:
+            self.failed.emit(str(e))
+
+
 class DiagramScene(QGraphicsScene):
+    # the kinds of undo ids in a virtual diagram, id = model id*IdKinds + kind
+    IdKinds = 4
+    NodeIdKind = 0
+    LabelIdKind = 1
+    ArrowIdKind = 2
+    TextIdKind = 3
+
     class Mode(Enum):
         InsertItem = 0
         InsertLine = 1
@@ -301,7 +2074,35 @@ class DiagramScene(QGraphicsScene):
         MoveItem = 3
         DragScene = 4
 
+    class BackgroundStyle(Enum):
+        NoGrid = 0
+        BlueGrid = 1
+        WhiteGrid = 2
+        GrayGrid = 3
+
+    # (minor, major) pens, built once; every fifth grid line is a major one
+    GridPens = {
+        BackgroundStyle.BlueGrid: (gridPen(QColor(0, 255, 255, 90)), gridPen(QColor(0, 255, 255))),
+        BackgroundStyle.WhiteGrid: (gridPen(QColor(0, 0, 0, 35)), gridPen(QColor(0, 0, 0, 120))),
+        BackgroundStyle.GrayGrid: (gridPen(QColor(192, 192, 192, 110)), gridPen(QColor(192, 192, 192))),
+    }
+    GridBrush = QBrush(Qt.white)
+    MajorGridEvery = 5
+    MinGridSpacing = 8
+
+    DefaultSceneRect = QRectF(0, 0, 1000, 1000)
+    # shared by every scene, like the node shapes; items keep an id into it
+    styles = StylePalette()
+    SceneRectMargin = 500
+
+    # nodes stack within +-NodeZLimit, between arrows (-1000) and free text (1000)
+    NodeZLimit = 900.
+    ZStep = 1.
+    MinZGap = 1e-6
+    ZCompactionChunk = 1000
+
     itemInserted = pyqtSignal(DiagramItem)
+    itemsInserted = pyqtSignal(list)
     textInserted = pyqtSignal(QGraphicsTextItem)
     itemSelected = pyqtSignal(QGraphicsItem)
 
@@ -317,8 +2118,83 @@ class DiagramScene(QGraphicsScene):
         self.myTextColor = Qt.black
         self.myLineColor = Qt.black
         self.myFont = QFont()
-
-        self.typeCount = {DiagramItem.DiagramType.Step: 0, DiagramItem.DiagramType.Conditional: 0, DiagramItem.DiagramType.Io: 0}
+        self.graph = DiagramGraph()
+
+        # virtual mode: a DiagramModel holds every node and only the ones near
+        # the viewport are materialised as (recycled) Qt items
+        self.myModel = None
+        self.liveNodes = {}
+        self.liveArrows = {}
+        self.movedNodes = {}
+        self.itemPool = {diagramType: [] for diagramType in DiagramItem.DiagramType}
+        self.arrowPool = []
+        self.itemBudget = 5000
+        self.materialiseMargin = 500.
+        self.materialisedRect = QRectF()
+        self.viewportRect = QRectF()
+        self.colorCache = {}
+        self.fontCache = {}
+        self.labelPositions = {}
+
+        self.typeCount = {diagramType: 0 for diagramType in DiagramItem.DiagramType}
+        self.myGeneration = 0
+
+        # snapping while dragging; the alignment index is built once per drag
+        # from the nodes around the viewport
+        self.myGridSize = 20
+        self.mySnapToGrid = False
+        self.myAlignToItems = True
+        self.snapTolerance = 8
+        self.alignmentIndex = None
+        self.guideLines = []
+
+        # set while arrows are routed orthogonally around the nodes
+        self.router = None
+
+        # node stacking; compaction spreads drifted z values back out a chunk
+        # per event loop pass
+        self.zOrder = ZOrderIndex()
+        self.zCompaction = None
+        self.applyingZValues = False
+        # undo id: z before the change, while a z order change is recorded
+        self.zRecording = None
+        self.zCompactionTimer = QTimer(self)
+        self.zCompactionTimer.timeout.connect(self.compactZOrderStep)
+
+        self.myBackgroundStyle = DiagramScene.BackgroundStyle.NoGrid
+        # (step, rect, minor lines, major lines) of the last drawn neighbourhood
+        self.gridCache = None
+
+        # the scene rect grows as items are added or moved and is only
+        # recomputed from scratch, once per event loop pass, after deletions
+        self.contentRect = QRectF()
+        self.setSceneRect(self.DefaultSceneRect)
+        self.sceneRectTimer = QTimer(self)
+        self.sceneRectTimer.setSingleShot(True)
+        self.sceneRectTimer.timeout.connect(self.updateSceneRect)
+
+        # arrows invalidated inside a batch are recomputed once when it ends
+        self.arrowBatchDepth = 0
+        self.dirtyArrows = {}
+        self.arrowUpdatesRequested = 0
+        self.arrowUpdatesPerformed = 0
+
+        self.metrics = DiagramMetrics()
+
+        # undo history; commands refer to items by ids that survive a delete
+        # and its undo, the mapping only holds items in the scene. Virtual
+        # diagrams derive the ids of nodes, labels and arrows from the model
+        self.undoStack = DiagramUndoStack(self)
+        self.undoItems = {}
+        self.nextUndoId = 0
+        self.replaying = False
+        self.dragPos = None
+        self.dragIds = None
+        self.dragCount = 0
+
+        # autosave: the operations of the history go to a JournalWriter too
+        self.journalWriter = None
+        self.journaledStyles = 0
 
     def font(self):
         return self.myFont
@@ -333,43 +2209,875 @@ class DiagramScene(QGraphicsScene):
         return self.myLineColor
 
     def isItemChange(self, type):
-        items = self.selectedItems()
-        for item in items:
-            if item.type() == type:
-                return True
-        return False
+        return bool(self.selectedItemsOfType(type))
+
+    def selectedItemsOfType(self, type):
+        # one pass over the selection; restyling can change it, so callers take this list first
+        return [item for item in self.selectedItems() if item.type() == type]
 
     def setLineColor(self, color):
         self.myLineColor = Qt.GlobalColor(color)
-        if self.isItemChange(Arrow.Type):
-            item = self.selectedItems()[0]
-            item.setColor(self.myLineColor)
-            self.update()
+        arrows = self.selectedItemsOfType(Arrow.Type)
+        if not arrows:
+            return
+        style = self.styles.intern(self.myLineColor)
+        self.restyleItems('Line Color', arrows, [style.id]*len(arrows))
 
     def setTextColor(self, color):
         self.myTextColor = Qt.GlobalColor(color)
-        if self.isItemChange(DiagramTextItem.Type):
-            item = self.selectedItems()[0]
-            item.setDefaultTextColor(self.myTextColor)
+        items = self.selectedItemsOfType(DiagramTextItem.Type)
+        self.restyleItems('Text Color', items, [self.styles.intern(self.myTextColor, self.textStyle(item).font).id for item in items])
 
     def setItemColor(self, color):
         self.myItemColor = Qt.GlobalColor(color)
-        if self.isItemChange(DiagramItem.Type):
-            item = self.selectedItems()[0]
-            item.setBrush(self.myItemColor)
+        items = self.selectedItemsOfType(DiagramItem.Type)
+        self.restyleItems('Fill Color', items, [self.styles.intern(self.myItemColor).id]*len(items))
 
     def setFont(self, font):
         self.myFont = font
+        items = self.selectedItemsOfType(DiagramTextItem.Type)
+        self.restyleItems('Font', items, [self.styles.intern(self.textStyle(item).color, font).id for item in items])
+
+    def restyleItems(self, text, items, styleIds):
+        # selecting text syncs the font controls, which set the same font again
+        changes = [(item, styleId) for item, styleId in zip(items, styleIds) if item.styleId() != styleId]
+        if not changes:
+            return
+        items = [item for item, styleId in changes]
+        styleIds = array('l', (styleId for item, styleId in changes))
+        if self.recordsHistory():
+            oldStyleIds = array('l', (item.styleId() for item in items))
+            self.applyStyles(items, styleIds)
+            self.undoStack.push(StyleCommand(self, text, array('q', map(self.undoId, items)), oldStyleIds, styleIds))
+        else:
+            self.applyStyles(items, styleIds)
+
+    def applyStyles(self, items, styleIds):
+        # node and text updates only mark the items dirty, the scene repaints
+        # them together on the next pass; arrows are repainted as one rect
+        rect = QRectF()
+        for item, styleId in zip(items, styleIds):
+            if item is None:
+                continue
+            item.setStyle(self.styles.style(styleId))
+            if item.type() == Arrow.Type:
+                rect |= item.sceneBoundingRect()
+        if not rect.isNull():
+            self.update(rect)
 
-        if self.isItemChange(DiagramTextItem.Type):
-            item = self.selectedItems()[0]
-            #At this point the selection can change so the first selected item might not be a DiagramTextItem
-            if item is not None and isinstance(item, DiagramTextItem):
-                item.setFont(self.myFont)
+    def textStyle(self, textItem):
+        styleId = textItem.styleId()
+        if styleId is None:
+            return self.styles.intern(textItem.defaultTextColor(), textItem.font())
+        return self.styles.style(styleId)
 
     def setMode(self, mode):
         self.myMode = mode
 
+    def beginArrowBatch(self):
+        self.arrowBatchDepth += 1
+
+    def endArrowBatch(self):
+        self.arrowBatchDepth -= 1
+        if self.arrowBatchDepth == 0:
+            self.flushArrowUpdates()
+
+    def scheduleArrowUpdate(self, arrow):
+        self.arrowUpdatesRequested += 1
+        if self.arrowBatchDepth == 0:
+            arrow.updatePosition()
+            self.arrowUpdatesPerformed += 1
+        else:
+            arrow.invalidateGeometry()
+            self.dirtyArrows[arrow] = None
+
+    def flushArrowUpdates(self):
+        dirtyArrows = self.dirtyArrows
+        self.dirtyArrows = {}
+        for arrow in dirtyArrows:
+            if arrow.scene() is self:
+                arrow.updateGeometry()
+        self.arrowUpdatesPerformed += len(dirtyArrows)
+
+    def arrowUpdateStats(self):
+        return {'requested': self.arrowUpdatesRequested,
+                'performed': self.arrowUpdatesPerformed,
+                'saved': self.arrowUpdatesRequested - self.arrowUpdatesPerformed}
+
+    def resetArrowUpdateStats(self):
+        self.arrowUpdatesRequested = 0
+        self.arrowUpdatesPerformed = 0
+
+    def indexRebuilt(self):
+        # restoring the BSP index or changing the scene rect rebuilds the whole tree
+        if self.itemIndexMethod() == QGraphicsScene.BspTreeIndex:
+            self.metrics.indexRebuilds += 1
+
+    def gridSize(self):
+        return self.myGridSize
+
+    def setGridSize(self, size):
+        self.myGridSize = max(1, int(size))
+
+    def snapsToGrid(self):
+        return self.mySnapToGrid
+
+    def setSnapToGrid(self, enabled):
+        self.mySnapToGrid = enabled
+
+    def alignsToItems(self):
+        return self.myAlignToItems
+
+    def setAlignToItems(self, enabled):
+        self.myAlignToItems = enabled
+        if not enabled:
+            self.setGuideLines([])
+
+    def backgroundStyle(self):
+        return self.myBackgroundStyle
+
+    def setBackgroundStyle(self, style):
+        if style == self.myBackgroundStyle:
+            return
+        self.myBackgroundStyle = style
+        for view in self.views():
+            view.resetCachedContent()
+        self.update()
+
+    def gridStep(self, lod):
+        # coarsen by the major factor until lines are at least MinGridSpacing pixels apart
+        step = self.myGridSize
+        while step*lod < self.MinGridSpacing:
+            step *= self.MajorGridEvery
+        return step
+
+    def gridLines(self, rect, step):
+        cache = self.gridCache
+        if cache is not None and cache[0] == step and cache[1].contains(rect):
+            return cache[2], cache[3]
+        # build lines for the exposed rect and a band around it, so scrolling
+        # reuses them until the view leaves the band
+        major = step*self.MajorGridEvery
+        band = rect.adjusted(-rect.width(), -rect.height(), rect.width(), rect.height())
+        left = math.floor(band.left()/major)*major
+        top = math.floor(band.top()/major)*major
+        right = math.ceil(band.right()/major)*major
+        bottom = math.ceil(band.bottom()/major)*major
+        minorLines = []
+        majorLines = []
+        columns = int(round((right - left)/step))
+        rows = int(round((bottom - top)/step))
+        for i in range(columns + 1):
+            x = left + i*step
+            (majorLines if i % self.MajorGridEvery == 0 else minorLines).append(QLineF(x, top, x, bottom))
+        for i in range(rows + 1):
+            y = top + i*step
+            (majorLines if i % self.MajorGridEvery == 0 else minorLines).append(QLineF(left, y, right, y))
+        self.gridCache = (step, QRectF(QPointF(left, top), QPointF(right, bottom)), minorLines, majorLines)
+        return minorLines, majorLines
+
+    def drawBackground(self, painter, rect):
+        pens = self.GridPens.get(self.myBackgroundStyle)
+        if pens is None:
+            super().drawBackground(painter, rect)
+            return
+        painter.fillRect(rect, self.GridBrush)
+        lod = QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        minorLines, majorLines = self.gridLines(rect, self.gridStep(lod))
+        painter.setPen(pens[0])
+        painter.drawLines(minorLines)
+        painter.setPen(pens[1])
+        painter.drawLines(majorLines)
+
+    def setJournal(self, writer):
+        if self.journalWriter is not None:
+            self.journalWriter.stop()
+        self.journalWriter = writer
+        self.journaledStyles = 0
+        if writer is not None:
+            self.resetJournal()
+
+    def journal(self, op):
+        # styles are defined in the journal before an operation can use them
+        if len(self.styles) > self.journaledStyles:
+            styles = [[style.id, style.color.rgba(), None if style.font is None else style.font.toString()]
+                        for style in self.styles.styles[self.journaledStyles:]]
+            self.journaledStyles = len(self.styles)
+            self.journalWriter.post({'op': 'styles', 'styles': styles})
+        self.journalWriter.post(op)
+
+    def journalCommand(self, command, forward):
+        if self.journalWriter is not None:
+            self.journal(command.operation(forward))
+
+    def resetJournal(self):
+        # the whole scene as the journal's new starting point; a virtual
+        # diagram is written from its model, released nodes included
+        if self.journalWriter is None:
+            return
+        if self.myModel is None:
+            records = DiagramItemRecords()
+            records.add(self, [item for item in self.items() if item.type() == DiagramItem.Type or 
+                                item.type() == Arrow.Type or 
+                                (item.type() == DiagramTextItem.Type and item.getOwner() is None)])
+        else:
+            self.syncModel()
+            records = DiagramItemRecords.fromModel(self)
+            records.add(self, [item for item in self.items() 
+                                if item.type() == DiagramTextItem.Type and item.getOwner() is None])
+        self.journal(dict(records.columns(), op='reset'))
+
+    def restoreJournal(self, state):
+        # a diagram as large as the ones opened virtually is recovered into a model
+        if len(state.nodes) > VIRTUAL_NODE_THRESHOLD:
+            self.setModel(DiagramModel.fromJournal(state))
+            return
+        styleIds = {}
+        for styleId, (argb, font) in state.styles.items():
+            if font is not None:
+                fontString = font
+                font = QFont()
+                font.fromString(fontString)
+            styleIds[styleId] = self.styles.intern(QColor.fromRgba(argb), font).id
+        records = DiagramItemRecords.fromJournal(state, styleIds)
+        self.clearDiagram()
+        self.restoreItems(records)
+        ids = [state.nodes, state.texts, state.arrows]
+        self.nextUndoId = max(self.nextUndoId, max((max(items, default=-1) for items in ids)) + 1)
+
+    def recordsHistory(self):
+        return not self.replaying
+
+    def modelUndoId(self, modelId, kind):
+        return modelId*self.IdKinds + kind
+
+    def undoId(self, item):
+        # the items of a virtual diagram come and go with the viewport, their
+        # ids come from the model; free text is numbered as everywhere else
+        if self.myModel is not None:
+            if item.type() == DiagramItem.Type and item.modelId is not None:
+                return self.modelUndoId(item.modelId, self.NodeIdKind)
+            if item.type() == Arrow.Type and item.modelId is not None:
+                return self.modelUndoId(item.modelId, self.ArrowIdKind)
+            if item.type() == DiagramTextItem.Type and item.getOwner() is not None and item.getOwner().modelId is not None:
+                return self.modelUndoId(item.getOwner().modelId, self.LabelIdKind)
+        if item.undoId is None:
+            item.undoId = self.nextUndoId if self.myModel is None else self.modelUndoId(self.nextUndoId, self.TextIdKind)
+            self.nextUndoId += 1
+        if item.scene() is self:
+            self.undoItems[item.undoId] = item
+        return item.undoId
+
+    def itemForId(self, itemId):
+        if self.myModel is not None:
+            modelId, kind = divmod(itemId, self.IdKinds)
+            if kind == self.NodeIdKind:
+                return self.liveNodes.get(modelId)
+            if kind == self.LabelIdKind:
+                item = self.liveNodes.get(modelId)
+                return None if item is None else item.getTextItem()
+            if kind == self.ArrowIdKind:
+                return self.liveArrows.get(modelId)
+        return self.undoItems.get(itemId)
+
+    def registerUndoId(self, item, undoId):
+        item.undoId = undoId
+        self.undoItems[undoId] = item
+
+    def itemsForIds(self, ids):
+        return [item for item in map(self.itemForId, ids) if item is not None]
+
+    def partitionIds(self, ids, values=None):
+        # the live items of ids with their values, and for a virtual diagram
+        # the released nodes, labels and arrows as (model id, kind, value)
+        live = []
+        released = []
+        model = self.myModel
+        for itemId, value in zip(ids, values if values is not None else itertools.repeat(None)):
+            item = self.itemForId(itemId)
+            if item is not None:
+                live.append((item, value))
+            elif model is not None:
+                modelId, kind = divmod(itemId, self.IdKinds)
+                if kind == self.ArrowIdKind and model.isEdge(modelId) or \
+                        (kind == self.NodeIdKind or kind == self.LabelIdKind) and model.isNode(modelId):
+                    released.append((modelId, kind, value))
+        return live, released
+
+    def refreshViewport(self):
+        # the model changed under the view, materialise it again
+        self.materialisedRect = QRectF()
+        if not self.viewportRect.isNull():
+            self.updateViewport(self.viewportRect)
+
+    def removeIds(self, ids):
+        live, released = self.partitionIds(ids)
+        model = self.myModel
+        for modelId, kind, _ in released:
+            if kind == self.NodeIdKind:
+                model.removeNode(modelId)
+            elif kind == self.ArrowIdKind:
+                model.removeEdge(modelId)
+        self.deleteItems([item for item, _ in live])
+
+    def translateIds(self, ids, dx, dy):
+        live, released = self.partitionIds(ids)
+        self.translateItems([item for item, _ in live], dx, dy)
+        model = self.myModel
+        for modelId, kind, _ in released:
+            if kind == self.NodeIdKind:
+                model.moveNode(modelId, model.xs[modelId] + dx, model.ys[modelId] + dy)
+            elif kind == self.LabelIdKind:
+                model.labelXs[modelId] += dx
+                model.labelYs[modelId] += dy
+        if released:
+            self.refreshViewport()
+
+    def moveIdsTo(self, ids, xs, ys):
+        live, released = self.partitionIds(ids, zip(xs, ys))
+        self.moveItemsTo([item for item, _ in live], [x for _, (x, y) in live], [y for _, (x, y) in live])
+        model = self.myModel
+        for modelId, kind, (x, y) in released:
+            if kind == self.NodeIdKind:
+                model.moveNode(modelId, x, y)
+            elif kind == self.LabelIdKind:
+                model.labelXs[modelId] = x
+                model.labelYs[modelId] = y
+        if released:
+            self.refreshViewport()
+
+    def applyIdStyles(self, ids, styleIds):
+        live, released = self.partitionIds(ids, styleIds)
+        self.applyStyles([item for item, _ in live], [styleId for _, styleId in live])
+        model = self.myModel
+        for modelId, kind, styleId in released:
+            style = self.styles.style(styleId)
+            if kind == self.NodeIdKind:
+                model.colors[modelId] = style.color.rgba()
+            elif kind == self.LabelIdKind:
+                model.textColors[modelId] = style.color.rgba()
+                model.nodeFonts[modelId] = model.fontId(style.font.toString())
+            else:
+                model.edgeColors[modelId] = style.color.rgba()
+
+    def setIdText(self, textId, text):
+        live, released = self.partitionIds([textId])
+        for textItem, _ in live:
+            self.setItemText(textItem, text)
+        for modelId, kind, _ in released:
+            if kind == self.LabelIdKind:
+                self.myModel.names[modelId] = text
+
+    def setIdZValues(self, ids, zs):
+        # the command covers any compaction still running
+        self.cancelZCompaction()
+        live, released = self.partitionIds(ids, zs)
+        self.setZValues(live)
+        released = [(modelId, z) for modelId, kind, z in released if kind == self.NodeIdKind]
+        if released:
+            self.myModel.setZValues([modelId for modelId, z in released], [z for modelId, z in released])
+
+    def idZValue(self, itemId):
+        item = self.itemForId(itemId)
+        return item.zValue() if item is not None else self.myModel.zs[itemId//self.IdKinds]
+
+    def recordItems(self, text, items, inserted=True):
+        if not self.recordsHistory():
+            return
+        records = DiagramItemRecords()
+        records.add(self, items)
+        if len(records):
+            self.undoStack.push(ItemsCommand(self, text, records, inserted))
+
+    def deleteSelection(self):
+        if not self.recordsHistory():
+            return self.deleteItems(self.selectedItems())
+        records = DiagramItemRecords()
+        removedItems = self.deleteItems(self.selectedItems(), records)
+        if removedItems:
+            self.undoStack.push(ItemsCommand(self, 'Delete', records, False))
+        return removedItems
+
+    def restoreItems(self, records):
+        # one arrow batch and one index rebuild for the whole insert
+        self.beginArrowBatch()
+        indexMethod = self.itemIndexMethod()
+        self.setItemIndexMethod(QGraphicsScene.NoIndex)
+        try:
+            records.restore(self)
+        finally:
+            self.endArrowBatch()
+            self.setItemIndexMethod(indexMethod)
+            self.indexRebuilt()
+
+    def translateItems(self, items, dx, dy):
+        self.beginArrowBatch()
+        try:
+            for item in items:
+                item.moveBy(dx, dy)
+        finally:
+            self.endArrowBatch()
+
+    def moveItemsTo(self, items, xs, ys):
+        # one arrow batch and one index rebuild for the whole move
+        self.beginArrowBatch()
+        indexMethod = self.itemIndexMethod()
+        self.setItemIndexMethod(QGraphicsScene.NoIndex)
+        try:
+            for item, x, y in zip(items, xs, ys):
+                if item is not None and item.scene() is self:
+                    item.setPos(x, y)
+        finally:
+            self.endArrowBatch()
+            self.setItemIndexMethod(indexMethod)
+            self.indexRebuilt()
+        self.updateSceneRect()
+
+    def setItemText(self, textItem, text):
+        textItem.setPlainText(text)
+        textItem.setEditText(text)
+        if textItem.getOwner() is not None:
+            textItem.getOwner().setMyName(text)
+
+    def recordDrag(self, grabber):
+        # every move event of a drag is pushed, the stack merges them into one command
+        if self.dragPos is None or not self.recordsHistory():
+            return
+        pos = grabber.scenePos()
+        dx = pos.x() - self.dragPos.x()
+        dy = pos.y() - self.dragPos.y()
+        if not dx and not dy:
+            return
+        if self.dragIds is None:
+            self.dragIds = array('q', map(self.undoId, self.movingItems(grabber)))
+        self.dragPos = pos
+        self.undoStack.push(TranslateCommand(self, self.dragIds, dx, dy, self.dragCount))
+
+    def noteZValueChanged(self, item):
+        self.zOrder.move(item, item.zValue())
+        # a plan made before this change would undo it; the rest of the plan
+        # runs now, the history already counts on its end state
+        if not self.applyingZValues and self.zCompaction is not None:
+            plan = self.zCompaction
+            self.cancelZCompaction()
+            self.setZValues([(other, z) for other, z in plan if other is not item])
+
+    def setZValues(self, changes):
+        recording = self.zRecording
+        self.applyingZValues = True
+        try:
+            for item, z in changes:
+                if recording is not None:
+                    recording.setdefault(self.undoId(item), item.zValue())
+                item.setZValue(z)
+        finally:
+            self.applyingZValues = False
+
+    def beginZRecording(self):
+        # the end state of a pending compaction is part of the last command
+        self.finishZCompaction()
+        if self.recordsHistory():
+            self.zRecording = {}
+
+    def endZRecording(self, text):
+        oldZs = self.zRecording
+        self.zRecording = None
+        if not oldZs:
+            return
+        # a compaction the change scheduled belongs to it
+        planned = {}
+        for item, z in self.zCompaction or ():
+            itemId = self.undoId(item)
+            oldZs.setdefault(itemId, item.zValue())
+            planned[itemId] = z
+        changes = [(itemId, oldZ, planned[itemId] if itemId in planned else self.idZValue(itemId)) 
+                    for itemId, oldZ in oldZs.items()]
+        changes = [change for change in changes if change[1] != change[2]]
+        if changes:
+            self.undoStack.push(ZOrderCommand(self, text, array('q', (change[0] for change in changes)), 
+                                                array('d', (change[1] for change in changes)), 
+                                                array('d', (change[2] for change in changes))))
+
+    def zCompactionPlan(self):
+        # evenly spaced below 0, where new nodes are added, in the current order
+        items = self.zOrder.items()
+        spacing = self.NodeZLimit/2/max(1, len(items))
+        targets = [(item, -self.NodeZLimit/2 + i*spacing) for i, item in enumerate(items)]
+        # lowered nodes bottom up, then raised nodes top down: every
+        # intermediate state keeps the order, so the plan can be spread out
+        return [(item, z) for item, z in targets if z < item.zValue()] + \
+                [(item, z) for item, z in reversed(targets) if z > item.zValue()]
+
+    def compactZOrder(self):
+        self.cancelZCompaction()
+        if self.myModel is not None:
+            self.compactModelZOrder()
+        else:
+            self.setZValues(self.zCompactionPlan())
+
+    def compactModelZOrder(self):
+        # released nodes only have a z in the model, so the whole model is renumbered at once
+        self.syncModel()
+        model = self.myModel
+        if self.zRecording is not None:
+            for nodeId in model.nodeIds():
+                self.zRecording.setdefault(self.modelUndoId(nodeId, self.NodeIdKind), model.zs[nodeId])
+        liveKeys = {nodeId: self.zOrder.key(item) for nodeId, item in self.liveNodes.items() if item in self.zOrder}
+        nodeIds = sorted(model.nodeIds(), key=lambda nodeId: (model.zs[nodeId], liveKeys.get(nodeId, (0, -1))[1], nodeId))
+        spacing = self.NodeZLimit/2/max(1, len(nodeIds))
+        zs = [-self.NodeZLimit/2 + i*spacing for i in range(len(nodeIds))]
+        model.setZValues(nodeIds, zs)
+        changes = []
+        for nodeId, z in zip(nodeIds, zs):
+            item = self.liveNodes.get(nodeId)
+            if item is not None:
+                changes.append((item, z))
+        # live items change in the order that keeps every intermediate state sorted
+        changes.sort(key=lambda change: self.zOrder.key(change[0]))
+        self.setZValues([change for change in changes if change[1] < change[0].zValue()] +
+                        [change for change in reversed(changes) if change[1] > change[0].zValue()])
+
+    def scheduleZCompaction(self):
+        # in the background once the stack drifts towards the arrow and text bands
+        top = self.zOrder.top()
+        if top is None or self.zCompaction is not None or self.myModel is not None:
+            return
+        if top > self.NodeZLimit*0.75 or self.zOrder.bottom() < -self.NodeZLimit*0.75:
+            self.zCompaction = deque(self.zCompactionPlan())
+            self.zCompactionTimer.start(0)
+
+    def cancelZCompaction(self):
+        self.zCompaction = None
+        self.zCompactionTimer.stop()
+
+    def finishZCompaction(self):
+        plan = self.zCompaction
+        self.cancelZCompaction()
+        if plan:
+            self.setZValues(plan)
+
+    def compactZOrderStep(self):
+        plan = self.zCompaction
+        if plan is None:
+            self.zCompactionTimer.stop()
+            return
+        # from the front: only prefixes of the plan keep the stacking order
+        self.setZValues([plan.popleft() for _ in range(min(self.ZCompactionChunk, len(plan)))])
+        if not plan:
+            self.cancelZCompaction()
+
+    def zRange(self):
+        top, bottom = self.zOrder.top(), self.zOrder.bottom()
+        if self.myModel is not None and self.myModel.nodeCount():
+            # released nodes stack too
+            modelTop, modelBottom = self.myModel.zRange()
+            top = modelTop if top is None else max(top, modelTop)
+            bottom = modelBottom if bottom is None else min(bottom, modelBottom)
+        return top, bottom
+
+    def stackedNodes(self, items):
+        return self.zOrder.ordered(item for item in items if isinstance(item, DiagramItem))
+
+    def bringToFront(self, items):
+        nodes = self.stackedNodes(items)
+        if not nodes:
+            return
+        self.beginZRecording()
+        try:
+            top = self.zRange()[0]
+            if top + self.ZStep*len(nodes) > self.NodeZLimit:
+                self.compactZOrder()
+                top = self.zRange()[0]
+            step = min(self.ZStep, (self.NodeZLimit - top)/(len(nodes) + 1))
+            self.setZValues((node, top + step*(i + 1)) for i, node in enumerate(nodes))
+            self.scheduleZCompaction()
+        finally:
+            self.endZRecording('Bring to Front')
+
+    def sendToBack(self, items):
+        nodes = self.stackedNodes(items)
+        if not nodes:
+            return
+        self.beginZRecording()
+        try:
+            bottom = self.zRange()[1]
+            if bottom - self.ZStep*len(nodes) < -self.NodeZLimit:
+                self.compactZOrder()
+                bottom = self.zRange()[1]
+            step = min(self.ZStep, (bottom + self.NodeZLimit)/(len(nodes) + 1))
+            self.setZValues((node, bottom - step*(len(nodes) - i)) for i, node in enumerate(nodes))
+            self.scheduleZCompaction()
+        finally:
+            self.endZRecording('Send to Back')
+
+    def overlappingNodes(self, item, exclude):
+        return [other for other in self.items(item.sceneBoundingRect(), Qt.IntersectsItemBoundingRect)
+                if isinstance(other, DiagramItem) and other not in exclude and other in self.zOrder]
+
+    def raiseItems(self, items):
+        # each node moves just above the lowest overlapping node that covers it
+        nodes = self.stackedNodes(items)
+        selected = set(nodes)
+        self.beginZRecording()
+        try:
+            for node in reversed(nodes):
+                key = self.zOrder.key(node)
+                above = [other for other in self.overlappingNodes(node, selected) if self.zOrder.key(other) > key]
+                if not above:
+                    continue
+                target = min(above, key=self.zOrder.key)
+                z = self.zBetween(target, self.zOrder.zAbove, self.ZStep)
+                if z is None:
+                    self.compactZOrder()
+                    z = self.zBetween(target, self.zOrder.zAbove, self.ZStep)
+                self.setZValues([(node, z)])
+            self.scheduleZCompaction()
+        finally:
+            self.endZRecording('Raise')
+
+    def lowerItems(self, items):
+        nodes = self.stackedNodes(items)
+        selected = set(nodes)
+        self.beginZRecording()
+        try:
+            for node in nodes:
+                key = self.zOrder.key(node)
+                below = [other for other in self.overlappingNodes(node, selected) if self.zOrder.key(other) < key]
+                if not below:
+                    continue
+                target = max(below, key=self.zOrder.key)
+                z = self.zBetween(target, self.zOrder.zBelow, -self.ZStep)
+                if z is None:
+                    self.compactZOrder()
+                    z = self.zBetween(target, self.zOrder.zBelow, -self.ZStep)
+                self.setZValues([(node, z)])
+            self.scheduleZCompaction()
+        finally:
+            self.endZRecording('Lower')
+
+    def zBetween(self, target, neighbour, step):
+        # halfway between target and its neighbour in the stack, None when
+        # they are too close or equal and only compaction can make room
+        z = target.zValue()
+        other = neighbour(target)
+        if other is None:
+            other = max(-self.NodeZLimit, min(self.NodeZLimit, z + 2*step))
+        if abs(other - z) < 2*self.MinZGap:
+            return None
+        return (z + other)/2
+
+    def orthogonalArrows(self):
+        return self.router is not None
+
+    def setOrthogonalArrows(self, enabled):
+        if enabled == (self.router is not None):
+            return
+        if enabled:
+            self.router = ArrowRouter(self)
+        else:
+            self.router.clear()
+            self.router = None
+        # straight arrows drop their routes, orthogonal ones get a provisional
+        # route now and are queued for the router
+        self.beginArrowBatch()
+        try:
+            for arrow in self.graph.edges():
+                arrow.myRoute = None
+                self.scheduleArrowUpdate(arrow)
+        finally:
+            self.endArrowBatch()
+
+    def layoutInput(self):
+        # a snapshot for diagramlayout.layeredLayout(); nodes are model ids in
+        # virtual mode and DiagramItems otherwise
+        if self.myModel is not None:
+            self.syncModel()
+            model = self.myModel
+            nodes = model.nodeIds()
+            types = [model.types[nodeId] for nodeId in nodes]
+            xs = [model.xs[nodeId] for nodeId in nodes]
+            index = {nodeId: i for i, nodeId in enumerate(nodes)}
+            edges = [(index[model.edgeStarts[edgeId]], index[model.edgeEnds[edgeId]]) 
+                        for edgeId in range(len(model.edgeAlive)) if model.edgeAlive[edgeId]]
+        else:
+            nodes = self.graph.nodes()
+            types = [node.diagramType().value for node in nodes]
+            xs = [node.x() for node in nodes]
+            index = {node: i for i, node in enumerate(nodes)}
+            edges = [(index[arrow.startItem()], index[arrow.endItem()]) for arrow in self.graph.edges()]
+        sizes = {diagramType.value: DiagramItem.shapePolygon(diagramType).boundingRect().size() 
+                    for diagramType in DiagramItem.DiagramType}
+        # terminals start and end the flow, diamonds get the room their shape needs
+        terminals = [diagramType == DiagramItem.DiagramType.StartEnd.value for diagramType in types]
+        arguments = {'widths': [sizes[diagramType].width() for diagramType in types],
+                        'heights': [sizes[diagramType].height() for diagramType in types],
+                        'starts': [start for start, _ in edges], 'ends': [end for _, end in edges],
+                        'pinFirst': terminals, 'pinLast': terminals, 'initialXs': xs}
+        return nodes, arguments
+
+    def applyLayout(self, nodes, xs, ys):
+        # layout coordinates are shape centres, StartEnd is not drawn around its origin
+        centres = {diagramType: DiagramItem.shapePolygon(diagramType).boundingRect().center() 
+                    for diagramType in DiagramItem.DiagramType}
+        model = self.myModel
+        if model is None:
+            targets = [(item, x - centres[item.diagramType()].x(), y - centres[item.diagramType()].y()) 
+                        for item, x, y in zip(nodes, xs, ys) if item.scene() is self]
+            items = [item for item, x, y in targets]
+            newXs = array('d', (x for item, x, y in targets))
+            newYs = array('d', (y for item, x, y in targets))
+            self.moveLaidOutItems(items, newXs, newYs)
+            return
+
+        # one arrow batch and one index rebuild for the whole move
+        records = self.recordsHistory()
+        ids = array('q')
+        oldXs = array('d')
+        oldYs = array('d')
+        newXs = array('d')
+        newYs = array('d')
+        self.beginArrowBatch()
+        indexMethod = self.itemIndexMethod()
+        self.setItemIndexMethod(QGraphicsScene.NoIndex)
+        try:
+            for nodeId, x, y in zip(nodes, xs, ys):
+                if not model.isNode(nodeId):
+                    continue
+                centre = centres[DiagramItem.DiagramType(model.types[nodeId])]
+                x -= centre.x()
+                y -= centre.y()
+                item = self.liveNodes.get(nodeId)
+                if records:
+                    ids.append(self.modelUndoId(nodeId, self.NodeIdKind))
+                    oldXs.append(item.pos().x() if item is not None else model.xs[nodeId])
+                    oldYs.append(item.pos().y() if item is not None else model.ys[nodeId])
+                    newXs.append(x)
+                    newYs.append(y)
+                if item is not None:
+                    item.setPos(x, y)
+                else:
+                    model.moveNode(nodeId, x, y)
+            self.materialisedRect = QRectF()
+        finally:
+            self.endArrowBatch()
+            self.setItemIndexMethod(indexMethod)
+            self.indexRebuilt()
+        self.updateSceneRect()
+        if ids:
+            self.undoStack.push(MoveCommand(self, 'Auto Layout', ids, oldXs, oldYs, newXs, newYs))
+
+    def moveLaidOutItems(self, items, newXs, newYs):
+        if self.recordsHistory():
+            oldXs = array('d', (item.pos().x() for item in items))
+            oldYs = array('d', (item.pos().y() for item in items))
+            self.moveItemsTo(items, newXs, newYs)
+            self.undoStack.push(MoveCommand(self, 'Auto Layout', array('q', map(self.undoId, items)), oldXs, oldYs, newXs, newYs))
+        else:
+            self.moveItemsTo(items, newXs, newYs)
+
+    def includeInSceneRect(self, rect):
+        if self.contentRect.contains(rect):
+            return
+        self.contentRect = self.contentRect.united(rect)
+        if self.sceneRect().contains(rect):
+            return
+        # overshoot by a quarter of the content size, so a diagram that keeps
+        # growing only resizes the scene a logarithmic number of times
+        bounds = self.contentRect
+        margin = max(self.SceneRectMargin, max(bounds.width(), bounds.height())/4)
+        self.setSceneRect(bounds.adjusted(-margin, -margin, margin, margin))
+        self.indexRebuilt()
+
+    def contentsBoundingRect(self):
+        bounds = self.itemsBoundingRect()
+        if self.myModel is not None:
+            bounds = bounds.united(self.myModel.boundingRect())
+        return bounds
+
+    def scheduleSceneRectUpdate(self):
+        self.sceneRectTimer.start(0)
+
+    def updateSceneRect(self):
+        self.sceneRectTimer.stop()
+        bounds = self.contentsBoundingRect()
+        self.contentRect = bounds
+        if bounds.isNull():
+            self.setSceneRect(self.DefaultSceneRect)
+        else:
+            margin = self.SceneRectMargin
+            self.setSceneRect(bounds.adjusted(-margin, -margin, margin, margin))
+        self.indexRebuilt()
+
+    def viewScale(self):
+        views = self.views()
+        return views[-1].transform().m11() if views else 1.
+
+    def buildAlignmentIndex(self, exclude):
+        views = self.views()
+        if views:
+            view = views[-1]
+            rect = view.mapToScene(view.viewport().rect()).boundingRect()
+            items = self.items(rect)
+        else:
+            items = self.items()
+        self.alignmentIndex = AlignmentIndex(item.sceneBoundingRect() for item in items
+                                             if isinstance(item, DiagramItem) and item not in exclude)
+
+    def setGuideLines(self, lines):
+        dirty = QRectF()
+        for line in self.guideLines + lines:
+            dirty = dirty.united(QRectF(line.p1(), line.p2()).normalized())
+        self.guideLines = lines
+        if not dirty.isNull():
+            # guides are cosmetic lines, so pad by a couple of pixels at any zoom
+            margin = 2/self.viewScale()
+            self.update(dirty.adjusted(-margin, -margin, margin, margin))
+
+    def snapMovingItems(self, grabber):
+        # Qt has already moved the selection by the mouse delta; shift it
+        # again so the grabbed node lands on a guide or grid point
+        rect = grabber.sceneBoundingRect()
+        tolerance = self.snapTolerance/self.viewScale()
+        dx = dy = None
+        lines = []
+        index = self.alignmentIndex
+        if self.myAlignToItems and index is not None and not index.isEmpty():
+            match = index.nearestX(rect, tolerance)
+            if match is not None:
+                dx, x, other = match
+                lines.append(QLineF(x, min(rect.top(), other.top()), x, max(rect.bottom(), other.bottom())))
+            match = index.nearestY(rect, tolerance)
+            if match is not None:
+                dy, y, other = match
+                lines.append(QLineF(min(rect.left(), other.left()), y, max(rect.right(), other.right()), y))
+        if self.mySnapToGrid:
+            pos = grabber.scenePos()
+            grid = self.myGridSize
+            if dx is None:
+                dx = round(pos.x()/grid)*grid - pos.x()
+            if dy is None:
+                dy = round(pos.y()/grid)*grid - pos.y()
+        self.setGuideLines(lines)
+        if not dx and not dy:
+            return
+        for item in self.movingItems(grabber):
+            item.moveBy(dx or 0., dy or 0.)
+
+    def movingItems(self, grabber):
+        # the items a drag moves; children of selected items follow their parent
+        items = [item for item in self.selectedItems() if item.flags() & QGraphicsItem.ItemIsMovable]
+        if grabber not in items:
+            items.append(grabber)
+        return [item for item in items if item.parentItem() is None or not item.parentItem().isSelected()]
+
+    def drawForeground(self, painter, rect):
+        super().drawForeground(painter, rect)
+        if self.guideLines:
+            pen = QPen(QColor(0, 120, 215), 0, Qt.DashLine)
+            pen.setCosmetic(True)
+            painter.setPen(pen)
+            painter.drawLines(self.guideLines)
+
     def setItemType(self, type):
         self.myItemType = type
 
@@ -378,36 +3086,418 @@ class DiagramScene(QGraphicsScene):
         cursor.clearSelection()
         item.setTextCursor(cursor)
 
+        text = item.toPlainText()
         if item.getOwner() is None:
-            if len(item.toPlainText()) == 0:
-                self.removeItem(item)
+            # free text that had no text when editing began is new
+            previous = item.editText() or ''
+            item.setEditText(text)
+            if len(text) == 0:
+                if previous and self.recordsHistory():
+                    item.setPlainText(previous)
+                    records = DiagramItemRecords()
+                    self.deleteItems([item], records)
+                    self.undoStack.push(ItemsCommand(self, 'Delete', records, False))
+                else:
+                    self.removeItem(item)
+            elif not previous:
+                self.recordItems('Insert Text', [item])
+            elif text != previous and self.recordsHistory():
+                self.undoStack.push(TextCommand(self, self.undoId(item), previous, text))
         else:
             ownerItem = item.getOwner()
-            if len(item.toPlainText()) == 0:
-                item.setPlainText(ownerItem.getMyName())
+            previous = ownerItem.getMyName()
+            if len(text) == 0:
+                item.setPlainText(previous)
+            elif text != previous:
+                ownerItem.setMyName(text)
+                if self.recordsHistory():
+                    self.undoStack.push(TextCommand(self, self.undoId(item), previous, text))
+
+    def generation(self):
+        return self.myGeneration
+
+    def clearDiagram(self):
+        # work started on the old diagram checks this before touching the scene
+        self.myGeneration += 1
+        self.clear()
+        self.graph.clear()
+        self.zOrder.clear()
+        self.cancelZCompaction()
+        self.dirtyArrows = {}
+        self.line = None
+        self.textItem = None
+        self.myModel = None
+        self.liveNodes = {}
+        self.liveArrows = {}
+        self.movedNodes = {}
+        self.itemPool = {diagramType: [] for diagramType in DiagramItem.DiagramType}
+        self.arrowPool = []
+        self.materialisedRect = QRectF()
+        self.viewportRect = QRectF()
+        self.fontCache = {}
+        self.typeCount = {diagramType: 0 for diagramType in DiagramItem.DiagramType}
+        self.sceneRectTimer.stop()
+        self.contentRect = QRectF()
+        self.setSceneRect(self.DefaultSceneRect)
+        if self.router is not None:
+            self.router.clear()
+        self.undoStack.clear()
+        self.undoItems = {}
+        self.dragPos = None
+        self.resetJournal()
+
+    def addArrows(self, edges):
+        arrows = []
+        for edge in edges:
+            arrow = self.addArrow(*edge)
+            if arrow is not None:
+                arrows.append(arrow)
+        return arrows
+
+    def addArrow(self, startItem, endItem, color=None):
+        if self.graph.hasEdge(startItem, endItem):
+            return None
+        arrow = Arrow(startItem, endItem)
+        arrow.setStyle(self.styles.intern(self.myLineColor if color is None else color))
+        arrow.setZValue(-1000.)
+        self.graph.addEdge(arrow)
+        self.addItem(arrow)
+        arrow.updatePosition()
+        if self.myModel is not None and startItem.modelId is not None and endItem.modelId is not None:
+            arrow.modelId = self.myModel.addEdge(startItem.modelId, endItem.modelId, arrow.color().rgba())
+            self.liveArrows[arrow.modelId] = arrow
+        return arrow
+
+    def removeArrow(self, arrow):
+        self.deleteItems([arrow])
+
+    def removeDiagramItem(self, item):
+        self.deleteItems([item])
+
+    def deleteItems(self, items, records=None):
+        # collect the closure first: nodes take their arrows with them
+        nodes = {}
+        arrows = {}
+        others = {}
+        for item in items:
+            if item.type() == DiagramItem.Type:
+                nodes[item] = None
+            elif item.type() == Arrow.Type:
+                arrows[item] = None
             else:
-                ownerItem.setMyName(item.toPlainText())
+                others[item] = None
+        for node in nodes:
+            # labels are children of their node and leave the scene with it
+            others.pop(node.getTextItem(), None)
+        if records is not None:
+            closure = dict(arrows)
+            modelEdges = {}
+            for node in nodes:
+                closure.update(dict.fromkeys(self.graph.incidentEdges(node)))
+                if node.modelId is not None:
+                    modelEdges.update(dict.fromkeys(self.myModel.edgesOf(node.modelId)))
+            records.add(self, list(nodes) + list(others) + list(closure))
+            # edges to released nodes only exist in the model
+            records.addModelArrows(self, [edgeId for edgeId in modelEdges if edgeId not in self.liveArrows])
+
+        for node in nodes:
+            arrows.update(dict.fromkeys(self.graph.removeNode(node)))
+            self.zOrder.remove(node)
+        for arrow in arrows:
+            self.graph.removeEdge(arrow)
+            if self.router is not None:
+                self.router.removeArrow(arrow)
+        if self.myModel is not None:
+            for arrow in arrows:
+                if arrow.modelId is not None:
+                    self.myModel.removeEdge(arrow.modelId)
+                    self.liveArrows.pop(arrow.modelId, None)
+            for node in nodes:
+                if node.modelId is not None:
+                    self.myModel.removeNode(node.modelId)
+                    self.liveNodes.pop(node.modelId, None)
+                    self.movedNodes.pop(node, None)
+        for item in others:
+            if isinstance(item, DiagramTextItem) and item.getOwner() is not None and item.getOwner() not in nodes:
+                item.getOwner().setTextItemOwnership(None)
+
+        removedItems = [item for item in list(arrows) + list(others) + list(nodes) if item.scene() is self]
+        if len(removedItems) == 0:
+            return removedItems
+        for item in removedItems:
+            self.undoItems.pop(item.undoId, None)
+            if item.type() == DiagramItem.Type and item.getTextItem() is not None:
+                self.undoItems.pop(item.getTextItem().undoId, None)
+
+        # one selection notification and one index rebuild for the whole batch
+        self.blockSignals(True)
+        indexMethod = self.itemIndexMethod()
+        self.setItemIndexMethod(QGraphicsScene.NoIndex)
+        try:
+            self.clearSelection()
+            for item in removedItems:
+                self.removeItem(item)
+        finally:
+            self.setItemIndexMethod(indexMethod)
+            self.indexRebuilt()
+            self.blockSignals(False)
+        self.selectionChanged.emit()
+        self.scheduleSceneRectUpdate()
+        return removedItems
+
+    def model(self):
+        return self.myModel
+
+    def isVirtual(self):
+        return self.myModel is not None
+
+    def setItemBudget(self, budget):
+        self.itemBudget = budget
+
+    def setMaterialiseMargin(self, margin):
+        self.materialiseMargin = margin
+
+    def setModel(self, model):
+        self.clearDiagram()
+        self.myModel = model
+        self.includeInSceneRect(model.boundingRect())
+        # free text is rare, so it is always materialised
+        for text, x, y, font, textColor, z in model.texts:
+            self.addItem(self.createTextItem(QPointF(x, y), text, self.modelFont(font), QColor(textColor), z))
+        self.resetJournal()
+
+    def modelColor(self, argb):
+        color = self.colorCache.get(argb)
+        if color is None:
+            color = self.colorCache[argb] = QColor.fromRgba(argb)
+        return color
+
+    def modelFont(self, fontId):
+        if fontId < 0:
+            return None
+        font = self.fontCache.get(fontId)
+        if font is None:
+            font = self.fontCache[fontId] = QFont()
+            font.fromString(self.myModel.fonts[fontId])
+        return font
+
+    def modelRow(self, item):
+        pos = item.pos()
+        textItem = item.getTextItem()
+        if textItem is None:
+            return (item.diagramType().value, pos.x(), pos.y(), item.getMyName(), item.brush().color().rgba(), 
+                    item.zValue(), DiagramModel.NoFont, 0, 0., 0.)
+        labelPos = textItem.pos()
+        return (item.diagramType().value, pos.x(), pos.y(), item.getMyName(), item.brush().color().rgba(), item.zValue(), 
+                self.myModel.fontId(textItem.font().toString()), textItem.defaultTextColor().rgba(), labelPos.x(), labelPos.y())
+
+    def noteNodeMoved(self, item):
+        if item.modelId is not None:
+            self.movedNodes[item] = None
+
+    def syncModel(self):
+        # write the state of the live items back into the model
+        for nodeId, item in self.liveNodes.items():
+            self.myModel.updateNode(nodeId, *self.modelRow(item))
+        for edgeId, arrow in self.liveArrows.items():
+            self.myModel.edgeColors[edgeId] = arrow.color().rgba()
+        self.movedNodes = {}
+
+    def updateViewport(self, rect):
+        if self.myModel is None:
+            return
+        self.viewportRect = QRectF(rect)
+        # hysteresis: nothing to do while the view stays inside the materialised margin
+        halfMargin = self.materialiseMargin/2
+        if self.materialisedRect.contains(rect.adjusted(-halfMargin, -halfMargin, halfMargin, halfMargin)):
+            return
+        margin = self.materialiseMargin
+        area = rect.adjusted(-margin, -margin, margin, margin)
+        self.materialisedRect = area
+
+        for item in self.movedNodes:
+            pos = item.pos()
+            self.myModel.moveNode(item.modelId, pos.x(), pos.y())
+        self.movedNodes = {}
+
+        # the far end of every edge of a node in the area is materialised too,
+        # so no edge of a visible node goes missing
+        model = self.myModel
+        inside = model.nodesInRect(area)
+        wanted = dict.fromkeys(inside)
+        for nodeId in inside:
+            wanted.update(dict.fromkeys(model.neighbours(nodeId)))
+        if len(wanted) > self.itemBudget:
+            # over budget, the nodes nearest the center are kept, each with all of its neighbours
+            center = rect.center()
+            cx = center.x()
+            cy = center.y()
+            xs = model.xs
+            ys = model.ys
+            inside.sort(key=lambda i: (xs[i]-cx)**2 + (ys[i]-cy)**2)
+            wanted = {}
+            for nodeId in inside:
+                added = [end for end in model.neighbours(nodeId) if end not in wanted]
+                if nodeId not in wanted:
+                    added.append(nodeId)
+                if wanted and len(wanted) + len(added) > self.itemBudget:
+                    break
+                wanted.update(dict.fromkeys(added))
+
+        self.beginArrowBatch()
+        try:
+            for nodeId in [nodeId for nodeId in self.liveNodes if nodeId not in wanted]:
+                self.releaseNode(nodeId)
+            added = [nodeId for nodeId in wanted if nodeId not in self.liveNodes]
+            for nodeId in added:
+                self.materialiseNode(nodeId)
+            for nodeId in added:
+                for edgeId in self.myModel.edgesOf(nodeId):
+                    if edgeId not in self.liveArrows and \
+                        self.myModel.edgeStarts[edgeId] in self.liveNodes and self.myModel.edgeEnds[edgeId] in self.liveNodes:
+                        self.materialiseArrow(edgeId)
+        finally:
+            self.endArrowBatch()
+
+    def materialiseNode(self, nodeId):
+        model = self.myModel
+        diagramType = DiagramItem.DiagramType(model.types[nodeId])
+        pool = self.itemPool[diagramType]
+        item = pool.pop() if pool else DiagramItem(diagramType, self.myItemMenu)
+        fontId = model.nodeFonts[nodeId]
+        labelPos = None if fontId < 0 else QPointF(model.labelXs[nodeId], model.labelYs[nodeId])
+        self.configureDiagramItem(item, QPointF(model.xs[nodeId], model.ys[nodeId]), model.names[nodeId], 
+                                    self.modelColor(model.colors[nodeId]), model.zs[nodeId], self.modelFont(fontId), 
+                                    None if fontId < 0 else self.modelColor(model.textColors[nodeId]), labelPos)
+        item.modelId = nodeId
+        self.liveNodes[nodeId] = item
+        self.addItem(item)
+        self.graph.addNode(item)
+        self.zOrder.add(item, item.zValue())
+        return item
+
+    def releaseNode(self, nodeId):
+        item = self.liveNodes.pop(nodeId)
+        self.myModel.updateNode(nodeId, *self.modelRow(item))
+        self.movedNodes.pop(item, None)
+        for arrow in self.graph.removeNode(item):
+            self.releaseArrow(arrow)
+        self.zOrder.remove(item)
+        item.modelId = None
+        item.setSelected(False)
+        self.removeItem(item)
+        pool = self.itemPool[item.diagramType()]
+        if len(pool) < self.itemBudget//4:
+            pool.append(item)
+
+    def materialiseArrow(self, edgeId):
+        model = self.myModel
+        startItem = self.liveNodes[model.edgeStarts[edgeId]]
+        endItem = self.liveNodes[model.edgeEnds[edgeId]]
+        if self.arrowPool:
+            arrow = self.arrowPool.pop()
+            arrow.setItems(startItem, endItem)
+        else:
+            arrow = Arrow(startItem, endItem)
+            arrow.setZValue(-1000.)
+        arrow.setStyle(self.styles.intern(self.modelColor(model.edgeColors[edgeId])))
+        arrow.modelId = edgeId
+        self.liveArrows[edgeId] = arrow
+        self.graph.addEdge(arrow)
+        self.addItem(arrow)
+        self.scheduleArrowUpdate(arrow)
+        return arrow
+
+    def releaseArrow(self, arrow):
+        self.graph.removeEdge(arrow)
+        if self.router is not None:
+            self.router.removeArrow(arrow)
+        self.liveArrows.pop(arrow.modelId, None)
+        self.myModel.edgeColors[arrow.modelId] = arrow.color().rgba()
+        arrow.modelId = None
+        arrow.setSelected(False)
+        self.removeItem(arrow)
+        if len(self.arrowPool) < self.itemBudget//4:
+            self.arrowPool.append(arrow)
+
+    def nextItemName(self, diagramType):
+        self.typeCount[diagramType] += 1
+        return str(diagramType)[12:] + '_' + str(self.typeCount[diagramType])
+
+    def configureTextItem(self, textItem, posF, text='', font=None, color=None):
+        textItem.setStyle(self.styles.intern(self.myTextColor if color is None else color, 
+                                                self.myFont if font is None else font))
+        textItem.setPlainText(text)
+        textItem.setPos(posF)
+
+    def createTextItem(self, posF, text='', font=None, color=None, zValue=1000.):
+        textItem = DiagramTextItem()
+        textItem.setZValue(zValue)
+        self.configureTextItem(textItem, posF, text, font, color)
+        textItem.lostFocus[QGraphicsTextItem].connect(self.editorLostFocus)
+        textItem.selectedChange[QGraphicsItem].connect(self.itemSelected)
+        return textItem
+
+    def configureDiagramItem(self, item, posF, name='', color=None, zValue=0., font=None, textColor=None, labelPos=None):
+        item.setStyle(self.styles.intern(self.myItemColor if color is None else color))
+        item.setPos(posF)
+        item.setZValue(zValue)
+        if not name:
+            name = self.nextItemName(item.diagramType())
+        item.setMyName(name)
+
+        # the label is a child item, so it moves with the node
+        if labelPos is None:
+            labelPos = self.defaultLabelPos(item.diagramType())
+        textItem = item.getTextItem()
+        if textItem is None:
+            textItem = self.createTextItem(labelPos, name, font, textColor)
+            textItem.setParentItem(item)
+            textItem.setItemOwner(item)
+            item.setTextItemOwnership(textItem)
+        else:
+            self.configureTextItem(textItem, labelPos, name, font, textColor)
+
+    def defaultLabelPos(self, diagramType):
+        # just below the node, the same for every node of a type
+        pos = self.labelPositions.get(diagramType)
+        if pos is None:
+            height = DiagramItem(diagramType, self.myItemMenu).boundingRect().height()
+            pos = self.labelPositions[diagramType] = QPointF(0, height/2+5)
+        return QPointF(pos)
+
+    def createDiagramItem(self, diagramType, posF, name='', color=None, zValue=0., font=None, textColor=None, labelPos=None):
+        # builds a node and its label without adding them to the scene
+        item = DiagramItem(diagramType, self.myItemMenu)
+        self.configureDiagramItem(item, posF, name, color, zValue, font, textColor, labelPos)
+        return item
+
+    def addDiagramItem(self, item):
+        self.addItem(item)
+        self.graph.addNode(item)
+        self.zOrder.add(item, item.zValue())
+        if self.myModel is not None and item.modelId is None:
+            item.modelId = self.myModel.addNode(*self.modelRow(item))
+            self.liveNodes[item.modelId] = item
+
+    def insertItems(self, records):
+        items = [self.createDiagramItem(*DiagramItemRecord(*record)) for record in records]
+        for item in items:
+            self.addDiagramItem(item)
+        self.itemsInserted.emit(items)
+        return items
 
     def insertItem(self, posF, text=''):
         if self.myMode == DiagramScene.Mode.InsertItem:
-            item = DiagramItem(self.myItemType, self.myItemMenu)
-            item.setBrush(self.myItemColor)
-            self.addItem(item)
-            item.setPos(posF)
-
-            itemLabel = str(item.diagramType())[12:] + '_' + str(self.typeCount[item.diagramType()]+1)
-            item.setMyName(itemLabel)
-            textPos = QPointF(posF.x(), posF.y()+item.boundingRect().height()/2+5)
-
-            self.setMode(DiagramScene.Mode.InsertText)
-            self.insertItem(textPos, itemLabel)
-            textItem = self.items()[0]
-            textItem.setItemOwner(item)
-            item.setTextItemOwnership(textItem)
+            item = self.createDiagramItem(self.myItemType, posF)
+            self.addDiagramItem(item)
+            self.recordItems('Insert', [item])
 
-            self.itemInserted.emit(item)
+            self.textItem = item.getTextItem()
+            self.textItem.setTextInteractionFlags(Qt.TextEditorInteraction)
+            self.textInserted.emit(self.textItem)
 
-            self.typeCount[self.myItemType] += 1
+            self.itemInserted.emit(item)
         elif self.myMode == DiagramScene.Mode.InsertLine:
             self.line = QGraphicsLineItem(
                             QLineF(posF, posF)
@@ -415,16 +3505,10 @@ class DiagramScene(QGraphicsScene):
             self.line.setPen(QPen(self.myLineColor, 2))
             self.addItem(self.line)
         elif self.myMode == DiagramScene.Mode.InsertText:
-            self.textItem = DiagramTextItem()
-            self.textItem.setFont(self.myFont)
+            self.textItem = self.createTextItem(posF, text)
             self.textItem.setTextInteractionFlags(Qt.TextEditorInteraction)
-            self.textItem.setZValue(1000.)
-            self.textItem.setPlainText(text)
-            self.textItem.lostFocus[QGraphicsTextItem].connect(self.editorLostFocus)
-            self.textItem.selectedChange[QGraphicsItem].connect(self.itemSelected)
+            self.textItem.setEditText('')
             self.addItem(self.textItem)
-            self.textItem.setDefaultTextColor(self.myTextColor)
-            self.textItem.setPos(posF)
             self.textInserted.emit(self.textItem)
 
     def dragEnterEvent(self, event):
@@ -452,6 +3536,7 @@ class DiagramScene(QGraphicsScene):
 
         self.update()
 
+    @measured('mousePress')
     def mousePressEvent(self, mouseEvent):
         if mouseEvent.button() != Qt.LeftButton:
             return
@@ -462,18 +3547,18 @@ class DiagramScene(QGraphicsScene):
         # insert line
         self.insertItem(mouseEvent.scenePos())
 
-        itemToBeMoved = self.itemAt(mouseEvent.scenePos(), QTransform())
-        if isinstance(itemToBeMoved, DiagramItem):
-            itemText = itemToBeMoved.getTextItem()
-            self.oldMouseX =  mouseEvent.scenePos().x()
-            self.oldMouseY = mouseEvent.scenePos().y()
+        super().mousePressEvent(mouseEvent)
 
-            self.oldItemTextX = itemText.scenePos().x()
-            self.oldItemTextY = itemText.scenePos().y()
-        #print(itemMoved.scenePos())
+        if self.myMode == self.Mode.MoveItem and self.myAlignToItems and \
+                isinstance(self.mouseGrabberItem(), DiagramItem):
+            self.buildAlignmentIndex(set(self.selectedItems()) | {self.mouseGrabberItem()})
 
-        super().mousePressEvent(mouseEvent)
+        grabber = self.mouseGrabberItem()
+        self.dragCount += 1
+        self.dragIds = None
+        self.dragPos = grabber.scenePos() if self.myMode == self.Mode.MoveItem and grabber is not None else None
 
+    @measured('mouseMove')
     def mouseMoveEvent(self, mouseEvent):
         if self.myMode == DiagramScene.Mode.DragScene:
             return
@@ -484,19 +3569,26 @@ class DiagramScene(QGraphicsScene):
             self.line.setLine(newLine)
         elif self.myMode == self.Mode.MoveItem and self.mouseGrabberItem() is not None:
             # TODO: implement mouse move event where, item seems to hover
-            item = self.mouseGrabberItem()
-            if item is not None and isinstance(item, DiagramItem):
-                textItem = item.getTextItem()
-                newX = mouseEvent.scenePos().x()
-                newY = mouseEvent.scenePos().y()
-                dx = newX-self.oldMouseX
-                dy = newY-self.oldMouseY
-                textItem.setPos(QPointF(self.oldItemTextX, self.oldItemTextY) + QPointF(dx, dy))
-            super().mouseMoveEvent(mouseEvent)
+            # every selected item moves in this event, so arrows shared by
+            # two of them are recomputed once instead of twice
+            self.beginArrowBatch()
+            try:
+                super().mouseMoveEvent(mouseEvent)
+                grabber = self.mouseGrabberItem()
+                # hold Alt to drag freely
+                if isinstance(grabber, DiagramItem) and not mouseEvent.modifiers() & Qt.AltModifier:
+                    self.snapMovingItems(grabber)
+                elif self.guideLines:
+                    self.setGuideLines([])
+                if grabber is not None:
+                    self.recordDrag(grabber)
+            finally:
+                self.endArrowBatch()
         else:
             view.setDragMode(QGraphicsView.RubberBandDrag)
             super().mouseMoveEvent(mouseEvent)
 
+    @measured('mouseRelease')
     def mouseReleaseEvent(self, mouseEvent):
         if self.line is not None and self.myMode == self.Mode.InsertLine:
             startItems = self.items(self.line.line().p1())
@@ -512,17 +3604,15 @@ class DiagramScene(QGraphicsScene):
                 startItems[0].type() == DiagramItem.Type and \
                 endItems[0].type() == DiagramItem.Type and \
                 startItems[0] != endItems[0]:
-                startItem = startItems[0]
-                endItem = endItems[0]
-                arrow = Arrow(startItem, endItem)
-                arrow.setColor(self.myLineColor)
-                startItem.addArrow(arrow)
-                endItem.addArrow(arrow)
-                arrow.setZValue(-1000.)
-                self.addItem(arrow)
-                arrow.updatePosition()
+                arrow = self.addArrow(startItems[0], endItems[0])
+                if arrow is not None:
+                    self.recordItems('Insert Arrow', [arrow])
 
         self.line = None
+        self.dragPos = None
+        self.alignmentIndex = None
+        if self.guideLines:
+            self.setGuideLines([])
         super().mouseReleaseEvent(mouseEvent)  
 
     def mouseDoubleClickEvent(self, mouseEvent):
@@ -540,6 +3630,569 @@ class DiagramScene(QGraphicsScene):
         super().mouseDoubleClickEvent(mouseEvent)
 
 
+class DiagramDocument:
+    FormatName = 'diagramscene'
+    Version = 1
+
+    def __init__(self):
+        # plain rows, so saving and loading never touch Qt objects per field:
+        # nodes:  [type, x, y, name, color, z, font, textColor, labelX, labelY]
+        # arrows: [startNode, endNode, color]
+        # texts:  [text, x, y, font, color, z]
+        # fonts are indexes into self.fonts
+        self.fonts = []
+        self.nodes = []
+        self.arrows = []
+        self.texts = []
+
+    @classmethod
+    def fromScene(cls, scene):
+        if scene.isVirtual():
+            scene.syncModel()
+            document = scene.model().toDocument()
+            document.texts = []
+        else:
+            document = cls()
+        fontIds = {key: i for i, key in enumerate(document.fonts)}
+
+        def fontId(font):
+            key = font.toString()
+            if key not in fontIds:
+                fontIds[key] = len(document.fonts)
+                document.fonts.append(key)
+            return fontIds[key]
+
+        nodeIds = {}
+        for item in scene.graph.nodes() if not scene.isVirtual() else ():
+            nodeIds[item] = len(document.nodes)
+            pos = item.pos()
+            row = [item.diagramType().value, pos.x(), pos.y(), item.getMyName(), 
+                    item.brush().color().name(QColor.HexArgb), item.zValue()]
+            textItem = item.getTextItem()
+            if textItem is not None:
+                labelPos = textItem.pos()
+                row += [fontId(textItem.font()), textItem.defaultTextColor().name(QColor.HexArgb), labelPos.x(), labelPos.y()]
+            else:
+                row += [None, None, None, None]
+            document.nodes.append(row)
+
+        for arrow in scene.graph.edges() if not scene.isVirtual() else ():
+            document.arrows.append([nodeIds[arrow.startItem()], nodeIds[arrow.endItem()], arrow.color().name(QColor.HexArgb)])
+
+        for item in scene.items(Qt.AscendingOrder):
+            if isinstance(item, DiagramTextItem) and item.getOwner() is None:
+                document.texts.append([item.toPlainText(), item.pos().x(), item.pos().y(), fontId(item.font()), 
+                                        item.defaultTextColor().name(QColor.HexArgb), item.zValue()])
+
+        return document
+
+    def toScene(self, scene):
+        items = []
+        for _ in self.buildScene(scene, items):
+            pass
+        return items
+
+    def buildScene(self, scene, items=None, chunkSize=None):
+        # yields the number of nodes and arrows added after every chunk, so a
+        # large document can be spread over several event loop passes
+        items = [] if items is None else items
+        chunkSize = chunkSize or max(1, len(self.nodes), len(self.arrows))
+        fonts = []
+        for key in self.fonts:
+            font = QFont()
+            font.fromString(key)
+            fonts.append(font)
+
+        colors = {}
+
+        def color(name):
+            if name is None:
+                return None
+            if name not in colors:
+                colors[name] = QColor(name)
+            return colors[name]
+
+        for first in range(0, len(self.nodes), chunkSize):
+            records = []
+            for diagramType, x, y, name, brushColor, z, font, textColor, labelX, labelY in self.nodes[first:first + chunkSize]:
+                records.append(DiagramItemRecord(
+                                DiagramItem.DiagramType(diagramType), QPointF(x, y), name, color(brushColor), z,
+                                None if font is None else fonts[font], color(textColor), 
+                                None if labelX is None else QPointF(labelX, labelY)))
+            items.extend(scene.insertItems(records))
+            yield len(items)
+
+        for first in range(0, len(self.arrows), chunkSize):
+            scene.addArrows([(items[start], items[end], color(arrowColor)) 
+                                for start, end, arrowColor in self.arrows[first:first + chunkSize]])
+            yield len(items) + min(first + chunkSize, len(self.arrows))
+
+        for text, x, y, font, textColor, z in self.texts:
+            scene.addItem(scene.createTextItem(QPointF(x, y), text, fonts[font], color(textColor), z))
+
+        # growing while inserting overshoots, so fit the rect to what was loaded
+        scene.updateSceneRect()
+
+    def saveGraph(self, fileName):
+        # nodes are keyed by their labels, numbered where labels repeat
+        keys = []
+        used = set()
+        for i, node in enumerate(self.nodes):
+            label = ' '.join(node[3].split()) or 'n{}'.format(i)
+            key = label
+            number = 2
+            while key in used:
+                key = '{} ({})'.format(label, number)
+                number += 1
+            used.add(key)
+            keys.append(key)
+        scale = GRAPH_POSITION_SCALE
+        nodes = ((key, node[3], GRAPH_TYPE_SHAPES[DiagramItem.DiagramType(node[0])], node[1]/scale, node[2]/scale) 
+                    for key, node in zip(keys, self.nodes))
+        edges = ((keys[start], keys[end]) for start, end, color in self.arrows)
+        diagramformats.writeGraph(fileName, nodes, edges)
+
+    def toDict(self):
+        return {'format': self.FormatName, 'version': self.Version, 'fonts': self.fonts, 
+                'nodes': self.nodes, 'arrows': self.arrows, 'texts': self.texts}
+
+    @classmethod
+    def fromDict(cls, data):
+        if not isinstance(data, dict) or data.get('format') != cls.FormatName:
+            raise ValueError('not a diagram document')
+        if data.get('version', 0) > cls.Version:
+            raise ValueError('diagram document version {} is not supported'.format(data.get('version')))
+        document = cls()
+        document.fonts = data.get('fonts', [])
+        document.nodes = data.get('nodes', [])
+        document.arrows = data.get('arrows', [])
+        document.texts = data.get('texts', [])
+        document.validate()
+        return document
+
+    def validate(self):
+        # every row is checked up front, so a broken file is refused before
+        # the current diagram is cleared for it
+        def number(value):
+            return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+        def color(value):
+            return value is None or isinstance(value, str) and QColor.isValidColor(value)
+
+        def index(value, count):
+            return isinstance(value, int) and not isinstance(value, bool) and 0 <= value < count
+
+        if not all(isinstance(rows, list) for rows in (self.fonts, self.nodes, self.arrows, self.texts)):
+            raise ValueError('malformed diagram document')
+        if not all(isinstance(font, str) for font in self.fonts):
+            raise ValueError('malformed font in diagram document')
+        types = {diagramType.value for diagramType in DiagramItem.DiagramType}
+        fontCount = len(self.fonts)
+        for i, row in enumerate(self.nodes):
+            if not (isinstance(row, list) and len(row) == 10):
+                raise ValueError('malformed node {}'.format(i))
+            diagramType, x, y, name, brushColor, z, font, textColor, labelX, labelY = row
+            if not (diagramType in types and number(x) and number(y) and isinstance(name, str) 
+                    and color(brushColor) and number(z) and (font is None or index(font, fontCount)) 
+                    and color(textColor) and (labelX is None) == (labelY is None) 
+                    and (labelX is None or number(labelX) and number(labelY))):
+                raise ValueError('malformed node {}'.format(i))
+        nodeCount = len(self.nodes)
+        for i, row in enumerate(self.arrows):
+            if not (isinstance(row, list) and len(row) == 3 and index(row[0], nodeCount) 
+                    and index(row[1], nodeCount) and color(row[2])):
+                raise ValueError('malformed arrow {}'.format(i))
+        for i, row in enumerate(self.texts):
+            if not (isinstance(row, list) and len(row) == 6 and isinstance(row[0], str) and number(row[1]) 
+                    and number(row[2]) and index(row[3], fontCount) and color(row[4]) and number(row[5])):
+                raise ValueError('malformed text {}'.format(i))
+
+    def save(self, fileName):
+        with open(fileName, 'w', encoding='utf-8') as f:
+            json.dump(self.toDict(), f, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, fileName):
+        with open(fileName, 'r', encoding='utf-8') as f:
+            return cls.fromDict(json.load(f))
+
+    @classmethod
+    def open(cls, fileName):
+        if fileName.endswith(BINARY_DIAGRAM_SUFFIX):
+            return cls.loadBinary(fileName)
+        return cls.load(fileName)
+
+    def saveBinary(self, fileName):
+        DiagramBinaryReader.write(self, fileName)
+
+    @classmethod
+    def loadBinary(cls, fileName):
+        reader = DiagramBinaryReader(fileName)
+        try:
+            return reader.toDocument()
+        finally:
+            reader.close()
+
+
+def colorToArgb(name):
+    return 0 if name is None else int(name[1:], 16)
+
+
+def argbToColor(argb):
+    return '#{:08x}'.format(argb)
+
+
+class DiagramBinaryReader:
+    # Little-endian columnar layout, every column padded to 8 bytes:
+    #   header, node columns (sorted by x), arrow columns (sorted by start node)
+    #   with per-node offsets into them, text columns and a utf-8 string table.
+    Magic = b'DGMB'
+    Version = 1
+    Header = struct.Struct('<4sIIIII')
+    NodeColumns = [('x', 'd'), ('y', 'd'), ('z', 'd'), ('labelX', 'd'), ('labelY', 'd'), ('color', 'I'), 
+                    ('textColor', 'I'), ('name', 'I'), ('font', 'i'), ('type', 'B')]
+    ArrowColumns = [('start', 'I'), ('end', 'I'), ('color', 'I')]
+    TextColumns = [('x', 'd'), ('y', 'd'), ('z', 'd'), ('color', 'I'), ('text', 'I'), ('font', 'i')]
+    NoFont = -1
+
+    def __init__(self, fileName):
+        self.file = open(fileName, 'rb')
+        self.map = None
+        self.columns = []
+        # a file that does not check out is closed again before the error leaves
+        try:
+            self.mapFile()
+        except (ValueError, struct.error) as e:
+            self.close()
+            raise ValueError(str(e)) from e
+        except BaseException:
+            self.close()
+            raise
+
+    def mapFile(self):
+        size = os.fstat(self.file.fileno()).st_size
+        if size < self.Header.size:
+            raise ValueError('not a binary diagram document')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+
+        magic, version, self.myNodeCount, self.myArrowCount, self.myTextCount, self.myStringCount = self.Header.unpack_from(self.map, 0)
+        if magic != self.Magic:
+            raise ValueError('not a binary diagram document')
+        if version > self.Version:
+            raise ValueError('binary diagram document version {} is not supported'.format(version))
+
+        offset = self.Header.size
+        self.nodes, offset = self.mapColumns(self.NodeColumns, self.myNodeCount, offset)
+        self.arrows, offset = self.mapColumns(self.ArrowColumns, self.myArrowCount, offset)
+        self.arrowOffsets, offset = self.mapColumn('I', self.myNodeCount+1, offset)
+        self.texts, offset = self.mapColumns(self.TextColumns, self.myTextCount, offset)
+        self.stringOffsets, offset = self.mapColumn('I', self.myStringCount+1, offset)
+        self.stringData = offset
+        # the string table runs to the end of the file, so this also catches a
+        # file cut short inside it
+        if self.arrowOffsets[self.myNodeCount] != self.myArrowCount or \
+                self.stringData + self.stringOffsets[self.myStringCount] != len(self.map):
+            raise ValueError('binary diagram document is truncated or corrupt')
+
+    def mapColumn(self, typeCode, count, offset):
+        size = array(typeCode).itemsize*count
+        if offset + size > len(self.map):
+            raise ValueError('binary diagram document is truncated')
+        column = self.view[offset:offset+size].cast(typeCode)
+        self.columns.append(column)
+        if sys.byteorder != 'little':
+            column = array(typeCode, column)
+            column.byteswap()
+        return column, offset + (size+7)//8*8
+
+    def mapColumns(self, columns, count, offset):
+        mapped = {}
+        for name, typeCode in columns:
+            mapped[name], offset = self.mapColumn(typeCode, count, offset)
+        return mapped, offset
+
+    def close(self):
+        if self.file is None:
+            return
+        # the column views must be released before the map can be closed
+        for column in self.columns:
+            column.release()
+        self.columns = []
+        if self.map is not None:
+            self.view.release()
+            self.map.close()
+        self.file.close()
+        self.file = None
+        self.map = None
+
+    def nodeCount(self):
+        return self.myNodeCount
+
+    def arrowCount(self):
+        return self.myArrowCount
+
+    def stringTable(self):
+        # all strings, utf-8 encoded, indexed by stringOffsets
+        return self.map[self.stringData:]
+
+    def string(self, index):
+        if index < 0:
+            return None
+        start = self.stringData + self.stringOffsets[index]
+        end = self.stringData + self.stringOffsets[index+1]
+        return str(self.map[start:end], 'utf-8')
+
+    def node(self, index):
+        nodes = self.nodes
+        font = nodes['font'][index]
+        return [nodes['type'][index], nodes['x'][index], nodes['y'][index], self.string(nodes['name'][index]),
+                argbToColor(nodes['color'][index]), nodes['z'][index], font, 
+                None if font == self.NoFont else argbToColor(nodes['textColor'][index]),
+                None if font == self.NoFont else nodes['labelX'][index], 
+                None if font == self.NoFont else nodes['labelY'][index]]
+
+    def outgoingArrows(self, index):
+        return range(self.arrowOffsets[index], self.arrowOffsets[index+1])
+
+    def toDocument(self, indices=None):
+        if indices is None:
+            indices = range(self.myNodeCount)
+        document = DiagramDocument()
+
+        fontIds = {}
+        nodeIds = {}
+        for index in indices:
+            nodeIds[index] = len(document.nodes)
+            row = self.node(index)
+            font = row[6]
+            if font != self.NoFont:
+                if font not in fontIds:
+                    fontIds[font] = len(document.fonts)
+                    document.fonts.append(self.string(font))
+                row[6] = fontIds[font]
+            else:
+                row[6] = None
+            document.nodes.append(row)
+
+        arrows = self.arrows
+        for index in nodeIds:
+            for arrow in self.outgoingArrows(index):
+                end = arrows['end'][arrow]
+                if end in nodeIds:
+                    document.arrows.append([nodeIds[index], nodeIds[end], argbToColor(arrows['color'][arrow])])
+
+        texts = self.texts
+        for i in range(self.myTextCount):
+            font = texts['font'][i]
+            if font not in fontIds:
+                fontIds[font] = len(document.fonts)
+                document.fonts.append(self.string(font))
+            document.texts.append([self.string(texts['text'][i]), texts['x'][i], texts['y'][i], fontIds[font],
+                                    argbToColor(texts['color'][i]), texts['z'][i]])
+
+        return document
+
+    @classmethod
+    def write(cls, document, fileName):
+        strings = {}
+
+        def stringId(text):
+            if text not in strings:
+                strings[text] = len(strings)
+            return strings[text]
+
+        fontIds = [stringId(font) for font in document.fonts]
+
+        order = sorted(range(len(document.nodes)), key=lambda i: document.nodes[i][1])
+        position = [0]*len(order)
+        for newIndex, oldIndex in enumerate(order):
+            position[oldIndex] = newIndex
+
+        nodes = {name: array(typeCode) for name, typeCode in cls.NodeColumns}
+        for oldIndex in order:
+            diagramType, x, y, name, color, z, font, textColor, labelX, labelY = document.nodes[oldIndex]
+            nodes['type'].append(diagramType)
+            nodes['x'].append(x)
+            nodes['y'].append(y)
+            nodes['z'].append(z)
+            nodes['name'].append(stringId(name))
+            nodes['color'].append(colorToArgb(color))
+            nodes['font'].append(cls.NoFont if font is None else fontIds[font])
+            nodes['textColor'].append(colorToArgb(textColor))
+            nodes['labelX'].append(0. if labelX is None else labelX)
+            nodes['labelY'].append(0. if labelY is None else labelY)
+
+        arrowRows = sorted((position[start], position[end], colorToArgb(color)) for start, end, color in document.arrows)
+        arrows = {name: array(typeCode) for name, typeCode in cls.ArrowColumns}
+        arrowOffsets = array('I', [0]*(len(order)+1))
+        for start, end, color in arrowRows:
+            arrows['start'].append(start)
+            arrows['end'].append(end)
+            arrows['color'].append(color)
+            arrowOffsets[start+1] += 1
+        for i in range(len(order)):
+            arrowOffsets[i+1] += arrowOffsets[i]
+
+        texts = {name: array(typeCode) for name, typeCode in cls.TextColumns}
+        for text, x, y, font, color, z in document.texts:
+            texts['x'].append(x)
+            texts['y'].append(y)
+            texts['z'].append(z)
+            texts['color'].append(colorToArgb(color))
+            texts['text'].append(stringId(text))
+            texts['font'].append(fontIds[font])
+
+        stringData = bytearray()
+        stringOffsets = array('I', [0])
+        for text in strings:
+            stringData += text.encode('utf-8')
+            stringOffsets.append(len(stringData))
+
+        columns = [nodes[name] for name, _ in cls.NodeColumns] + [arrows[name] for name, _ in cls.ArrowColumns] + \
+                    [arrowOffsets] + [texts[name] for name, _ in cls.TextColumns] + [stringOffsets]
+        with open(fileName, 'wb') as f:
+            f.write(cls.Header.pack(cls.Magic, cls.Version, len(order), len(arrowRows), len(document.texts), len(strings)))
+            for column in columns:
+                if sys.byteorder != 'little':
+                    column.byteswap()
+                data = column.tobytes()
+                f.write(data)
+                f.write(bytes(-len(data) % 8))
+            f.write(stringData)
+
+
+class LayoutWorker(QThread):
+    layoutReady = pyqtSignal(object, object, object)
+    layoutFailed = pyqtSignal(str)
+
+    def __init__(self, nodes, arguments, parent=None):
+        super().__init__(parent)
+        self.nodes = nodes
+        self.arguments = arguments
+
+    def run(self):
+        try:
+            xs, ys = diagramlayout.layeredLayout(**self.arguments)
+        except (ValueError, MemoryError) as e:
+            self.layoutFailed.emit(str(e))
+            return
+        self.layoutReady.emit(self.nodes, xs.tolist(), ys.tolist())
+
+
+class GraphImporter(QObject):
+    # reads a CSV, DOT or GraphML file a chunk per timer tick so the event
+    # loop keeps running; the records go into a compact DiagramModel, which
+    # a large graph keeps as the scene's virtual model, a small one is then
+    # built into items a chunk at a time
+    ChunkTime = 0.03
+    ChunkSize = 500
+    # creating items is much slower than parsing records
+    BuildChunkSize = 200
+    GridColumns = 40
+    GridSpacing = 300.
+
+    progressChanged = pyqtSignal(int)
+    imported = pyqtSignal()
+    failed = pyqtSignal(str)
+
+    def __init__(self, scene, fileName, parent=None):
+        super().__init__(parent)
+        self.scene = scene
+        self.fileName = fileName
+        self.positioned = True
+        self.building = False
+        self.steps = self.importSteps()
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.step)
+
+    def start(self):
+        self.timer.start(0)
+
+    def cancel(self):
+        self.timer.stop()
+        self.steps.close()
+        if self.building:
+            self.scene.clearDiagram()
+
+    def step(self):
+        deadline = time.perf_counter() + self.ChunkTime
+        try:
+            while time.perf_counter() < deadline:
+                progress = next(self.steps)
+        except StopIteration:
+            self.timer.stop()
+            self.imported.emit()
+            return
+        except (OSError, ValueError) as e:
+            self.cancel()
+            self.failed.emit(str(e))
+            return
+        self.progressChanged.emit(progress)
+
+    def importSteps(self):
+        # progress is in percent: reading up to 90, building the rest
+        scene = self.scene
+        model = DiagramModel()
+        color = QColor(scene.itemColor()).rgba()
+        lineColor = QColor(scene.lineColor()).rgba()
+        scale = GRAPH_POSITION_SCALE
+        nodeIds = {}
+        edges = set()
+        unplaced = set()
+
+        with open(self.fileName, 'rb') as raw:
+            size = max(1, os.fstat(raw.fileno()).st_size)
+            for count, record in enumerate(diagramformats.readGraph(self.fileName, raw), 1):
+                if record[0] == 'node':
+                    _, key, label, shape, pos, explicit = record
+                    nodeId = nodeIds.get(key)
+                    diagramType = GRAPH_SHAPE_TYPES.get(shape.lower(), DiagramItem.DiagramType.Step) if shape else None
+                    if nodeId is None:
+                        if pos is None:
+                            index = len(nodeIds)
+                            x = (index % self.GridColumns)*self.GridSpacing
+                            y = (index // self.GridColumns)*self.GridSpacing
+                        else:
+                            x, y = pos[0]*scale, pos[1]*scale
+                        nodeId = nodeIds[key] = model.addNode((diagramType or DiagramItem.DiagramType.Step).value, 
+                                                                x, y, label or key, color, 0., DiagramModel.NoFont, 0, 0., 0.)
+                        if pos is None:
+                            unplaced.add(nodeId)
+                    elif explicit:
+                        # a declaration after the node was first used by an edge
+                        if label is not None:
+                            model.names[nodeId] = label
+                        if diagramType is not None:
+                            model.types[nodeId] = diagramType.value
+                        if pos is not None:
+                            model.moveNode(nodeId, pos[0]*scale, pos[1]*scale)
+                            unplaced.discard(nodeId)
+                else:
+                    start = nodeIds[record[1]]
+                    end = nodeIds[record[2]]
+                    if start != end and (start, end) not in edges:
+                        edges.add((start, end))
+                        model.addEdge(start, end, lineColor)
+                if count % self.ChunkSize == 0:
+                    yield 90*raw.tell()//size
+
+        self.positioned = not unplaced
+        nodeIds = edges = unplaced = None
+        if model.nodeCount() > VIRTUAL_NODE_THRESHOLD:
+            scene.setModel(model)
+            return
+
+        document = model.toDocument()
+        model = None
+        total = max(1, len(document.nodes) + len(document.arrows))
+        self.building = True
+        scene.clearDiagram()
+        for done in document.buildScene(scene, chunkSize=self.BuildChunkSize):
+            yield 90 + 10*done//total
+        self.building = False
+
+
 class CellListWidget(QListWidget):
     def __init__(self, parent=None):
         super().__init__(parent=parent)
@@ -560,37 +4213,131 @@ class CellListWidget(QListWidget):
         drag.exec_()
 
 class DiagramView(QGraphicsView):
+    ZoomLevels = [10, 25, 50, 75, 100, 125, 150, 200]
+    # fitting a large diagram may go far below the smallest zoom level
+    MinZoomScale = 0.01
     zoomScale = 100
 
-    zoomSignal = pyqtSignal(int)
+    zoomSignal = pyqtSignal(float)
 
     def __init__(self, scene, parent=None):
         super().__init__(parent=parent)
 
         self.setScene(scene)
+        # the grid is drawn procedurally; caching it lets panning blit the
+        # already drawn part and only paint the newly exposed strip
+        self.setCacheMode(QGraphicsView.CacheBackground)
 
         self.setAcceptDrops(True)
 
+        # the overlay is refreshed on a timer rather than after every frame,
+        # which would keep repainting it forever
+        self.myShowMetrics = False
+        self.metricsFont = QFont('Monospace')
+        self.metricsFont.setStyleHint(QFont.TypeWriter)
+        self.metricsTimer = QTimer(self)
+        self.metricsTimer.setInterval(500)
+        self.metricsTimer.timeout.connect(self.updateMetricsOverlay)
+
+    def metrics(self):
+        scene = self.scene()
+        return scene.metrics if isinstance(scene, DiagramScene) else None
+
+    def showsMetrics(self):
+        return self.myShowMetrics
+
+    def setShowMetrics(self, show):
+        self.myShowMetrics = show
+        if show:
+            self.metricsTimer.start()
+        else:
+            self.metricsTimer.stop()
+        self.viewport().update()
+
+    def metricsRect(self):
+        metrics = self.metrics()
+        lines = metrics.summary() if metrics is not None else []
+        fontMetrics = QFontMetrics(self.metricsFont)
+        width = max((fontMetrics.horizontalAdvance(line) for line in lines), default=0)
+        return QRect(8, 8, width + 12, len(lines)*fontMetrics.height() + 12)
+
+    def updateMetricsOverlay(self):
+        self.viewport().update(self.metricsRect())
+
+    def paintEvent(self, event):
+        metrics = self.metrics()
+        if metrics is None:
+            super().paintEvent(event)
+            return
+        # repaints of the overlay alone are not counted as frames
+        overlayOnly = self.myShowMetrics and self.metricsRect().contains(event.rect())
+        metrics.beginFrame()
+        start = time.perf_counter()
+        super().paintEvent(event)
+        if not overlayOnly:
+            metrics.endFrame(time.perf_counter() - start)
+        if self.myShowMetrics:
+            self.drawMetrics(metrics)
+
+    def drawMetrics(self, metrics):
+        rect = self.metricsRect()
+        painter = QPainter(self.viewport())
+        painter.fillRect(rect, QColor(0, 0, 0, 170))
+        painter.setFont(self.metricsFont)
+        painter.setPen(Qt.white)
+        painter.drawText(rect.adjusted(6, 6, -6, -6), Qt.AlignLeft | Qt.AlignTop, '\n'.join(metrics.summary()))
+        painter.end()
+
+    def updateVisibleItems(self):
+        scene = self.scene()
+        if isinstance(scene, DiagramScene) and scene.isVirtual():
+            scene.updateViewport(self.mapToScene(self.viewport().rect()).boundingRect())
+
+    def scrollContentsBy(self, dx, dy):
+        super().scrollContentsBy(dx, dy)
+        self.updateVisibleItems()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.updateVisibleItems()
+
     def setupMatrix(self, value):
+        levels = self.ZoomLevels
         if value > 0:
-            self.zoomScale += 25
+            larger = [level for level in levels if level > self.zoomScale]
+            self.zoomScale = larger[0] if larger else levels[-1]
         else:
-            self.zoomScale -= 25
-        
-        if self.zoomScale > 150:
-            self.zoomScale = 150
-        elif self.zoomScale < 50:
-            self.zoomScale = 50
+            smaller = [level for level in levels if level < self.zoomScale]
+            self.zoomScale = smaller[-1] if smaller else max(self.zoomScale/2, self.MinZoomScale)
+
+        self.setZoomScale(self.zoomScale)
 
+    def setZoomScale(self, zoomScale):
+        self.zoomScale = zoomScale
         newScale = self.zoomScale/100.
         
         oldMatrix = self.transform()
         self.resetTransform()
         self.translate(oldMatrix.dx(), oldMatrix.dy())
         self.scale(newScale, newScale)
+        self.updateVisibleItems()
 
         self.zoomSignal.emit(self.zoomScale)
 
+    def fitToContents(self, margin=20):
+        scene = self.scene()
+        bounds = scene.contentsBoundingRect() if isinstance(scene, DiagramScene) else scene.itemsBoundingRect()
+        if bounds.isNull():
+            return
+        bounds.adjust(-margin, -margin, margin, margin)
+        # the largest zoom level that still shows everything, or below the
+        # smallest level the exact scale that does
+        viewport = self.viewport().rect()
+        fit = min(viewport.width()/bounds.width(), viewport.height()/bounds.height())*100
+        levels = [level for level in self.ZoomLevels if level <= fit]
+        self.setZoomScale(levels[-1] if levels else max(fit, self.MinZoomScale))
+        self.centerOn(bounds.center())
+
     def wheelEvent(self, event):
         self.setupMatrix(event.angleDelta().y())
         event.accept()
@@ -605,16 +4352,19 @@ class MainWindow(QMainWindow):
         self.createToolBox()
 
         self.scene = DiagramScene(self.itemMenu, self)
-        self.scene.setSceneRect(QRectF(0, 0, 5000, 5000))
         self.scene.itemInserted[DiagramItem].connect(self.itemInserted)
         self.scene.textInserted[QGraphicsTextItem].connect(self.textInserted)
         self.scene.itemSelected[QGraphicsItem].connect(self.itemSelected)
+        self.scene.undoStack.canUndoChanged.connect(self.undoAction.setEnabled)
+        self.scene.undoStack.canRedoChanged.connect(self.redoAction.setEnabled)
+        self.scene.undoStack.undoTextChanged.connect(self.undoTextChanged)
+        self.scene.undoStack.redoTextChanged.connect(self.redoTextChanged)
         self.createToolbars()
 
         layout = QHBoxLayout()
         layout.addWidget(self.toolBox)
         self.view = DiagramView(self.scene) #QGraphicsView(self.scene)
-        self.view.zoomSignal[int].connect(self.sceneScaleAutoChanged)
+        self.view.zoomSignal[float].connect(self.sceneScaleAutoChanged)
         layout.addWidget(self.view)
 
         widget = QWidget()
@@ -622,8 +4372,68 @@ class MainWindow(QMainWindow):
 
         self.setCentralWidget(widget)
         self.setWindowTitle('Diagramscene in Python (with additional stuffs)')
+        self.fileName = None
+        self.layoutWorker = None
+        self.layoutGeneration = None
+        self.importer = None
+        self.importProgress = None
+        self.autosaveLock = None
+        self.autosaveJournal = None
         self.setUnifiedTitleAndToolBarOnMac(True)
 
+    def startAutosave(self, directory=None):
+        # one window per autosave directory; a lock left by a crashed process is stale and taken over
+        if directory is None:
+            directory = os.path.join(QStandardPaths.writableLocation(QStandardPaths.AppDataLocation), 'autosave')
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError:
+            return
+        lock = QLockFile(os.path.join(directory, 'autosave.lock'))
+        if not lock.tryLock(0):
+            return
+        self.autosaveLock = lock
+
+        try:
+            state = diagramjournal.recoverJournal(directory)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            QMessageBox.warning(self, 'Recover Diagram', 'Cannot recover the unsaved diagram:\n{}'.format(e))
+            state = None
+        if state is not None and not state.isEmpty() and \
+                QMessageBox.question(self, 'Recover Diagram', 'The last session ended unexpectedly. Recover its diagram?', 
+                                    QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes) == QMessageBox.Yes:
+            self.scene.restoreJournal(state)
+            self.view.fitToContents()
+            self.view.updateVisibleItems()
+
+        self.autosaveJournal = diagramjournal.Journal(directory)
+        writer = JournalWriter(self.autosaveJournal, self)
+        writer.failed.connect(self.autosaveFailed)
+        writer.start()
+        self.scene.setJournal(writer)
+
+    def stopAutosave(self):
+        # a clean exit leaves nothing to recover
+        if self.autosaveJournal is None:
+            return
+        self.scene.setJournal(None)
+        try:
+            self.autosaveJournal.close(discard=True)
+        except OSError:
+            pass
+        self.autosaveJournal = None
+        self.autosaveLock.unlock()
+        self.autosaveLock = None
+
+    @pyqtSlot(str)
+    def autosaveFailed(self, message):
+        self.scene.setJournal(None)
+        QMessageBox.warning(self, 'Autosave', 'Autosave stopped:\n{}'.format(message))
+
+    def closeEvent(self, event):
+        self.stopAutosave()
+        super().closeEvent(event)
+
     @pyqtSlot(DiagramItem)
     def itemInserted(self, item):
         self.pointerTypeGroup.button(DiagramScene.Mode.MoveItem.value).setChecked(True)
@@ -648,54 +4458,195 @@ class MainWindow(QMainWindow):
         self.underlineAction.setChecked(font.underline())
     
     @pyqtSlot()
-    def bringToFront(self):
-        if len(self.scene.selectedItems()) == 0:
+    def openDiagram(self):
+        fileName, _ = QFileDialog.getOpenFileName(self, 'Open Diagram', '', DIAGRAM_FILE_FILTER)
+        if not fileName:
             return
-        
-        selectedItem = self.scene.selectedItems()[0]
-        overlapItems = selectedItem.collidingItems()
 
-        zValue = 0
-        for item in overlapItems:
-            if item.zValue() >= zValue and item.type() == DiagramItem.Type:
-                zValue = item.zValue() + 0.1
-        selectedItem.setZValue(zValue)
+        # large diagrams are opened into a DiagramModel and only the part
+        # around the viewport becomes Qt items
+        model = None
+        try:
+            if fileName.endswith(BINARY_DIAGRAM_SUFFIX):
+                reader = DiagramBinaryReader(fileName)
+                try:
+                    if reader.nodeCount() > VIRTUAL_NODE_THRESHOLD:
+                        model = DiagramModel.fromBinary(reader)
+                    else:
+                        document = reader.toDocument()
+                finally:
+                    reader.close()
+            else:
+                document = DiagramDocument.load(fileName)
+                if len(document.nodes) > VIRTUAL_NODE_THRESHOLD:
+                    model = DiagramModel.fromDocument(document)
+        except (OSError, ValueError, struct.error) as e:
+            QMessageBox.warning(self, 'Open Diagram', 'Cannot open {}:\n{}'.format(fileName, e))
+            return
+
+        if model is not None:
+            self.scene.setModel(model)
+            self.view.updateVisibleItems()
+        else:
+            self.scene.clearDiagram()
+            document.toScene(self.scene)
+            self.scene.resetJournal()
+        self.fileName = fileName
+
+    @pyqtSlot()
+    def saveDiagram(self):
+        if self.fileName is None:
+            self.saveDiagramAs()
+            return
+
+        try:
+            document = DiagramDocument.fromScene(self.scene)
+            if self.fileName.endswith(BINARY_DIAGRAM_SUFFIX):
+                document.saveBinary(self.fileName)
+            else:
+                document.save(self.fileName)
+        except OSError as e:
+            QMessageBox.warning(self, 'Save Diagram', 'Cannot save {}:\n{}'.format(self.fileName, e))
+
+    @pyqtSlot()
+    def saveDiagramAs(self):
+        fileName, _ = QFileDialog.getSaveFileName(self, 'Save Diagram', '', DIAGRAM_FILE_FILTER)
+        if not fileName:
+            return
+        self.fileName = fileName
+        self.saveDiagram()
+
+    @pyqtSlot()
+    def importGraph(self):
+        if self.importer is not None:
+            return
+        fileName, _ = QFileDialog.getOpenFileName(self, 'Import Graph', '', diagramformats.GRAPH_FILE_FILTER)
+        if not fileName:
+            return
+        self.importer = GraphImporter(self.scene, fileName, self)
+        self.importer.imported.connect(self.graphImported)
+        self.importer.failed.connect(self.graphImportFailed)
+        self.importProgress = QProgressDialog('Importing {}...'.format(os.path.basename(fileName)), 'Cancel', 0, 100, self)
+        self.importProgress.setWindowTitle('Import Graph')
+        self.importProgress.setWindowModality(Qt.WindowModal)
+        self.importProgress.setMinimumDuration(500)
+        self.importProgress.setAutoClose(False)
+        self.importProgress.setValue(0)
+        self.importProgress.canceled.connect(self.cancelImport)
+        self.importer.progressChanged.connect(self.importProgress.setValue)
+        self.importer.start()
+
+    @pyqtSlot()
+    def graphImported(self):
+        positioned = self.importer.positioned
+        self.importFinished()
+        self.fileName = None
+        self.scene.resetJournal()
+        self.view.updateVisibleItems()
+        # files without coordinates were laid out on a grid as they streamed in
+        if not positioned and diagramlayout is not None:
+            self.autoLayout()
+        else:
+            self.view.fitToContents()
+
+    @pyqtSlot(str)
+    def graphImportFailed(self, message):
+        self.importFinished()
+        QMessageBox.warning(self, 'Import Graph', 'Cannot import the graph:\n{}'.format(message))
+
+    @pyqtSlot()
+    def cancelImport(self):
+        self.importer.cancel()
+        self.importFinished()
+
+    def importFinished(self):
+        self.importProgress.canceled.disconnect(self.cancelImport)
+        self.importProgress.close()
+        self.importProgress.deleteLater()
+        self.importProgress = None
+        self.importer.deleteLater()
+        self.importer = None
+
+    @pyqtSlot()
+    def exportGraph(self):
+        fileName, _ = QFileDialog.getSaveFileName(self, 'Export Graph', '', diagramformats.GRAPH_FILE_FILTER)
+        if not fileName:
+            return
+        try:
+            DiagramDocument.fromScene(self.scene).saveGraph(fileName)
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, 'Export Graph', 'Cannot export {}:\n{}'.format(fileName, e))
+
+    @pyqtSlot()
+    def bringToFront(self):
+        self.scene.bringToFront(self.scene.selectedItems())
 
     @pyqtSlot()
     def sendToBack(self):
-        if len(self.scene.selectedItems()) == 0:
+        self.scene.sendToBack(self.scene.selectedItems())
+
+    @pyqtSlot()
+    def raiseItems(self):
+        self.scene.raiseItems(self.scene.selectedItems())
+
+    @pyqtSlot()
+    def lowerItems(self):
+        self.scene.lowerItems(self.scene.selectedItems())
+
+    @pyqtSlot()
+    def autoLayout(self):
+        if self.layoutWorker is not None:
+            return
+        nodes, arguments = self.scene.layoutInput()
+        if not nodes:
+            return
+        self.layoutGeneration = self.scene.generation()
+        self.layoutWorker = LayoutWorker(nodes, arguments, self)
+        self.layoutWorker.layoutReady.connect(self.layoutReady)
+        self.layoutWorker.layoutFailed.connect(self.layoutFailed)
+        self.layoutWorker.finished.connect(self.layoutFinished)
+        self.autoLayoutAction.setEnabled(False)
+        self.layoutWorker.start()
+
+    @pyqtSlot(object, object, object)
+    def layoutReady(self, nodes, xs, ys):
+        # the diagram may have been replaced while the layout was running,
+        # its items are gone then
+        if self.scene.generation() != self.layoutGeneration:
             return
+        self.scene.applyLayout(nodes, xs, ys)
+        self.view.fitToContents()
 
-        selectedItem = self.scene.selectedItems()[0]
-        overlapItems = selectedItem.collidingItems()
-        
-        zValue = 0.
-        for item in overlapItems:
-            if item.zValue() <= zValue and item.type() == DiagramItem.Type:
-                zValue = item.zValue() - 0.1
-        selectedItem.setZValue(zValue)
+    @pyqtSlot(str)
+    def layoutFailed(self, message):
+        QMessageBox.warning(self, 'Auto Layout', 'Cannot lay out the diagram:\n{}'.format(message))
+
+    @pyqtSlot()
+    def layoutFinished(self):
+        self.layoutWorker.deleteLater()
+        self.layoutWorker = None
+        self.layoutGeneration = None
+        self.autoLayoutAction.setEnabled(True)
 
     @pyqtSlot()
     def deleteItem(self):
-        selectedItems = self.scene.selectedItems()
-        for item in selectedItems:
-            if item.type() == Arrow.Type:
-                self.scene.removeItem(item)
-                arrow = item
-                arrow.startItem().removeArrow(arrow)
-                arrow.endItem().removeArrow(arrow)
+        self.scene.deleteSelection()
 
-        selectedItems = self.scene.selectedItems()
-        for item in selectedItems:
-            if item.type() == DiagramItem.Type:
-                item.removeArrows()
-                textItem = item.getTextItem()
-                self.scene.removeItem(textItem)
-                self.scene.removeItem(item)
+    @pyqtSlot()
+    def undo(self):
+        self.scene.undoStack.undo()
 
-        selectedItems = self.scene.selectedItems()
-        for item in selectedItems:
-            self.scene.removeItem(item)
+    @pyqtSlot()
+    def redo(self):
+        self.scene.undoStack.redo()
+
+    @pyqtSlot(str)
+    def undoTextChanged(self, text):
+        self.undoAction.setText('&Undo {}'.format(text) if text else '&Undo')
+
+    @pyqtSlot(str)
+    def redoTextChanged(self, text):
+        self.redoAction.setText('&Redo {}'.format(text) if text else '&Redo')
 
     @pyqtSlot(QAbstractButton)
     def pointerGroupClicked(self, button):
@@ -764,18 +4715,24 @@ class MainWindow(QMainWindow):
 
     @pyqtSlot(str)
     def sceneScaleChanged(self, scale):
-        newScale = float(scale.strip('%'))/100.
-        oldMatrix = self.view.transform()
-        self.view.resetTransform()
-        self.view.translate(oldMatrix.dx(), oldMatrix.dy())
-        self.view.scale(newScale, newScale)
+        try:
+            zoomScale = float(scale.strip().rstrip('%'))
+        except ValueError:
+            zoomScale = 0
+        if zoomScale < DiagramView.MinZoomScale:
+            # show the scale in use again
+            self.sceneScaleAutoChanged(self.view.zoomScale)
+            return
+        self.view.setZoomScale(zoomScale)
 
-    @pyqtSlot(int)
+    @pyqtSlot()
+    def sceneScaleEdited(self):
+        self.sceneScaleChanged(self.sceneScaleCombo.currentText())
+
+    @pyqtSlot(float)
     def sceneScaleAutoChanged(self, scale):
-        scaleStr = str(scale)+'%'
-        self.sceneScaleCombo.currentTextChanged[str].disconnect()
-        self.sceneScaleCombo.setCurrentText(scaleStr)
-        self.sceneScaleCombo.currentTextChanged[str].connect(self.sceneScaleChanged)
+        # scales between the levels, as fitting produces them, are shown as they are
+        self.sceneScaleCombo.setEditText('{:.3g}%'.format(scale))
 
     @pyqtSlot()
     def about(self):
@@ -796,6 +4753,37 @@ class MainWindow(QMainWindow):
             self.scene.setItemType(DiagramItem.DiagramType(id))
             self.scene.setMode(DiagramScene.Mode.InsertItem)
 
+    @pyqtSlot()
+    def fitToContents(self):
+        self.view.fitToContents()
+
+    @pyqtSlot(bool)
+    def orthogonalArrowsToggled(self, checked):
+        self.scene.setOrthogonalArrows(checked)
+
+    @pyqtSlot(bool)
+    def showMetricsToggled(self, checked):
+        self.view.setShowMetrics(checked)
+
+    @pyqtSlot()
+    def exportMetrics(self):
+        fileName, _ = QFileDialog.getSaveFileName(self, 'Export Performance Metrics', '', 'JSON files (*.json)')
+        if not fileName:
+            return
+        try:
+            with open(fileName, 'w') as f:
+                json.dump(self.scene.metrics.export(), f, indent=1)
+        except OSError as e:
+            QMessageBox.warning(self, 'Export Performance Metrics', 'Cannot save {}:\n{}'.format(fileName, e))
+
+    @pyqtSlot(bool)
+    def snapToGridToggled(self, checked):
+        self.scene.setSnapToGrid(checked)
+
+    @pyqtSlot(bool)
+    def alignToItemsToggled(self, checked):
+        self.scene.setAlignToItems(checked)
+
     @pyqtSlot(QAbstractButton)
     def backgroundButtonGroupClicked(self, button):
         buttons = self.backgroundButtonGroup.buttons()
@@ -804,24 +4792,16 @@ class MainWindow(QMainWindow):
                 button.setChecked(False)
         text = button.text()
         if text == 'Blue Grid':
-            filename = os.path.join(DIR_NAME, 'images\\background1.png') 
-            self.scene.setBackgroundBrush(QBrush(QPixmap(filename)))
+            self.scene.setBackgroundStyle(DiagramScene.BackgroundStyle.BlueGrid)
         elif text == 'White Grid':
-            filename = os.path.join(DIR_NAME, 'images\\background2.png')
-            self.scene.setBackgroundBrush(QBrush(QPixmap(filename)))
+            self.scene.setBackgroundStyle(DiagramScene.BackgroundStyle.WhiteGrid)
         elif text == 'Gray Grid':
-            filename = os.path.join(DIR_NAME, 'images\\background3.png')
-            self.scene.setBackgroundBrush(QBrush(QPixmap(filename)))
+            self.scene.setBackgroundStyle(DiagramScene.BackgroundStyle.GrayGrid)
         else:
-            filename = os.path.join(DIR_NAME, 'images\\background4.png')
-            self.scene.setBackgroundBrush(QBrush(QPixmap(filename)))
-
-        self.scene.update()
-        self.view.update()
+            self.scene.setBackgroundStyle(DiagramScene.BackgroundStyle.NoGrid)
 
     def createCellWidget(self, text, type):
-        item = DiagramItem(type, self.itemMenu)
-        icon = QIcon(item.image())
+        icon = DiagramItem.shapeIcon(type)
 
         button = QToolButton()
         button.setIcon(icon)
@@ -839,8 +4819,7 @@ class MainWindow(QMainWindow):
         return widget
 
     def createCellListWidgetItem(self, text, type):
-        item = DiagramItem(type, self.itemMenu)
-        icon = QIcon(item.image())
+        icon = DiagramItem.shapeIcon(type)
 
         listWidgetItem = QListWidgetItem(text)
         listWidgetItem.setIcon(icon)
@@ -881,6 +4860,16 @@ class MainWindow(QMainWindow):
         self.sendBackAction.setStatusTip('Send item to back')
         self.sendBackAction.triggered.connect(self.sendToBack)
 
+        self.raiseAction = QAction('&Raise', self)
+        self.raiseAction.setShortcut('Ctrl+]')
+        self.raiseAction.setStatusTip('Raise items above the next item covering them')
+        self.raiseAction.triggered.connect(self.raiseItems)
+
+        self.lowerAction = QAction('&Lower', self)
+        self.lowerAction.setShortcut('Ctrl+[')
+        self.lowerAction.setStatusTip('Lower items below the next item they cover')
+        self.lowerAction.triggered.connect(self.lowerItems)
+
         filename = os.path.join(DIR_NAME, 'images\\delete.png')
         self.deleteAction = QAction(QIcon(filename), 
                             '&Delete', self)
@@ -888,6 +4877,41 @@ class MainWindow(QMainWindow):
         self.deleteAction.setStatusTip('Delete item from diagram')
         self.deleteAction.triggered.connect(self.deleteItem)
 
+        self.undoAction = QAction('&Undo', self)
+        self.undoAction.setShortcut(QKeySequence.Undo)
+        self.undoAction.setStatusTip('Undo the last change')
+        self.undoAction.setEnabled(False)
+        self.undoAction.triggered.connect(self.undo)
+
+        self.redoAction = QAction('&Redo', self)
+        self.redoAction.setShortcut(QKeySequence.Redo)
+        self.redoAction.setStatusTip('Redo the last undone change')
+        self.redoAction.setEnabled(False)
+        self.redoAction.triggered.connect(self.redo)
+
+        self.openAction = QAction('&Open...', self)
+        self.openAction.setShortcut(QKeySequence.Open)
+        self.openAction.setStatusTip('Open a saved diagram')
+        self.openAction.triggered.connect(self.openDiagram)
+
+        self.saveAction = QAction('&Save', self)
+        self.saveAction.setShortcut(QKeySequence.Save)
+        self.saveAction.setStatusTip('Save the diagram')
+        self.saveAction.triggered.connect(self.saveDiagram)
+
+        self.saveAsAction = QAction('Save &As...', self)
+        self.saveAsAction.setShortcut(QKeySequence.SaveAs)
+        self.saveAsAction.setStatusTip('Save the diagram under a new name')
+        self.saveAsAction.triggered.connect(self.saveDiagramAs)
+
+        self.importAction = QAction('&Import Graph...', self)
+        self.importAction.setStatusTip('Replace the diagram with a CSV, DOT or GraphML graph')
+        self.importAction.triggered.connect(self.importGraph)
+
+        self.exportAction = QAction('&Export Graph...', self)
+        self.exportAction.setStatusTip('Save the diagram as a CSV, DOT or GraphML graph')
+        self.exportAction.triggered.connect(self.exportGraph)
+
         self.exitAction = QAction('E&xit', self)
         self.exitAction.setShortcut(QKeySequence.Quit)
         self.exitAction.setStatusTip('Quit Scenediagram example')
@@ -913,6 +4937,44 @@ class MainWindow(QMainWindow):
         self.underlineAction.setShortcut('Ctrl+U')
         self.underlineAction.triggered.connect(self.handleFontChange)
 
+        self.snapToGridAction = QAction('&Snap to Grid', self)
+        self.snapToGridAction.setCheckable(True)
+        self.snapToGridAction.setShortcut('Ctrl+G')
+        self.snapToGridAction.setStatusTip('Snap dragged items to the grid')
+        self.snapToGridAction.toggled.connect(self.snapToGridToggled)
+
+        self.alignToItemsAction = QAction('Show &Alignment Guides', self)
+        self.alignToItemsAction.setCheckable(True)
+        self.alignToItemsAction.setChecked(True)
+        self.alignToItemsAction.setStatusTip('Align dragged items with their neighbours')
+        self.alignToItemsAction.toggled.connect(self.alignToItemsToggled)
+
+        self.autoLayoutAction = QAction('Auto &Layout', self)
+        self.autoLayoutAction.setShortcut('Ctrl+L')
+        self.autoLayoutAction.setStatusTip('Arrange the diagram as a layered flowchart')
+        self.autoLayoutAction.setEnabled(diagramlayout is not None)
+        self.autoLayoutAction.triggered.connect(self.autoLayout)
+
+        self.orthogonalArrowsAction = QAction('&Orthogonal Arrows', self)
+        self.orthogonalArrowsAction.setCheckable(True)
+        self.orthogonalArrowsAction.setStatusTip('Route arrows around nodes with right-angled bends')
+        self.orthogonalArrowsAction.toggled.connect(self.orthogonalArrowsToggled)
+
+        self.fitToContentsAction = QAction('&Fit to Contents', self)
+        self.fitToContentsAction.setShortcut('Ctrl+0')
+        self.fitToContentsAction.setStatusTip('Zoom to show the whole diagram')
+        self.fitToContentsAction.triggered.connect(self.fitToContents)
+
+        self.showMetricsAction = QAction('Performance &Overlay', self)
+        self.showMetricsAction.setCheckable(True)
+        self.showMetricsAction.setShortcut('F12')
+        self.showMetricsAction.setStatusTip('Show frame times and drawing counters over the diagram')
+        self.showMetricsAction.toggled.connect(self.showMetricsToggled)
+
+        self.exportMetricsAction = QAction('&Export Performance Metrics...', self)
+        self.exportMetricsAction.setStatusTip('Save the recent frame and event timings as histograms')
+        self.exportMetricsAction.triggered.connect(self.exportMetrics)
+
         self.aboutAction = QAction('A&bout', self)
         self.aboutAction.setShortcut('F1')
         self.aboutAction.triggered.connect(self.about)
@@ -955,13 +5017,13 @@ class MainWindow(QMainWindow):
         self.backgroundButtonGroup.buttonClicked[QAbstractButton].connect(self.backgroundButtonGroupClicked)
 
         backgroundLayout = QGridLayout()
-        filename = os.path.join(DIR_NAME, 'images\\background1.png')
+        filename = os.path.join(DIR_NAME, 'images', 'background1.png')
         backgroundLayout.addWidget(self.createBackgroundCellWidget('Blue Grid', filename), 0, 0)
-        filename = os.path.join(DIR_NAME, 'images\\background2.png')
+        filename = os.path.join(DIR_NAME, 'images', 'background2.png')
         backgroundLayout.addWidget(self.createBackgroundCellWidget('White Grid', filename), 0, 1)
-        filename = os.path.join(DIR_NAME, 'images\\background3.png')
+        filename = os.path.join(DIR_NAME, 'images', 'background3.png')
         backgroundLayout.addWidget(self.createBackgroundCellWidget('Gray Grid', filename), 1, 0)
-        filename = os.path.join(DIR_NAME, 'images\\background4.png')
+        filename = os.path.join(DIR_NAME, 'images', 'background4.png')
         backgroundLayout.addWidget(self.createBackgroundCellWidget('No Grid', filename), 1, 1)
 
         backgroundLayout.setRowStretch(2, 10)
@@ -979,13 +5041,37 @@ class MainWindow(QMainWindow):
 
     def createMenus(self):
         self.fileMenu = self.menuBar().addMenu('&File')
+        self.fileMenu.addAction(self.openAction)
+        self.fileMenu.addAction(self.saveAction)
+        self.fileMenu.addAction(self.saveAsAction)
+        self.fileMenu.addSeparator()
+        self.fileMenu.addAction(self.importAction)
+        self.fileMenu.addAction(self.exportAction)
+        self.fileMenu.addSeparator()
         self.fileMenu.addAction(self.exitAction)
 
         self.itemMenu = self.menuBar().addMenu('&Item')
+        self.itemMenu.addAction(self.undoAction)
+        self.itemMenu.addAction(self.redoAction)
+        self.itemMenu.addSeparator()
         self.itemMenu.addAction(self.deleteAction)
         self.itemMenu.addSeparator()
         self.itemMenu.addAction(self.toFrontAction)
         self.itemMenu.addAction(self.sendBackAction)
+        self.itemMenu.addAction(self.raiseAction)
+        self.itemMenu.addAction(self.lowerAction)
+        self.itemMenu.addSeparator()
+        self.itemMenu.addAction(self.autoLayoutAction)
+
+        self.viewMenu = self.menuBar().addMenu('&View')
+        self.viewMenu.addAction(self.snapToGridAction)
+        self.viewMenu.addAction(self.alignToItemsAction)
+        self.viewMenu.addAction(self.orthogonalArrowsAction)
+        self.viewMenu.addSeparator()
+        self.viewMenu.addAction(self.fitToContentsAction)
+        self.viewMenu.addSeparator()
+        self.viewMenu.addAction(self.showMetricsAction)
+        self.viewMenu.addAction(self.exportMetricsAction)
 
         self.aboutMenu = self.menuBar().addMenu('&Help')
         self.aboutMenu.addAction(self.aboutAction)
@@ -1104,10 +5190,14 @@ class MainWindow(QMainWindow):
         self.pointerTypeGroup.buttonClicked[QAbstractButton].connect(self.pointerGroupClicked)
 
         self.sceneScaleCombo = QComboBox()
-        scales = ["50%", "75%", "100%", "125%", "150%"]
+        scales = [str(level) + '%' for level in DiagramView.ZoomLevels]
         self.sceneScaleCombo.addItems(scales)
-        self.sceneScaleCombo.setCurrentIndex(2)
-        self.sceneScaleCombo.currentTextChanged[str].connect(self.sceneScaleChanged)
+        self.sceneScaleCombo.setCurrentIndex(DiagramView.ZoomLevels.index(100))
+        # editable, so the exact scale of a fit can be shown and any scale typed in
+        self.sceneScaleCombo.setEditable(True)
+        self.sceneScaleCombo.setInsertPolicy(QComboBox.NoInsert)
+        self.sceneScaleCombo.activated[str].connect(self.sceneScaleChanged)
+        self.sceneScaleCombo.lineEdit().editingFinished.connect(self.sceneScaleEdited)
 
         self.pointerToolbar = self.addToolBar('Pointer type')
         self.pointerToolbar.addWidget(pointerButton)
@@ -1116,7 +5206,136 @@ class MainWindow(QMainWindow):
         self.pointerToolbar.addWidget(self.sceneScaleCombo)
 
 
-app = QApplication(sys.argv)
-window = MainWindow()
-window.show()
-app.exec_()
+RENDER_FORMATS = ['png', 'jpg', 'svg', 'pdf']
+
+
+def renderDiagram(fileName, outputFileName, maxSize=4096, margin=20):
+    document = DiagramDocument.open(fileName)
+    scene = DiagramScene(None)
+    document.toScene(scene)
+
+    source = scene.itemsBoundingRect().adjusted(-margin, -margin, margin, margin)
+    if source.isEmpty():
+        source = QRectF(0, 0, 2*margin, 2*margin)
+    scale = min(1., maxSize/max(source.width(), source.height()))
+    target = QRectF(0, 0, source.width()*scale, source.height()*scale)
+    size = target.size().toSize()
+
+    suffix = os.path.splitext(outputFileName)[1].lower()
+    if suffix == '.svg':
+        from PyQt5.QtSvg import QSvgGenerator
+        device = QSvgGenerator()
+        device.setFileName(outputFileName)
+        device.setSize(size)
+        device.setViewBox(target)
+        device.setTitle(os.path.basename(fileName))
+    elif suffix == '.pdf':
+        device = QPdfWriter(outputFileName)
+        device.setTitle(os.path.basename(fileName))
+        device.setResolution(72)
+        device.setPageSizeMM(QSizeF(size)*25.4/72)
+        device.setPageMargins(QMarginsF(0, 0, 0, 0))
+    else:
+        device = QImage(size, QImage.Format_ARGB32)
+        device.fill(Qt.white)
+
+    painter = QPainter(device)
+    painter.setRenderHint(QPainter.Antialiasing)
+    if suffix == '.pdf':
+        painter.setWindow(target.toRect())
+    scene.render(painter, target, source)
+    painter.end()
+
+    if isinstance(device, QImage) and not device.save(outputFileName):
+        raise OSError('cannot write ' + outputFileName)
+    return outputFileName
+
+
+def initRenderWorker():
+    # every worker process needs its own (offscreen) QApplication
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    global renderApp
+    renderApp = QApplication.instance() or QApplication(sys.argv[:1])
+
+
+def renderDiagramJob(job):
+    fileName, outputFileName, maxSize = job
+    try:
+        renderDiagram(fileName, outputFileName, maxSize)
+        return fileName, outputFileName, None
+    except Exception as e:
+        return fileName, outputFileName, '{}: {}'.format(type(e).__name__, e)
+
+
+def renderOutputNames(fileNames, outputDirectory, format='png'):
+    # outputs are named after their inputs; when two inputs share a name, every
+    # output mirrors its input's path below the inputs' common directory instead
+    inputs = {}
+    for fileName in fileNames:
+        inputs.setdefault(os.path.abspath(fileName), fileName)
+    paths = list(inputs)
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    if len(set(map(os.path.normcase, names))) < len(names):
+        root = os.path.commonpath([os.path.dirname(path) for path in paths])
+        names = [os.path.splitext(os.path.relpath(path, root))[0] for path in paths]
+        if len(set(map(os.path.normcase, names))) < len(names):
+            seen = {}
+            for path, name in zip(paths, names):
+                other = seen.setdefault(os.path.normcase(name), path)
+                if other != path:
+                    raise ValueError('{} and {} would both render to {}'.format(inputs[other], inputs[path], name + '.' + format))
+    return [(inputs[path], os.path.join(outputDirectory, name + '.' + format)) for path, name in zip(paths, names)]
+
+
+def renderDiagrams(fileNames, outputDirectory, format='png', jobs=None, maxSize=4096):
+    renderJobs = []
+    for fileName, outputFileName in renderOutputNames(fileNames, outputDirectory, format):
+        os.makedirs(os.path.dirname(outputFileName) or '.', exist_ok=True)
+        renderJobs.append((fileName, outputFileName, maxSize))
+
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(renderJobs) == 1:
+        initRenderWorker()
+        return [renderDiagramJob(job) for job in renderJobs]
+
+    # Qt must not be forked, so the pool always spawns fresh interpreters
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=initRenderWorker) as pool:
+        return list(pool.map(renderDiagramJob, renderJobs, chunksize=max(1, len(renderJobs)//(jobs*4))))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] != 'render':
+        app = QApplication(sys.argv)
+        window = MainWindow()
+        window.show()
+        window.startAutosave()
+        return app.exec_()
+
+    parser = argparse.ArgumentParser(prog='diagramscene.py render', 
+                                    description='Render saved diagrams headlessly.')
+    parser.add_argument('files', nargs='+', help='.diagram or .dgmb files to render')
+    parser.add_argument('-f', '--format', choices=RENDER_FORMATS, default='png', help='output format')
+    parser.add_argument('-o', '--output', default='.', help='output directory')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--max-size', type=int, default=4096, help='largest output side in pixels')
+    args = parser.parse_args(argv[1:])
+
+    os.makedirs(args.output, exist_ok=True)
+    try:
+        results = renderDiagrams(args.files, args.output, args.format, args.jobs, args.max_size)
+    except ValueError as e:
+        parser.error(str(e))
+    failures = 0
+    for fileName, outputFileName, error in results:
+        if error is None:
+            print(outputFileName)
+        else:
+            failures += 1
+            print('{}: {}'.format(fileName, error), file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
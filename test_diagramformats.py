@@ -0,0 +1,162 @@
+import io
+import os
+import tempfile
+import unittest
+
+import diagramformats
+
+
+NODES = [('a', 'a', 'box', 10., 20.), ('b', 'Label "B"\nsecond line', 'diamond', -30.5, 0.),
+         ('c d', 'c d', 'ellipse', 0., 1500.), ('lone', 'Lone <node> & co', 'box', 5., 5.)]
+EDGES = [('a', 'b'), ('b', 'c d'), ('c d', 'a')]
+
+
+def collect(records):
+    # the graph the records describe: key -> [label, shape, pos], and the edges
+    nodes = {}
+    edges = []
+    for record in records:
+        if record[0] == 'edge':
+            edges.append(record[1:])
+            continue
+        _, key, label, shape, pos, explicit = record
+        if key not in nodes:
+            nodes[key] = [label, shape, pos]
+        elif explicit:
+            nodes[key] = [label if label is not None else nodes[key][0], shape or nodes[key][1], pos or nodes[key][2]]
+    return nodes, edges
+
+
+def readText(reader, text, **options):
+    return collect(reader(io.StringIO(text), **options))
+
+
+class CsvTest(unittest.TestCase):
+    def testRoundTrip(self):
+        f = io.StringIO()
+        diagramformats.writeCsv(f, NODES, EDGES)
+        f.seek(0)
+        nodes, edges = collect(diagramformats.readCsv(f))
+        self.assertEqual(edges, EDGES)
+        self.assertEqual({key: shape for key, (label, shape, pos) in nodes.items()},
+                         {key: shape for key, label, shape, x, y in NODES})
+
+    def testHeaderColumns(self):
+        nodes, edges = readText(diagramformats.readCsv, 'Target, Source ,target_shape\nb,a,diamond\nc,b,\n')
+        self.assertEqual(edges, [('a', 'b'), ('b', 'c')])
+        self.assertEqual(nodes['b'][1], 'diamond')
+        self.assertIsNone(nodes['a'][1])
+
+    def testNoHeader(self):
+        nodes, edges = readText(diagramformats.readCsv, 'x,y\n\ny,z\nlone\n')
+        self.assertEqual(edges, [('x', 'y'), ('y', 'z')])
+        self.assertEqual(sorted(nodes), ['lone', 'x', 'y', 'z'])
+
+
+class DotTest(unittest.TestCase):
+    def testRoundTrip(self):
+        f = io.StringIO()
+        diagramformats.writeDot(f, NODES, EDGES)
+        f.seek(0)
+        nodes, edges = collect(diagramformats.readDot(f))
+        self.assertEqual(edges, EDGES)
+        # a label that is just the key is left out
+        self.assertEqual(nodes, {key: [None if label == key else label, shape, (x, y)] for key, label, shape, x, y in NODES})
+
+    def testLabelsAndPositions(self):
+        nodes, edges = readText(diagramformats.readDot, r'''
+            strict digraph "G" {
+              graph [rankdir=LR]; rankdir = TB
+              // a comment
+              a [label="\N is here\l", pos="72,-144!"];
+              b [label=<<b>bold</b> text>, pos="bad"];
+              a:n -> b:s:e -> "c" [color=red]; /* block
+              comment */ # preprocessor line
+            }''')
+        self.assertEqual(edges, [('a', 'b'), ('b', 'c')])
+        self.assertEqual(nodes['a'], ['a is here', None, (72., 144.)])
+        self.assertEqual(nodes['b'], ['bold text', None, None])
+        self.assertEqual(nodes['c'], [None, None, None])
+
+    def testSubgraphDefaults(self):
+        nodes, edges = readText(diagramformats.readDot, '''
+            graph {
+              node [shape=ellipse]
+              subgraph cluster_0 { node [shape=box]; x; { node [label="inner"] y } z }
+              w; x -- w
+            }''')
+        self.assertEqual(edges, [('x', 'w')])
+        self.assertEqual(nodes['x'][1], 'box')
+        self.assertEqual(nodes['y'][:2], ['inner', 'box'])
+        self.assertEqual(nodes['z'][:2], [None, 'box'])
+        self.assertEqual(nodes['w'][:2], [None, 'ellipse'])
+
+    def testEdgesToSubgraphsAreRefused(self):
+        with self.assertRaises(ValueError):
+            readText(diagramformats.readDot, 'digraph { a -> { b c } }')
+
+    def testUnterminatedInput(self):
+        with self.assertRaises(ValueError):
+            readText(diagramformats.readDot, 'digraph { a -> b')
+
+    def testTokensSplitAcrossChunks(self):
+        text = 'digraph G {\n  "a long \\"quoted\\" name" -> node_12345 [label=<<i>x</i>>, pos="1.5,2"];\n}\n'
+        expected = list(diagramformats.dotTokens(io.StringIO(text)))
+        for chunkSize in range(1, len(text) + 1):
+            with self.subTest(chunkSize=chunkSize):
+                self.assertEqual(list(diagramformats.dotTokens(io.StringIO(text), chunkSize)), expected)
+        self.assertIn(('id', 'node_12345'), expected)
+        self.assertIn(('string', 'a long "quoted" name'), expected)
+
+
+class GraphmlTest(unittest.TestCase):
+    def testRoundTrip(self):
+        f = io.StringIO()
+        diagramformats.writeGraphml(f, NODES, EDGES)
+        nodes, edges = collect(diagramformats.readGraphml(io.BytesIO(f.getvalue().encode('utf-8'))))
+        self.assertEqual(edges, EDGES)
+        self.assertEqual(nodes, {key: [label, shape, (x, y)] for key, label, shape, x, y in NODES})
+
+    def testYedNodes(self):
+        text = b'''<?xml version="1.0" encoding="UTF-8"?>
+            <graphml xmlns="http://graphml.graphdrawing.org/xmlns" xmlns:y="http://www.yworks.com/xml/graphml">
+              <key id="d0" for="node" yfiles.type="nodegraphics"/>
+              <graph edgedefault="directed">
+                <node id="n0"><data key="d0"><y:ShapeNode>
+                  <y:Geometry x="10" y="20" width="30" height="40"/>
+                  <y:NodeLabel>First</y:NodeLabel><y:Shape type="diamond"/>
+                </y:ShapeNode></data></node>
+                <node id="n1"/>
+                <edge source="n0" target="n1"/>
+                <edge source="n1" target="n2"/>
+              </graph>
+            </graphml>'''
+        nodes, edges = collect(diagramformats.readGraphml(io.BytesIO(text)))
+        self.assertEqual(edges, [('n0', 'n1'), ('n1', 'n2')])
+        self.assertEqual(nodes['n0'], ['First', 'diamond', (25., 40.)])
+        self.assertEqual(nodes['n2'], [None, None, None])
+
+    def testBrokenXml(self):
+        with self.assertRaises(ValueError):
+            collect(diagramformats.readGraphml(io.BytesIO(b'<graphml><graph><node id="a"></graph>')))
+
+
+class GraphFileTest(unittest.TestCase):
+    def testEveryFormat(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for suffix in ('.csv', '.dot', '.gv', '.graphml'):
+                with self.subTest(suffix=suffix):
+                    fileName = os.path.join(directory, 'graph' + suffix)
+                    diagramformats.writeGraph(fileName, NODES, EDGES)
+                    with open(fileName, 'rb') as raw:
+                        nodes, edges = collect(diagramformats.readGraph(fileName, raw))
+                    self.assertEqual(edges, EDGES)
+                    self.assertEqual(sorted(nodes), sorted(key for key, label, shape, x, y in NODES))
+
+    def testUnknownSuffix(self):
+        with self.assertRaises(ValueError):
+            diagramformats.graphFormat('graph.txt')
+
+
+if __name__ == '__main__':
+    unittest.main()
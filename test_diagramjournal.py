@@ -0,0 +1,139 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import diagramjournal
+
+
+def insertOp(op='insert', nodes=(), texts=(), arrows=()):
+    # nodes as (id, labelId, x, y), texts as (id, x, y, text), arrows as (id, startId, endId)
+    return {'op': op, 'nodeIds': [node[0] for node in nodes], 'labelIds': [node[1] for node in nodes],
+            'types': [0]*len(nodes), 'xs': [node[2] for node in nodes], 'ys': [node[3] for node in nodes],
+            'zs': [0.]*len(nodes), 'styleIds': [1]*len(nodes), 'labelXs': [0.]*len(nodes), 'labelYs': [60.]*len(nodes),
+            'labelStyleIds': [2]*len(nodes), 'names': ['node {}'.format(node[0]) for node in nodes],
+            'textIds': [text[0] for text in texts], 'textOwnerIds': [-1]*len(texts), 'textXs': [text[1] for text in texts],
+            'textYs': [text[2] for text in texts], 'textZs': [1000.]*len(texts), 'textStyleIds': [2]*len(texts),
+            'texts': [text[3] for text in texts], 'arrowIds': [arrow[0] for arrow in arrows],
+            'startIds': [arrow[1] for arrow in arrows], 'endIds': [arrow[2] for arrow in arrows],
+            'arrowStyleIds': [1]*len(arrows)}
+
+
+STYLES = {'op': 'styles', 'styles': [[1, 0xff00ff00, None], [2, 0xff000000, 'Sans,10,-1,5,50,0,0,0,0,0'], [3, 0xffff0000, None]]}
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = diagramjournal.Journal(self.directory)
+        self.journal.open()
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def journalName(self):
+        return os.path.join(self.directory, diagramjournal.JOURNAL_FILE)
+
+    def write(self, ops):
+        self.journal.append(ops)
+        self.journal.sync()
+
+    def recover(self):
+        return diagramjournal.recoverJournal(self.directory)
+
+    def startSession(self):
+        self.write([STYLES, insertOp('reset', nodes=[(0, 1, 0., 0.), (4, 5, 100., 0.), (8, 9, 200., 0.)],
+                                     texts=[(3, 50., 50., 'free')], arrows=[(2, 0, 4), (6, 4, 8)])])
+
+    def testNothingToRecover(self):
+        self.journal.close(discard=True)
+        self.assertIsNone(self.recover())
+
+    def testOperationsReplay(self):
+        self.startSession()
+        self.write([{'op': 'translate', 'ids': [0, 3], 'dx': 5., 'dy': -5.},
+                    {'op': 'move', 'ids': [4], 'xs': [150.], 'ys': [40.]},
+                    {'op': 'style', 'ids': [8, 6], 'styleIds': [3, 3]},
+                    {'op': 'text', 'id': 5, 'text': 'renamed'},
+                    {'op': 'zorder', 'ids': [0, 8], 'zs': [2., -1.]},
+                    {'op': 'remove', 'ids': [2, 3]},
+                    insertOp(nodes=[(12, -1, 7., 7.)], arrows=[(14, 12, 0)])])
+        state = self.recover()
+        self.assertEqual(state.seq, self.journal.state.seq)
+        self.assertEqual(state.nodes[0][1:4], [5., -5., 2.])
+        self.assertEqual(state.nodes[4][1:3], [150., 40.])
+        self.assertEqual(state.nodes[8][3:5], [-1., 3])
+        self.assertEqual(state.arrows[6][2], 3)
+        self.assertEqual(state.nodes[4][5], 'renamed')
+        self.assertEqual(state.texts[5][5], 'renamed')
+        self.assertNotIn(2, state.arrows)
+        self.assertNotIn(3, state.texts)
+        self.assertEqual(state.arrows[14], [12, 0, 1])
+        self.assertNotIn(12, state.labels)
+        self.assertEqual(state.styles[3], (0xffff0000, None))
+
+    def testTornLastLine(self):
+        self.startSession()
+        self.write([{'op': 'move', 'ids': [0], 'xs': [10.], 'ys': [10.]},
+                    {'op': 'move', 'ids': [0], 'xs': [20.], 'ys': [20.]}])
+        # a crash in the middle of writing the last line
+        with open(self.journalName(), 'rb+') as f:
+            f.truncate(os.path.getsize(self.journalName()) - 10)
+        state = self.recover()
+        self.assertEqual(state.nodes[0][1:3], [10., 10.])
+        self.assertEqual(state.seq, self.journal.state.seq - 1)
+
+    def testResetCompacts(self):
+        self.write([STYLES, insertOp(nodes=[(0, 1, 0., 0.)])])
+        self.assertGreater(os.path.getsize(self.journalName()), 0)
+        self.startSession()
+        # the reset went straight into the snapshot and the journal started over
+        self.assertEqual(os.path.getsize(self.journalName()), 0)
+        with open(os.path.join(self.directory, diagramjournal.SNAPSHOT_FILE), encoding='utf-8') as f:
+            self.assertEqual(json.load(f)['seq'], self.journal.state.seq)
+        self.assertEqual(sorted(self.recover().nodes), [0, 4, 8])
+
+    def testCompactionPastSize(self):
+        self.journal.CompactSize = 1000
+        self.startSession()
+        for i in range(20):
+            self.write([{'op': 'move', 'ids': [4], 'xs': [float(i)], 'ys': [0.]}])
+        self.assertLess(os.path.getsize(self.journalName()), 1000)
+        self.assertEqual(self.recover().nodes[4][1], 19.)
+
+    def testCrashBetweenSnapshotAndTruncate(self):
+        self.startSession()
+        self.write([{'op': 'translate', 'ids': [0], 'dx': 10., 'dy': 0.},
+                    {'op': 'translate', 'ids': [0], 'dx': 5., 'dy': 0.}])
+        # the snapshot is replaced, but the old journal survives the crash
+        journalCopy = self.journalName() + '.copy'
+        shutil.copyfile(self.journalName(), journalCopy)
+        self.journal.compact()
+        self.journal.close()
+        os.replace(journalCopy, self.journalName())
+        state = self.recover()
+        # the translations are in the snapshot and are not applied a second time
+        self.assertEqual(state.nodes[0][1], 15.)
+        self.assertEqual(state.seq, self.journal.state.seq)
+
+    def testSnapshotDropsArrowsWithoutEnds(self):
+        self.startSession()
+        self.write([{'op': 'remove', 'ids': [8]}])
+        self.journal.compact()
+        state = self.recover()
+        self.assertEqual(sorted(state.arrows), [2])
+        self.assertNotIn(9, state.texts)
+
+    def testUnknownOperation(self):
+        with self.assertRaises(ValueError):
+            diagramjournal.JournalState().apply({'op': 'unknown'})
+
+    def testNotASnapshot(self):
+        with self.assertRaises(ValueError):
+            diagramjournal.JournalState.fromSnapshot({'format': 'other'})
+
+
+if __name__ == '__main__':
+    unittest.main()